@@ -0,0 +1,370 @@
+#!/usr/bin/env python
+# --coding:utf-8--
+
+import asyncio
+import functools
+import uuid
+
+from google.api_core import exceptions
+from google.api_core.retry_async import AsyncRetry, if_exception_type
+from google.cloud import dialogflow_v2 as dialogflow
+from google.cloud.dialogflow_v2.services.contexts.transports import ContextsGrpcAsyncIOTransport
+
+from channel_pool import GLOBAL, ROUND_ROBIN, ClientPool, create_async_sessions_client
+from dialogflow_helper import BaseDialogflowHelper, BatchResult
+
+# Retry what the service refused to take on (UNAVAILABLE), with a short
+# backoff; the per-call deadline bounds the attempts
+DEFAULT_RETRY = AsyncRetry(predicate=if_exception_type(exceptions.ServiceUnavailable),
+                           initial=0.1, maximum=1.0, multiplier=2.0, timeout=None)
+
+
+class AsyncDialogflowHelper(BaseDialogflowHelper):
+    """
+    asyncio counterpart of DialogflowHelper, on SessionsAsyncClient and
+    ContextsAsyncClient (sharing one channel), or a pool of
+    SessionsAsyncClients on `pool_size` channels.
+
+    Every call is a coroutine awaited on the event loop, so concurrent
+    queries don't need a thread each. Calls have a deadline of `timeout`
+    seconds, retries included, and raise DeadlineExceeded past it.
+    Cancelling the awaiting task cancels the RPC, and close() cancels every
+    call in flight (they raise google.api_core.exceptions.Cancelled) before
+    closing the channel. DetectIntent calls go through the optional circuit
+    breaker and hedge policy, like DialogflowHelper's.
+
+    The async clients are bound to the event loop they are created on, so
+    they are created by the first call, on that loop.
+    """
+
+    def __init__(self, project_id, session_id, language_code="en",
+                 session_ttl=1200, max_sessions=10000,
+                 client_factory=None, response_cache=None, timeout=10.0, retry=DEFAULT_RETRY,
+                 breaker=None, hedge=None, location=GLOBAL, pool_size=1, pool_policy=ROUND_ROBIN):
+        """
+        :param project_id: GCP project ID associated with the Dialogflow agent
+        :param session_id: Default session ID, used when a call doesn't name one
+        :param language_code: Language code, e.g. 'en'
+        :param session_ttl: Seconds an idle per-chat session is kept in the registry
+        :param max_sessions: Maximum number of per-chat sessions kept in the registry
+        :param client_factory: Optional callable returning a SessionsAsyncClient
+                               (e.g. on a custom channel); called once per channel
+        :param response_cache: Optional IntentResponseCache for context-free intents.
+                               Its lookups run on the event loop, so prefer the
+                               in-memory cache here.
+        :param timeout: Default deadline of a call in seconds, retries included
+        :param retry: AsyncRetry policy, None to disable retries
+        :param breaker: Optional CircuitBreaker, see BaseDialogflowHelper
+        :param hedge: Optional HedgePolicy, see BaseDialogflowHelper
+        :param location: Location of the agent, see BaseDialogflowHelper; the
+                         default clients talk to its regional endpoint
+        :param pool_size: Number of channels calls are spread over; give the
+                          factory's channels their own connections (see
+                          channel_pool.channel_options)
+        :param pool_policy: channel_pool.ROUND_ROBIN or LEAST_LOADED
+        """
+        super().__init__(project_id, session_id, language_code,
+                         session_ttl=session_ttl,
+                         max_sessions=max_sessions,
+                         response_cache=response_cache,
+                         breaker=breaker,
+                         hedge=hedge,
+                         location=location)
+        self._client_factory = client_factory or functools.partial(create_async_sessions_client, location)
+        self.timeout = timeout
+        self.retry = retry
+        self.pool_size = max(1, pool_size)
+        self.pool_policy = pool_policy
+
+        self.clients = None
+        self.sessions_client = None
+        self.contexts_client = None
+        self._calls = set()
+        self._closed = False
+
+    async def detect_intent(self, text, session_id=None, query_params=None, timeout=None):
+        """
+        Send a single text query.
+
+        :param text: User input text
+        :param session_id: Session ID, defaults to the helper's session
+        :param query_params: Optional QueryParameters (input contexts, reset_contexts, ...)
+        :param timeout: Deadline in seconds, defaults to the helper's
+        :return: Dialogflow DetectIntentResponse object
+        """
+        session_path = self.get_session_path(session_id)
+
+        # Context-free answers ("hi", "help") can be served from the cache
+        cache = self.response_cache
+        if cache is not None:
+            if query_params is not None and query_params.contexts:
+                cache.track_contexts(session_path, True)
+            elif query_params is None or not query_params.reset_contexts:
+                cached = cache.lookup(session_path, text, self.language_code)
+                if cached is not None:
+                    return cached
+
+        text_input = dialogflow.TextInput(text=text, language_code=self.language_code)
+        request = {"session": session_path, "query_input": dialogflow.QueryInput(text=text_input)}
+        if query_params is not None:
+            request["query_params"] = query_params
+        response = await self._detect_intent_request(request, timeout)
+
+        if cache is not None:
+            cache.store(session_path, text, self.language_code, response)
+        return response
+
+    async def detect_intent_texts(self, text_list, session_id=None):
+        """
+        Send text queries one after the other (they may depend on each
+        other's contexts).
+
+        :param text_list: List of user text inputs
+        :param session_id: Session ID, defaults to the helper's session
+        :return: List of response objects from Dialogflow
+        """
+        return [await self.detect_intent(text, session_id) for text in text_list]
+
+    async def detect_intent_batch(self, text_list, max_concurrency=8, session_id=None):
+        """
+        Send a batch of text queries concurrently; see
+        DialogflowHelper.detect_intent_batch.
+
+        :param text_list: List of user text inputs
+        :param max_concurrency: Maximum number of requests in flight
+        :param session_id: Run every query in this session instead
+        :return: List of BatchResult, in input order
+        """
+        results = [None] * len(text_list)
+        async for result in self.iter_detect_intent_batch(text_list, max_concurrency,
+                                                          session_id, ordered=False):
+            results[result.index] = result
+        return results
+
+    async def iter_detect_intent_batch(self, text_list, max_concurrency=8, session_id=None,
+                                       ordered=True):
+        """
+        Async generator variant of detect_intent_batch that yields results
+        as they are ready.
+
+        :param text_list: List of user text inputs
+        :param max_concurrency: Maximum number of requests in flight
+        :param session_id: Run every query in this session instead
+        :param ordered: Yield in input order (True) or in completion order (False)
+        :return: Async generator of BatchResult
+        """
+        batch_id = uuid.uuid4().hex[:8]
+        texts = list(text_list)
+        max_concurrency = max(1, max_concurrency)
+
+        async def run(index):
+            text = texts[index]
+            try:
+                response = await self.detect_intent(text, session_id or f"batch-{batch_id}-{index}")
+                return BatchResult(index, text, response, None)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                return BatchResult(index, text, None, e)
+
+        pending = set()
+        next_index = 0
+        next_to_yield = 0
+        done = {}
+        try:
+            while next_index < len(texts) or pending:
+                while next_index < len(texts) and len(pending) < max_concurrency:
+                    pending.add(asyncio.ensure_future(run(next_index)))
+                    next_index += 1
+                finished, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in finished:
+                    result = task.result()
+                    if not ordered:
+                        yield result
+                        continue
+                    done[result.index] = result
+                while next_to_yield in done:
+                    yield done.pop(next_to_yield)
+                    next_to_yield += 1
+        finally:
+            # The consumer stopped early or was cancelled
+            for task in pending:
+                task.cancel()
+
+    async def detect_intent_with_contexts(self, text, context_name, lifespan_count=5, parameters=None,
+                                          session_id=None):
+        """
+        Detect intent for text with an input context, in a single request.
+
+        :param text: The user query text
+        :param context_name: The context name to set
+        :param lifespan_count: Number of conversational turns for which the context remains active
+        :param parameters: Parameters for the context: a dict of plain values or of
+                           google.protobuf.struct_pb2.Value, or a Struct
+        :param session_id: Session ID, defaults to the helper's session
+        :return: Dialogflow DetectIntentResponse object
+        """
+        session_id = session_id or self.session_id
+        query_params = None
+        if context_name:
+            context = dialogflow.Context(
+                name=self.get_context_path(session_id, context_name),
+                lifespan_count=lifespan_count,
+                # Marshalled to a Struct like the event parameters
+                parameters=parameters or {}
+            )
+            query_params = dialogflow.QueryParameters(contexts=[context])
+        return await self.detect_intent(text, session_id, query_params)
+
+    async def detect_intent_with_reset(self, text, session_id=None):
+        """
+        Detect intent for text after dropping every active context of the
+        session, in the same request.
+
+        :param text: The user query text
+        :param session_id: Session ID, defaults to the helper's session
+        :return: Dialogflow DetectIntentResponse object
+        """
+        query_params = dialogflow.QueryParameters(reset_contexts=True)
+        return await self.detect_intent(text, session_id, query_params)
+
+    async def clear_contexts(self, session_id=None):
+        """
+        Clear all active contexts of a session with one DeleteAllContexts call.
+
+        :param session_id: Session ID, defaults to the helper's session
+        """
+        session_path = self.get_session_path(session_id)
+        self._sessions()
+        await self._call(self.contexts_client.delete_all_contexts, {"parent": session_path}, None)
+        if self.response_cache is not None:
+            self.response_cache.track_contexts(session_path, False)
+
+    async def detect_intent_with_event(self, event_name, parameters=None, session_id=None):
+        """
+        Trigger a custom event to Dialogflow rather than sending user text.
+
+        :param event_name: Name of the event
+        :param parameters: Parameters to pass along with the event: a dict of plain
+                           values or of google.protobuf.struct_pb2.Value, or a Struct
+        :param session_id: Session ID, defaults to the helper's session
+        :return: Dialogflow DetectIntentResponse object
+        """
+        event_input = dialogflow.EventInput(name=event_name,
+                                            language_code=self.language_code,
+                                            # Values of any of those forms are marshalled to a Struct
+                                            parameters=parameters or {})
+        request = {"session": self.get_session_path(session_id),
+                   "query_input": dialogflow.QueryInput(event=event_input)}
+        return await self._detect_intent_request(request)
+
+    async def close(self):
+        """
+        Cancel the calls in flight and close the channels, e.g. when the
+        webhook shuts down. Later calls raise Cancelled.
+        """
+        self._closed = True
+        calls = list(self._calls)
+        for task in calls:
+            task.cancel()
+        if calls:
+            await asyncio.gather(*calls, return_exceptions=True)
+        if self.clients is not None:
+            for client in self.clients.clients:
+                await client.transport.close()
+
+    def _sessions(self):
+        if self._closed:
+            raise exceptions.Cancelled("Dialogflow helper closed")
+        if self.sessions_client is None:
+            self.clients = ClientPool([self._client_factory() for _ in range(self.pool_size)],
+                                      self.pool_policy)
+            self.sessions_client = self.clients.clients[0]
+            # Contexts client on the first channel
+            self.contexts_client = dialogflow.ContextsAsyncClient(
+                transport=ContextsGrpcAsyncIOTransport(channel=self.sessions_client.transport.grpc_channel)
+            )
+        return self.sessions_client
+
+    async def _detect_intent_request(self, request, timeout=None):
+        """
+        DetectIntent under the circuit breaker, deadline, retry and hedge policies.
+
+        :param request: DetectIntentRequest fields (dict)
+        :param timeout: Deadline in seconds, defaults to the helper's
+        :return: Dialogflow DetectIntentResponse object
+        """
+        self._sessions()
+        self._allow_call()
+        try:
+            if self.hedge is None:
+                response = await self._detect(request, timeout)
+            else:
+                response = await self._call_hedged(request, timeout)
+        except asyncio.CancelledError:
+            # Neither a success nor a failure of Dialogflow
+            if self.breaker is not None:
+                self.breaker.release()
+            raise
+        except Exception as e:
+            self._record_call(e)
+            raise
+        self._record_call()
+        return response
+
+    async def _call_hedged(self, request, timeout):
+        """
+        Run one DetectIntent with a hedge: if it hasn't answered after the
+        hedge policy's delay (or failed with UNAVAILABLE before), a second
+        one is sent (on the pool's next channel) and the first answer wins;
+        the other one is cancelled. Both share the deadline.
+        """
+        loop = asyncio.get_running_loop()
+        timeout = self.timeout if timeout is None else timeout
+        started = loop.time()
+        first = asyncio.ensure_future(self._detect(request, timeout))
+        attempts = [first]
+        try:
+            await asyncio.wait(attempts, timeout=self.hedge.delay())
+            remaining = timeout - (loop.time() - started)
+            # Like DialogflowHelper: a fast UNAVAILABLE is hedged right away
+            unavailable = (first.done() and not first.cancelled()
+                           and isinstance(first.exception(), exceptions.ServiceUnavailable))
+            if (not first.done() or unavailable) and remaining > 0 and self.hedge.should_hedge():
+                attempts.append(asyncio.ensure_future(self._detect(request, remaining)))
+
+            pending = set(attempts)
+            while True:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                winner = next((a for a in attempts if a in done and a.exception() is None), None)
+                if winner is not None or not pending:
+                    self.hedge.record(loop.time() - started,
+                                      hedge_won=winner is not None and winner is not first)
+                    # The winner's response, else the last failure
+                    return (winner or attempts[-1]).result()
+        finally:
+            for attempt in attempts:
+                attempt.cancel()
+
+    async def _detect(self, request, timeout):
+        """DetectIntent on a client of the pool."""
+        with self.clients.client() as client:
+            return await self._call(client.detect_intent, request, timeout)
+
+    async def _call(self, method, request, timeout):
+        """
+        Run one RPC under the deadline and retry policy, as a task close() can cancel.
+        """
+        timeout = self.timeout if timeout is None else timeout
+        task = asyncio.ensure_future(method(request=request, retry=self.retry, timeout=timeout))
+        self._calls.add(task)
+        try:
+            return await asyncio.wait_for(task, timeout)
+        except asyncio.TimeoutError:
+            raise exceptions.DeadlineExceeded(f"Dialogflow call exceeded its {timeout}s deadline") from None
+        except asyncio.CancelledError:
+            if self._closed and task.cancelled():
+                raise exceptions.Cancelled("Dialogflow helper closed") from None
+            raise
+        finally:
+            self._calls.discard(task)
@@ -0,0 +1,363 @@
+#!/usr/bin/env python
+# --coding:utf-8--
+
+import asyncio
+import json
+import logging
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+from webhook_parser import MAX_BODY, MESSAGE_EVENT, InvalidCallback, WebhookParser
+
+logger = logging.getLogger(__name__)
+
+# Limits of the request head, as http.server enforces them (lines are
+# capped by the StreamReader limit, 64 KiB)
+MAX_HEADERS = 100
+MAX_HEADER_BYTES = 64 * 1024
+
+
+class AsyncWebhookServer:
+    """
+    An asyncio-based ingress for Lark event callbacks.
+
+    Unlike http.server.HTTPServer, every connection is served by its own
+    coroutine, so a slow client or a burst of events does not queue the
+    other callbacks behind it. Each request is verified and acknowledged
+    before any downstream work runs; text messages are then handed to an
+    in-process async pipeline (a bounded asyncio.Queue drained by worker
+    tasks) instead of a new thread per message. The blocking dedup and
+    enqueue callables (Redis, SQLite) run in a small thread pool of their
+    own, so a slow store holds up the callbacks waiting for it, not the
+    event loop (health checks, /metrics, other connections).
+
+    With a `key` function, messages with the same key (e.g. the same
+    chat_id) are handled one at a time and in arrival order, while
+    different keys run in parallel; see WorkerPool for the scheme.
+    """
+
+    def __init__(self, verification_token, handle_message, is_duplicate=None, host="",
+                 port=8000, workers=16, max_queue=10000, max_body=MAX_BODY, key=None,
+                 enqueue=None, reuse_port=False, on_request=None, routes=None, loads=None,
+                 drain_timeout=None, forget=None):
+        """
+        :param verification_token: APP_VERIFICATION_TOKEN from the Lark developer console
+        :param handle_message: Callable taking a Lark message dict. A blocking one
+                               (Dialogflow + Open API calls) runs in a thread pool;
+                               a coroutine function is awaited on the event loop.
+        :param is_duplicate: Optional callable taking the CallbackEvent of a message and
+                             returning True for a retry that was already accepted;
+                             it may block, it runs in the ingress thread pool
+        :param host: Interface to bind, '' for all interfaces
+        :param port: Port to listen on
+        :param workers: Number of pipeline workers (and executor threads)
+        :param max_queue: Maximum number of acked events waiting for a worker
+        :param max_body: Maximum accepted request body size in bytes
+        :param key: Optional callable returning a message's ordering key
+        :param enqueue: Optional callable taking a message, used instead of the
+                        in-process pipeline (e.g. to write it to a durable queue).
+                        It runs before the ack, in the ingress thread pool.
+        :param reuse_port: Bind with SO_REUSEPORT, so several processes can share the port
+        :param on_request: Optional callable run after every request with the event type
+                           (None for other requests) and the seconds it took to answer
+        :param routes: Optional dict of GET paths to callables returning (content type, body)
+                       or (content type, body, status)
+        :param loads: Optional callable decoding JSON bytes, see webhook_parser.json_loads
+        :param drain_timeout: Seconds stop() waits for the queued messages before it
+                              cancels the ones still being handled; None to wait for all
+        :param forget: Optional callable taking the CallbackEvent of a message that
+                       could not be queued after is_duplicate claimed it, undoing
+                       the claim so Lark's retry is accepted; runs in the ingress
+                       thread pool
+        """
+        self.verification_token = verification_token
+        self.handle_message = handle_message
+        self.is_duplicate = is_duplicate
+        self.host = host
+        self.port = port
+        self.workers = workers
+        self.max_queue = max_queue
+        self.max_body = max_body
+        self.key = key
+        self.enqueue = enqueue
+        self.reuse_port = reuse_port
+        self.on_request = on_request
+        self.routes = routes or {}
+        self.drain_timeout = drain_timeout
+        self.forget = forget
+        self.parser = WebhookParser(verification_token, max_body, loads)
+
+        self.queue = None
+        # Ordered mode: the queue holds keys, each key has a FIFO of messages
+        self._keyed = {}
+        self._keyed_depth = 0
+        self._server = None
+        self._executor = None
+        self._ingress_executor = None
+        self._worker_tasks = []
+        self._loop = None
+        self._stop_requested = None
+
+    async def start(self):
+        """Bind the listening socket and start the pipeline workers."""
+        self._loop = asyncio.get_running_loop()
+        self._stop_requested = asyncio.Event()
+        self.queue = asyncio.Queue(maxsize=self.max_queue)
+        self._executor = ThreadPoolExecutor(max_workers=self.workers,
+                                            thread_name_prefix="pipeline")
+        self._ingress_executor = ThreadPoolExecutor(max_workers=self.workers,
+                                                    thread_name_prefix="ingress")
+        self._worker_tasks = [asyncio.create_task(self._worker())
+                              for _ in range(self.workers)]
+        self._server = await asyncio.start_server(self._handle_connection,
+                                                  self.host or None, self.port,
+                                                  reuse_port=self.reuse_port or None)
+        # Pick up the real port when binding to port 0
+        self.port = self._server.sockets[0].getsockname()[1]
+
+    async def serve_forever(self):
+        """Start the server (if needed) and serve until cancelled or request_stop()."""
+        if self._server is None:
+            await self.start()
+        try:
+            await self._stop_requested.wait()
+        finally:
+            await self.stop()
+
+    def request_stop(self):
+        """Make serve_forever() stop and drain; safe to call from any thread."""
+        if self._loop is not None:
+            self._loop.call_soon_threadsafe(self._stop_requested.set)
+
+    async def stop(self):
+        """
+        Stop accepting connections, let queued events finish (for up to
+        drain_timeout seconds), and stop the workers. Coroutine handlers
+        still running then are cancelled, with the calls they await.
+        """
+        if self._server is not None:
+            self._server.close()
+        if self.queue is not None:
+            try:
+                await asyncio.wait_for(self.queue.join(), self.drain_timeout)
+            except asyncio.TimeoutError:
+                logger.warning("drain timed out, cancelling the messages in flight",
+                               extra={"waiting": self._keyed_depth if self.key else self.queue.qsize()})
+        for task in self._worker_tasks:
+            task.cancel()
+        await asyncio.gather(*self._worker_tasks, return_exceptions=True)
+        self._worker_tasks = []
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
+            self._executor = None
+        if self._ingress_executor is not None:
+            self._ingress_executor.shutdown(wait=True)
+            self._ingress_executor = None
+
+    async def _worker(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            item = await self.queue.get()
+            if self.key is None:
+                message = item
+            else:
+                message = self._keyed[item].popleft()
+                self._keyed_depth -= 1
+            try:
+                if asyncio.iscoroutinefunction(self.handle_message):
+                    await self.handle_message(message)
+                else:
+                    await loop.run_in_executor(self._executor, self.handle_message, message)
+            except Exception:
+                logger.exception("handle_message failed")
+            finally:
+                if self.key is not None:
+                    if self._keyed[item]:
+                        # Back of the line: other chats get a turn first
+                        self.queue.put_nowait(item)
+                    else:
+                        del self._keyed[item]
+                self.queue.task_done()
+
+    def _enqueue(self, message):
+        """
+        Queue a message for the workers, raising asyncio.QueueFull at capacity.
+        """
+        if self.key is None:
+            self.queue.put_nowait(message)
+            return
+
+        if self._keyed_depth >= self.max_queue:
+            raise asyncio.QueueFull
+        key = self.key(message)
+        pending = self._keyed.get(key)
+        if pending is None:
+            pending = self._keyed[key] = deque()
+            self.queue.put_nowait(key)
+        pending.append(message)
+        self._keyed_depth += 1
+
+    async def _handle_connection(self, reader, writer):
+        try:
+            while True:
+                try:
+                    request_line = await reader.readline()
+                except ValueError:
+                    # Longer than the reader's limit
+                    await self._write_response(writer, 414, "", keep_alive=False)
+                    break
+                if not request_line:
+                    break
+                started = time.perf_counter()
+
+                parts = request_line.decode("latin-1").split()
+                if len(parts) != 3:
+                    await self._write_response(writer, 400, "", keep_alive=False)
+                    break
+                method, target, version = parts
+
+                try:
+                    headers = await self._read_headers(reader)
+                except InvalidCallback as e:
+                    await self._write_response(writer, e.status, "", keep_alive=False)
+                    break
+
+                connection = headers.get("connection", "").lower()
+                if version == "HTTP/1.1":
+                    keep_alive = connection != "close"
+                else:
+                    keep_alive = connection == "keep-alive"
+
+                if method == "POST" or "content-length" in headers:
+                    try:
+                        length = self.parser.body_length(headers.get("content-length"),
+                                                         headers.get("transfer-encoding"))
+                    except InvalidCallback as e:
+                        # The body (if any) isn't read, so the connection can't be reused
+                        await self._write_response(writer, e.status, "", keep_alive=False)
+                        break
+                else:
+                    length = 0
+                body = await reader.readexactly(length) if length else b""
+
+                event_type, content_type = None, "application/json"
+                try:
+                    if method == "POST":
+                        status, rsp_body, event_type = await self._dispatch(body)
+                    elif method == "GET":
+                        route = self.routes.get(target.partition("?")[0])
+                        if route is not None:
+                            content_type, rsp_body, *status = route()
+                            status = status[0] if status else 200
+                        else:
+                            status, rsp_body = 404, ""
+                    else:
+                        status, rsp_body = 405, ""
+                except Exception:
+                    # E.g. the dedup store or event queue is down: Lark retries on a 5xx
+                    logger.exception("request failed", extra={"method": method, "target": target})
+                    status, rsp_body, content_type = 500, "", "application/json"
+
+                await self._write_response(writer, status, rsp_body, keep_alive, content_type)
+                if self.on_request is not None:
+                    self.on_request(event_type, time.perf_counter() - started)
+                if not keep_alive:
+                    break
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+    @staticmethod
+    async def _read_headers(reader):
+        """
+        :return: dict of the request's headers, lower-case names
+        :raise InvalidCallback: 431 if there are too many or they are too long
+        """
+        headers = {}
+        count = size = 0
+        while True:
+            try:
+                line = await reader.readline()
+            except ValueError:
+                raise InvalidCallback(431, "header line too long") from None
+            if line in (b"\r\n", b"\n", b""):
+                return headers
+            count += 1
+            size += len(line)
+            if count > MAX_HEADERS or size > MAX_HEADER_BYTES:
+                raise InvalidCallback(431, "request headers too large")
+            name, _, value = line.decode("latin-1").partition(":")
+            headers[name.strip().lower()] = value.strip()
+
+    async def _dispatch(self, body):
+        """
+        Verify and route one callback. The event is enqueued before the ack
+        is written; only the dedup and enqueue calls leave the event loop.
+
+        :return: (status, response body, event type)
+        """
+        try:
+            event = self.parser.parse(body)
+        except InvalidCallback as e:
+            logger.warning("callback rejected", extra={"reason": e.reason})
+            return e.status, "", None
+
+        # Verify token
+        if not event.verified:
+            logger.warning("verification token not match", extra={"token": event.token})
+            return 200, "", None
+
+        event_type = event.event_type
+
+        if event_type == "url_verification":
+            return 200, json.dumps({"challenge": event.challenge}), event_type
+
+        if event_type == MESSAGE_EVENT:
+            # Drop Lark retries before they are queued
+            if self.is_duplicate is not None and await self._off_loop(self.is_duplicate, event):
+                return 200, json.dumps({"msg": "ok"}), event_type
+
+            message = event.message
+            if message.get("message_type", "") == "text":
+                try:
+                    if self.enqueue is not None:
+                        await self._off_loop(self.enqueue, message)
+                    else:
+                        self._enqueue(message)
+                except asyncio.QueueFull:
+                    # Not acked: Lark delivers it again later
+                    logger.warning("pipeline queue full, message refused",
+                                   extra={"message_id": message.get("message_id", "")})
+                    await self._forget(event)
+                    return 503, "", event_type
+                except Exception:
+                    await self._forget(event)
+                    raise
+            return 200, json.dumps({"msg": "ok"}), event_type
+
+        # For other event types, just return 200 quickly
+        return 200, "", event_type
+
+    async def _forget(self, event):
+        if self.forget is not None:
+            await self._off_loop(self.forget, event)
+
+    async def _off_loop(self, fn, *args):
+        """:return: fn(*args), run in the ingress thread pool"""
+        return await self._loop.run_in_executor(self._ingress_executor, fn, *args)
+
+    async def _write_response(self, writer, status, body, keep_alive, content_type="application/json"):
+        payload = body.encode()
+        reason = {200: "OK", 400: "Bad Request", 404: "Not Found", 405: "Method Not Allowed",
+                  411: "Length Required", 413: "Payload Too Large", 414: "URI Too Long",
+                  431: "Request Header Fields Too Large", 500: "Internal Server Error",
+                  503: "Service Unavailable"}.get(status, "")
+        head = (f"HTTP/1.1 {status} {reason}\r\n"
+                f"Content-Type: {content_type}\r\n"
+                f"Content-Length: {len(payload)}\r\n"
+                f"Connection: {'keep-alive' if keep_alive else 'close'}\r\n"
+                "\r\n")
+        writer.write(head.encode("latin-1") + payload)
+        await writer.drain()
@@ -0,0 +1,128 @@
+"""
+Helpers for running the benchmarks offline.
+
+The bot modules read their configuration from the environment and build a
+Dialogflow client at import time, so the benchmarks set dummy credentials
+and anonymous Google auth before importing them.
+"""
+
+import importlib
+import os
+import socket
+import threading
+import time
+
+VERIFICATION_TOKEN = "bench-token"
+
+
+def import_bot(name="bot_v2"):
+    """
+    Import bot_v1/bot_v2 without a .env file or Google ADC.
+
+    :param name: Module name of the bot
+    :return: The imported module
+    """
+    offline_env()
+    import_google_auth_offline()
+    return importlib.import_module(name)
+
+
+def offline_env(env=os.environ):
+    """
+    Set the bot configuration needed offline (dummy credentials, no Redis)
+    where `env` doesn't set it already.
+
+    :return: env
+    """
+    env.setdefault("APP_ID", "cli_bench")
+    env.setdefault("APP_SECRET", "bench-secret")
+    env.setdefault("APP_VERIFICATION_TOKEN", VERIFICATION_TOKEN)
+    env.setdefault("DIALOGFLOW_PROJECT_ID", "bench-project")
+    env.setdefault("DIALOGFLOW_SESSION_ID", "bench-session")
+    # No Redis server is needed offline
+    env.setdefault("DEDUP_BACKEND", "memory")
+    env.setdefault("EVENT_QUEUE", "off")
+    # Per-message logs would dominate the measurements
+    env.setdefault("LOG_LEVEL", "WARNING")
+    return env
+
+
+def import_google_auth_offline():
+    """
+    Make Google credential discovery return anonymous credentials, so
+    clients can be built without ADC (they are then pointed at fakes).
+    """
+    import google.auth
+    from google.auth.credentials import AnonymousCredentials
+    google.auth.default = lambda *args, **kwargs: (AnonymousCredentials(), None)
+
+
+def message_event(message_id, chat_id="oc_bench", text="hi", token=VERIFICATION_TOKEN):
+    """
+    Build a synthetic im.message.receive_v1 callback body.
+
+    :return: dict
+    """
+    return {
+        "schema": "2.0",
+        "header": {
+            "event_id": "ev_" + message_id,
+            "event_type": "im.message.receive_v1",
+            "create_time": str(int(time.time() * 1000)),
+            "token": token,
+            "app_id": "cli_bench",
+            "tenant_key": "bench",
+        },
+        "event": {
+            "sender": {
+                "sender_id": {"open_id": "ou_" + chat_id},
+                "sender_type": "user",
+            },
+            "message": {
+                "message_id": message_id,
+                "chat_id": chat_id,
+                "chat_type": "p2p",
+                "message_type": "text",
+                "content": '{"text":"%s"}' % text,
+            },
+        },
+    }
+
+
+def percentile(samples, pct):
+    """
+    Nearest-rank percentile of a list of numbers.
+    """
+    if not samples:
+        return 0.0
+    ordered = sorted(samples)
+    index = min(len(ordered) - 1, max(0, int(round(pct / 100.0 * len(ordered))) - 1))
+    return ordered[index]
+
+
+def start_thread(target, *args):
+    t = threading.Thread(target=target, args=args, daemon=True)
+    t.start()
+    return t
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def wait_ready(port, timeout=30.0):
+    """
+    Wait until something accepts connections on 127.0.0.1:port.
+
+    :return: True if it did within `timeout` seconds
+    """
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection(("127.0.0.1", port), timeout=1).close()
+            return True
+        except OSError:
+            time.sleep(0.05)
+    return False
@@ -0,0 +1,218 @@
+"""
+Sync vs asyncio DialogflowHelper under concurrent load, against a local fake Sessions service.
+
+Sends the same queries through DialogflowHelper from a thread pool (one
+thread per concurrent call, like the executor of the asyncio pipeline) and
+through AsyncDialogflowHelper from asyncio tasks, at several concurrency
+levels, and reports throughput and the peak number of threads of the
+process (the fake runs in-process, so its server threads are counted
+too, on both sides). Then checks the deadline (a slow call raises
+DeadlineExceeded on time), the retry policy (UNAVAILABLE calls end up
+answered), cancellation (close() cancels the calls in flight) and the
+shutdown of the asyncio server (calls still in flight at its drain
+timeout are cancelled); exits non-zero if one of them fails.
+
+Usage: python -m benchmarks.bench_async_dialogflow [--queries 512] [--concurrency 8,64,256] [--latency-ms 50]
+"""
+
+import argparse
+import asyncio
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from google.api_core import exceptions
+
+from async_dialogflow_helper import AsyncDialogflowHelper
+from async_server import AsyncWebhookServer
+from benchmarks.fake_dialogflow import FakeSessions
+from dialogflow_helper import DialogflowHelper
+
+
+def thread_count():
+    with open("/proc/self/status") as f:
+        for line in f:
+            if line.startswith("Threads:"):
+                return int(line.split()[1])
+    return threading.active_count()
+
+
+class PeakThreads:
+    """Samples the thread count of the process every 5ms while in the with block."""
+
+    def __enter__(self):
+        self.peak = thread_count()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._sample, daemon=True)
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        self._thread.join()
+        return False
+
+    def _sample(self):
+        while not self._stop.wait(0.005):
+            self.peak = max(self.peak, thread_count())
+
+
+def run_sync(helper, texts, concurrency):
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        futures = [executor.submit(helper._detect_intent_text, text, f"chat-{i}")
+                   for i, text in enumerate(texts)]
+        return [f.result() for f in futures]
+
+
+async def run_async(helper, texts, concurrency):
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def one(i, text):
+        async with semaphore:
+            return await helper.detect_intent(text, f"chat-{i}")
+
+    try:
+        return await asyncio.gather(*(one(i, text) for i, text in enumerate(texts)))
+    finally:
+        await helper.close()
+
+
+def report(name, concurrency, count, elapsed, peak, idle):
+    print(f"{name:<6} concurrency={concurrency:<4} queries={count:<5} time={elapsed:6.2f}s "
+          f"throughput={count / elapsed:7.1f} q/s peak_threads={peak} (+{peak - idle})")
+
+
+def compare(args):
+    fake = FakeSessions(latency=args.latency_ms / 1000.0, max_workers=max(args.concurrency)).start()
+    texts = [f"utterance {i}" for i in range(args.queries)]
+    try:
+        for concurrency in args.concurrency:
+            sync_helper = DialogflowHelper("bench-project", "bench-session",
+                                           sessions_client=fake.sessions_client())
+            idle = thread_count()
+            with PeakThreads() as peak:
+                start = time.perf_counter()
+                responses = run_sync(sync_helper, texts, concurrency)
+                elapsed = time.perf_counter() - start
+            assert len(responses) == len(texts)
+            report("sync", concurrency, len(texts), elapsed, peak.peak, idle)
+
+            async_helper = AsyncDialogflowHelper("bench-project", "bench-session",
+                                                 client_factory=fake.async_sessions_client)
+            idle = thread_count()
+            with PeakThreads() as peak:
+                start = time.perf_counter()
+                responses = asyncio.run(run_async(async_helper, texts, concurrency))
+                elapsed = time.perf_counter() - start
+            assert [r.query_result.query_text for r in responses] == texts, "async responses out of order"
+            report("async", concurrency, len(texts), elapsed, peak.peak, idle)
+    finally:
+        fake.stop()
+
+
+async def check_deadline():
+    fake = FakeSessions(latency=0.5).start()
+    helper = AsyncDialogflowHelper("bench-project", "bench-session",
+                                   client_factory=fake.async_sessions_client, timeout=0.1)
+    start = time.perf_counter()
+    try:
+        await helper.detect_intent("slow")
+        outcome = "answered"
+    except exceptions.DeadlineExceeded:
+        outcome = "DeadlineExceeded"
+    finally:
+        await helper.close()
+        fake.stop()
+    elapsed = time.perf_counter() - start
+    ok = outcome == "DeadlineExceeded" and elapsed < 0.3
+    print(f"deadline      timeout=0.1s latency=0.5s -> {outcome} after {elapsed:.3f}s {'OK' if ok else 'FAILED'}")
+    return ok
+
+
+async def check_retry():
+    # Half of the calls fail with UNAVAILABLE, retried by DEFAULT_RETRY
+    fake = FakeSessions(latency=0.005, error_rate=0.5).start()
+    helper = AsyncDialogflowHelper("bench-project", "bench-session",
+                                   client_factory=fake.async_sessions_client, timeout=10.0)
+    texts = [f"retry {i}" for i in range(20)]
+    try:
+        results = await helper.detect_intent_batch(texts, max_concurrency=20)
+    finally:
+        await helper.close()
+        fake.stop()
+    answered = sum(1 for r in results if r.error is None)
+    ok = answered == len(texts) and fake.calls > len(texts)
+    print(f"retry         error_rate=0.5 UNAVAILABLE -> answered={answered}/{len(texts)} "
+          f"calls={fake.calls} {'OK' if ok else 'FAILED'}")
+    return ok
+
+
+async def check_cancel():
+    fake = FakeSessions(latency=5.0).start()
+    helper = AsyncDialogflowHelper("bench-project", "bench-session",
+                                   client_factory=fake.async_sessions_client, timeout=30.0)
+    tasks = [asyncio.ensure_future(helper.detect_intent(f"pending {i}", f"chat-{i}")) for i in range(10)]
+    await asyncio.sleep(0.2)
+    start = time.perf_counter()
+    await helper.close()
+    results = await asyncio.gather(*tasks, return_exceptions=True)
+    elapsed = time.perf_counter() - start
+    fake.stop()
+    cancelled = sum(1 for r in results if isinstance(r, exceptions.Cancelled))
+    try:
+        await helper.detect_intent("after close")
+        refused = False
+    except exceptions.Cancelled:
+        refused = True
+    ok = cancelled == len(tasks) and refused and elapsed < 0.5
+    print(f"cancellation  close() with {len(tasks)} calls in flight -> cancelled={cancelled}/{len(tasks)} "
+          f"after {elapsed:.3f}s, later calls refused={refused} {'OK' if ok else 'FAILED'}")
+    return ok
+
+
+async def check_shutdown():
+    fake = FakeSessions(latency=5.0).start()
+    helper = AsyncDialogflowHelper("bench-project", "bench-session",
+                                   client_factory=fake.async_sessions_client, timeout=30.0)
+    cancelled = []
+
+    async def handle(message):
+        try:
+            await helper.detect_intent(message["text"], message["chat_id"])
+        except asyncio.CancelledError:
+            cancelled.append(message)
+            raise
+
+    server = AsyncWebhookServer("bench-token", handle, host="127.0.0.1", port=0, workers=4,
+                                key=lambda m: m["chat_id"], drain_timeout=0.3)
+    await server.start()
+    for i in range(8):
+        server._enqueue({"text": f"pending {i}", "chat_id": f"chat-{i % 4}"})
+    await asyncio.sleep(0.2)
+    start = time.perf_counter()
+    await server.stop()
+    await helper.close()
+    elapsed = time.perf_counter() - start
+    fake.stop()
+    ok = len(cancelled) == server.workers and elapsed < 1.0
+    print(f"shutdown      drain_timeout=0.3s with {server.workers} calls in flight -> "
+          f"cancelled={len(cancelled)} stopped after {elapsed:.3f}s {'OK' if ok else 'FAILED'}")
+    return ok
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--queries", type=int, default=512)
+    parser.add_argument("--concurrency", type=lambda s: [int(c) for c in s.split(",")], default=[8, 64, 256])
+    parser.add_argument("--latency-ms", type=float, default=50.0)
+    args = parser.parse_args()
+
+    compare(args)
+    checks = [asyncio.run(check()) for check in (check_deadline, check_retry, check_cancel,
+                                                        check_shutdown)]
+    if not all(checks):
+        raise SystemExit("FAILED: see the checks above")
+
+
+if __name__ == "__main__":
+    main()
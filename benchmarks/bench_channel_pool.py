@@ -0,0 +1,164 @@
+"""
+Concurrent Dialogflow throughput as the channel pool grows, against a fake Sessions service with a per-connection stream limit.
+
+Google's front ends cap the concurrent calls (HTTP/2 streams) of one
+connection; calls past the cap wait in the client for a free stream. The
+fake does the same with --max-streams, so a single channel tops out at
+max_streams / latency calls per second however many calls are in flight.
+Sends --queries queries at --concurrency through AsyncDialogflowHelper
+(and DialogflowHelper from a thread pool) with pools of 1, 2, 4, ...
+channels and both selection policies, and reports throughput, latency
+and the connections the fake saw. Then checks the location-aware session
+and context paths and the regional endpoints.
+
+Exits non-zero if a channel doesn't get its own connection, if the
+largest pool isn't at least --min-speedup times as fast as a single
+channel, or if a path or endpoint is wrong.
+
+Usage: python -m benchmarks.bench_channel_pool [--pools 1,2,4,8] [--queries 800] [--concurrency 64] [--max-streams 4]
+"""
+
+import argparse
+import asyncio
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from async_dialogflow_helper import AsyncDialogflowHelper
+from benchmarks._offline import percentile
+from benchmarks.fake_dialogflow import FakeSessions
+from channel_pool import LEAST_LOADED, POLICIES, ROUND_ROBIN, ClientPool, channel_options, regional_endpoint
+from dialogflow_helper import DialogflowHelper
+
+
+async def run_async(fake, texts, size, policy, concurrency):
+    options = channel_options(keepalive_ms=60000, separate=True)
+    helper = AsyncDialogflowHelper("bench-project", "bench-session", timeout=30.0,
+                                   client_factory=lambda: fake.async_sessions_client(options),
+                                   pool_size=size, pool_policy=policy)
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def one(i):
+        async with semaphore:
+            start = time.perf_counter()
+            response = await helper.detect_intent(texts[i], f"chat-{i}")
+            assert response.query_result.query_text == texts[i]
+            return time.perf_counter() - start
+
+    try:
+        # Connect every channel first, like the bot's warm-up
+        await asyncio.gather(*(one(i) for i in range(size)))
+        start = time.perf_counter()
+        samples = await asyncio.gather(*(one(i) for i in range(len(texts))))
+        return time.perf_counter() - start, samples, helper.clients.stats()
+    finally:
+        await helper.close()
+
+
+def run_sync(fake, texts, size, policy, concurrency):
+    options = channel_options(keepalive_ms=60000, separate=True)
+    pool = ClientPool([fake.sessions_client(options) for _ in range(size)], policy)
+    helper = DialogflowHelper("bench-project", "bench-session", timeout=30.0, client_pool=pool)
+
+    def one(i):
+        start = time.perf_counter()
+        response = helper._detect_intent_text(texts[i], f"chat-{i}")
+        assert response.query_result.query_text == texts[i]
+        return time.perf_counter() - start
+
+    try:
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            list(executor.map(one, range(size)))
+            start = time.perf_counter()
+            samples = list(executor.map(one, range(len(texts))))
+        return time.perf_counter() - start, samples, pool.stats()
+    finally:
+        pool.close()
+
+
+def measure(args):
+    """:return: True if the pool scales and every channel has its own connection"""
+    texts = [f"query {i}" for i in range(args.queries)]
+    ok = True
+    for kind in args.kinds.split(","):
+        throughput = {}
+        for size in args.pools:
+            for policy in POLICIES:
+                fake = FakeSessions(latency=args.latency_ms / 1000.0, jitter=args.latency_ms / 2000.0,
+                                    slow_rate=args.slow_rate, slow_latency=args.slow_ms / 1000.0,
+                                    max_streams=args.max_streams,
+                                    max_workers=args.concurrency * 2).start()
+                try:
+                    if kind == "async":
+                        elapsed, samples, stats = asyncio.run(
+                            run_async(fake, texts, size, policy, args.concurrency))
+                    else:
+                        elapsed, samples, stats = run_sync(fake, texts, size, policy, args.concurrency)
+                    connections = len(fake.peers)
+                finally:
+                    fake.stop()
+                throughput[size, policy] = len(texts) / elapsed
+                ok = ok and connections == size
+                print(f"{kind:<5} channels={size:<2} {policy:<12} throughput={throughput[size, policy]:7.1f}/s "
+                      f"p50={percentile(samples, 50) * 1000:6.1f}ms p99={percentile(samples, 99) * 1000:7.1f}ms "
+                      f"connections={connections} calls/channel={stats['calls']}")
+        largest = max(args.pools)
+        speedup = throughput[largest, ROUND_ROBIN] / throughput[min(args.pools), ROUND_ROBIN]
+        ok = ok and speedup >= args.min_speedup
+        print(f"{kind:<5} {largest} channels vs {min(args.pools)}: {speedup:.1f}x round_robin, "
+              f"{throughput[largest, LEAST_LOADED] / throughput[min(args.pools), LEAST_LOADED]:.1f}x least_loaded")
+    print(f"pool          one connection per channel, at least {args.min_speedup}x {'OK' if ok else 'FAILED'}")
+    return ok
+
+
+def check_paths():
+    """:return: True if session and context paths and endpoints follow the location"""
+    from google.cloud import dialogflow_v2 as dialogflow
+
+    # No client is created before the first call
+    global_helper = AsyncDialogflowHelper("p", "s")
+    regional = AsyncDialogflowHelper("p", "s", location="europe-west1")
+    checks = {
+        "global session": (global_helper.get_session_path("chat"),
+                           dialogflow.SessionsClient.session_path("p", "chat")),
+        "global context": (global_helper.get_context_path("chat", "c"),
+                           dialogflow.ContextsClient.context_path("p", "chat", "c")),
+        "regional session": (regional.get_session_path("chat"),
+                             "projects/p/locations/europe-west1/agent/sessions/chat"),
+        "regional default session": (regional.session_path,
+                                     "projects/p/locations/europe-west1/agent/sessions/s"),
+        "regional context": (regional.get_context_path("chat", "c"),
+                             "projects/p/locations/europe-west1/agent/sessions/chat/contexts/c"),
+        "global endpoint": (regional_endpoint("global"), "dialogflow.googleapis.com:443"),
+        "regional endpoint": (regional_endpoint("europe-west1"), "europe-west1-dialogflow.googleapis.com:443"),
+    }
+    ok = True
+    for name, (got, expected) in checks.items():
+        ok = ok and got == expected
+        if got != expected:
+            print(f"{name}: {got!r}, expected {expected!r}")
+    print(f"paths         sessions, contexts and endpoints per location {'OK' if ok else 'FAILED'}")
+    return ok
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--pools", type=lambda v: [int(n) for n in v.split(",")], default=[1, 2, 4, 8],
+                        help="comma separated pool sizes")
+    parser.add_argument("--kinds", default="async,sync", help="comma separated helpers: async, sync")
+    parser.add_argument("--queries", type=int, default=800)
+    parser.add_argument("--concurrency", type=int, default=64)
+    parser.add_argument("--latency-ms", type=float, default=50.0)
+    parser.add_argument("--max-streams", type=int, default=4, help="concurrent calls per connection")
+    parser.add_argument("--slow-rate", type=float, default=0.0, help="share of calls in the latency tail")
+    parser.add_argument("--slow-ms", type=float, default=1000.0)
+    parser.add_argument("--min-speedup", type=float, default=2.0,
+                        help="throughput of the largest pool over the smallest")
+    args = parser.parse_args()
+
+    checks = [measure(args), check_paths()]
+    if not all(checks):
+        raise SystemExit("FAILED: see the checks above")
+
+
+if __name__ == "__main__":
+    main()
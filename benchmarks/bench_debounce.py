@@ -0,0 +1,198 @@
+"""
+Debounce window: Dialogflow calls and replies saved on bursty chats, and the latency it adds.
+
+Replays the same bursty traffic (every chat sends bursts of 1 to 4 text
+messages a few hundred milliseconds apart, like "hi" / "I need" / "help
+with my order", and one chat keeps typing for longer than the latency
+cap) to bot_v2 twice, in a child process against the local fakes (see
+bench_e2e): once without the debounce window and once with
+DEBOUNCE_WINDOW_MS. Reports the Dialogflow calls and Lark sends of each
+run, the coalescing ratio (messages per Dialogflow call) and the latency
+from every message to the reply that answered it.
+
+Exits non-zero if a message is left unanswered, if the window saves no
+Dialogflow calls, or if a message waited longer than
+DEBOUNCE_MAX_DELAY_MS (plus --slack-ms for Dialogflow and the send).
+
+Usage: python -m benchmarks.bench_debounce [--chats 20] [--bursts 5] [--window-ms 800] [--max-delay-ms 2000]
+"""
+
+import argparse
+import http.client
+import json
+import os
+import random
+import re
+import subprocess
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from benchmarks._offline import free_port, message_event, percentile, wait_ready
+from benchmarks.fake_dialogflow import FakeSessions
+from benchmarks.fake_lark import FakeLark
+
+TAG = re.compile(r"#(\d+)")
+WORDS = ["hi", "hello", "I need", "help with", "my order", "it is late", "thanks", "the invoice", "please"]
+
+
+def bursty_traffic(chats, bursts, rng):
+    """
+    :return: List of (due offset in seconds, callback body), sorted by due time
+    """
+    schedule = []
+    for chat in range(chats):
+        at = rng.uniform(0, 1.0)
+        for _ in range(bursts):
+            for _ in range(rng.choice([1, 1, 2, 3, 4])):
+                schedule.append((at, f"oc_{chat}"))
+                at += rng.uniform(0.05, 0.4)
+            # Then the user reads the reply
+            at += rng.uniform(2.0, 4.0)
+    # Someone who keeps typing: only the latency cap ends their burst
+    at = 0.5
+    while at < 8.5:
+        schedule.append((at, "oc_typing"))
+        at += 0.6
+    schedule.sort()
+    return [(at, json.dumps(message_event(f"om_debounce_{n}", chat_id=chat,
+                                          text=f"{rng.choice(WORDS)} #{n}")).encode())
+            for n, (at, chat) in enumerate(schedule)]
+
+
+def drive(port, traffic, concurrency=32):
+    """:return: Due time of every callback (perf_counter)"""
+    start = time.perf_counter() + 0.1
+    due = [start + at for at, _ in traffic]
+
+    def post(i):
+        delay = due[i] - time.perf_counter()
+        if delay > 0:
+            time.sleep(delay)
+        conn = http.client.HTTPConnection("127.0.0.1", port, timeout=30)
+        try:
+            conn.request("POST", "/", body=traffic[i][1], headers={"Content-Type": "application/json"})
+            conn.getresponse().read()
+        finally:
+            conn.close()
+
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        list(pool.map(post, range(len(traffic))))
+    return due
+
+
+def get_stats(port):
+    conn = http.client.HTTPConnection("127.0.0.1", port, timeout=5)
+    try:
+        conn.request("GET", "/stats")
+        return json.loads(conn.getresponse().read())
+    finally:
+        conn.close()
+
+
+def latencies(lark, due):
+    """
+    :return: Seconds from every message to the first reply naming its #n tag
+             (a merged reply names several)
+    """
+    answered = {}
+    for messages in lark.received.values():
+        for arrived, _, content in messages:
+            for tag in TAG.findall(json.dumps(content)):
+                n = int(tag)
+                if n < len(due) and n not in answered:
+                    answered[n] = arrived - due[n]
+    return answered
+
+
+def run(traffic, env_extra, df_latency):
+    lark = FakeLark().start()
+    dialogflow = FakeSessions(latency=df_latency).start()
+    port = free_port()
+    env = dict(os.environ,
+               BENCH_BOT="bot_v2",
+               BENCH_DIALOGFLOW_ADDRESS=dialogflow.address,
+               SERVER_PORT=str(port),
+               LARK_API_BASE=lark.base_url,
+               LARK_SEND_RATE="1000000",
+               LARK_CHAT_SEND_RATE="1000000",
+               **env_extra)
+    with tempfile.TemporaryFile("w+") as log:
+        proc = subprocess.Popen([sys.executable, "-m", "benchmarks.bench_e2e", "--child"],
+                                env=env, stdout=subprocess.DEVNULL, stderr=log)
+        try:
+            if not wait_ready(port, timeout=60):
+                log.seek(0)
+                sys.stderr.write(log.read()[-4000:])
+                raise SystemExit("FAILED: the bot did not start")
+            due = drive(port, traffic)
+            # The last bursts are still in their window
+            deadline = time.monotonic() + 10
+            while len(latencies(lark, due)) < len(traffic) and time.monotonic() < deadline:
+                time.sleep(0.1)
+            stats = get_stats(port)
+        finally:
+            proc.terminate()
+            proc.wait(30)
+    result = {
+        "answered": latencies(lark, due),
+        "dialogflow_calls": dialogflow.calls,
+        "lark_sends": lark.send_calls,
+        "debounce": stats.get("debounce"),
+    }
+    lark.stop()
+    dialogflow.stop()
+    return result
+
+
+def report(label, result, messages):
+    waits = list(result["answered"].values())
+    calls = result["dialogflow_calls"]
+    print(f"{label:<9} messages={messages} answered={len(waits)} dialogflow_calls={calls} "
+          f"lark_sends={result['lark_sends']} ratio={messages / calls if calls else 0:.2f} "
+          f"latency p50={percentile(waits, 50) * 1000:.0f}ms p99={percentile(waits, 99) * 1000:.0f}ms "
+          f"max={max(waits, default=0) * 1000:.0f}ms")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--chats", type=int, default=20)
+    parser.add_argument("--bursts", type=int, default=5, help="bursts per chat")
+    parser.add_argument("--window-ms", type=int, default=800)
+    parser.add_argument("--max-delay-ms", type=int, default=2000)
+    parser.add_argument("--max-messages", type=int, default=5)
+    parser.add_argument("--df-latency-ms", type=float, default=50.0)
+    parser.add_argument("--slack-ms", type=float, default=500.0,
+                        help="allowed on top of the latency cap for Dialogflow and the send")
+    parser.add_argument("--seed", type=int, default=7)
+    args = parser.parse_args()
+
+    traffic = bursty_traffic(args.chats, args.bursts, random.Random(args.seed))
+    df_latency = args.df_latency_ms / 1000.0
+    off = run(traffic, {"DEBOUNCE_WINDOW_MS": "0"}, df_latency)
+    report("off", off, len(traffic))
+    on = run(traffic, {"DEBOUNCE_WINDOW_MS": str(args.window_ms),
+                       "DEBOUNCE_MAX_DELAY_MS": str(args.max_delay_ms),
+                       "DEBOUNCE_MAX_MESSAGES": str(args.max_messages)}, df_latency)
+    report("debounced", on, len(traffic))
+    stats = on["debounce"] or {}
+    print(f"debounce  ratio={stats.get('coalescing_ratio')} flushed_by={stats.get('flushed_by')} "
+          f"added delay p50={stats.get('delay_p50_ms')}ms p99={stats.get('delay_p99_ms')}ms "
+          f"max={stats.get('delay_max_ms')}ms")
+
+    cap = (args.max_delay_ms + args.slack_ms) / 1000.0
+    worst = max(on["answered"].values(), default=0.0)
+    checks = {
+        "every message answered": len(off["answered"]) == len(on["answered"]) == len(traffic),
+        "fewer Dialogflow calls": on["dialogflow_calls"] < off["dialogflow_calls"],
+        f"latency within the cap ({cap * 1000:.0f}ms)": worst <= cap,
+    }
+    for name, ok in checks.items():
+        print(f"{name:<32} {'OK' if ok else 'FAILED'}")
+    if not all(checks.values()):
+        raise SystemExit("FAILED: see the checks above")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,109 @@
+"""
+Dedup throughput and exactly-once check.
+
+For each available backend (memory, sqlite, and redis if a server answers
+on 127.0.0.1:6379) it measures claims/sec for new keys and for hot retries,
+then has many threads deliver the same keys concurrently and checks that
+every key was claimed exactly once. Exits non-zero if a key is claimed
+twice or never.
+
+Usage: python -m benchmarks.bench_dedup [--ops 20000] [--threads 16] [--keys 2000]
+"""
+
+import argparse
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+import uuid
+from collections import Counter
+
+from dedup import create_deduplicator
+
+
+def ops_per_sec(dedup, keys):
+    start = time.perf_counter()
+    for key in keys:
+        dedup.claim(key)
+    return len(keys) / (time.perf_counter() - start)
+
+
+def exactly_once(factory, keys, threads, shared):
+    """
+    Every thread delivers every key (in its own order); each key must be won once.
+    Unless `shared`, each thread gets its own deduplicator, i.e. its own
+    front cache and store connection, like separate processes would.
+
+    :return: (keys claimed 0 times, keys claimed more than once)
+    """
+    wins = Counter()
+    lock = threading.Lock()
+    barrier = threading.Barrier(threads)
+    shared_dedup = factory() if shared else None
+
+    def deliver():
+        dedup = shared_dedup or factory()
+        order = list(keys)
+        random.shuffle(order)
+        barrier.wait()
+        for key in order:
+            if dedup.claim(key):
+                with lock:
+                    wins[key] += 1
+
+    workers = [threading.Thread(target=deliver) for _ in range(threads)]
+    for t in workers:
+        t.start()
+    for t in workers:
+        t.join()
+    missing = sum(1 for key in keys if wins[key] == 0)
+    doubled = sum(1 for key in keys if wins[key] > 1)
+    return missing, doubled
+
+
+def backends(tmp):
+    yield "memory", lambda: create_deduplicator("memory")
+    path = os.path.join(tmp, "dedup.sqlite3")
+    yield "sqlite", lambda: create_deduplicator("sqlite", sqlite_path=path)
+
+    import redis
+    client = redis.Redis(host="127.0.0.1", port=6379, decode_responses=True)
+    try:
+        client.ping()
+    except redis.exceptions.ConnectionError:
+        print("redis      skipped (no server on 127.0.0.1:6379)")
+        return
+    yield "redis", lambda: create_deduplicator("redis", redis_client=client)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--ops", type=int, default=20000)
+    parser.add_argument("--threads", type=int, default=16)
+    parser.add_argument("--keys", type=int, default=2000)
+    args = parser.parse_args()
+
+    failed = False
+    with tempfile.TemporaryDirectory() as tmp:
+        for name, factory in backends(tmp):
+            run = uuid.uuid4().hex[:8]
+            dedup = factory()
+            keys = [f"bench:{run}:{i}" for i in range(args.ops)]
+            new_rate = ops_per_sec(dedup, keys)
+            retry_rate = ops_per_sec(dedup, keys)
+
+            race_keys = [f"race:{run}:{i}" for i in range(args.keys)]
+            missing, doubled = exactly_once(factory, race_keys, args.threads,
+                                            shared=(name == "memory"))
+            ok = missing == 0 and doubled == 0
+            failed = failed or not ok
+            print(f"{name:<10} new={new_rate:10.0f} ops/s  retry={retry_rate:10.0f} ops/s  "
+                  f"exactly-once={'ok' if ok else f'FAIL (missing={missing}, doubled={doubled})'}")
+
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
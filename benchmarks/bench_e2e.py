@@ -0,0 +1,368 @@
+"""
+End-to-end benchmark: the real bot, offline, against local stand-ins.
+
+Starts bot_v1 or bot_v2 in a child process with the Lark Open API replaced
+by benchmarks/fake_lark.py and Dialogflow by benchmarks/fake_dialogflow.py
+(both with configurable latency and error rates), then replays
+im.message.receive_v1 callbacks at a target rate. The callbacks are
+synthetic, or read from a JSONL file of recorded callback bodies. Every
+text message is tagged "#<n>", so its reply can be matched at the fake Lark.
+
+The driver is open loop: callback n is due at n / rate seconds, and ack and
+end-to-end (callback to reply delivered) latencies are measured from that
+time, so a bot that falls behind shows it in the percentiles. Reports
+throughput, latency percentiles, and the bot's thread count and RSS
+(from /proc). --save writes the results as JSON; --baseline compares with
+saved results and exits non-zero on a regression beyond --tolerance.
+
+Usage: python -m benchmarks.bench_e2e [--bot bot_v2] [--rate 50] [--duration 10]
+                                      [--events recorded.jsonl] [--save out.json] [--baseline out.json]
+"""
+
+import argparse
+import copy
+import http.client
+import json
+import os
+import re
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from benchmarks._offline import VERIFICATION_TOKEN, free_port, message_event, percentile, wait_ready
+from benchmarks.fake_dialogflow import FakeSessions
+from benchmarks.fake_lark import FakeLark
+
+TAG = re.compile(r"#(\d+)")
+
+# Lower is better for these, higher for throughput
+COMPARED = ("throughput", "ack_p99_ms", "e2e_p99_ms", "rss_max_mb", "threads_max")
+
+
+def child():
+    """The bot under test, talking to the fakes given in the environment."""
+    from benchmarks._offline import import_bot
+    from benchmarks.fake_dialogflow import async_sessions_client, sessions_client
+
+    name = os.environ["BENCH_BOT"]
+    bot = import_bot(name)
+    if name == "bot_v1":
+        # bot_v1.run() always binds port 8000
+        from http.server import HTTPServer
+        HTTPServer(("127.0.0.1", int(os.environ["SERVER_PORT"])), bot.RequestHandler).serve_forever()
+        return
+
+    address = os.environ["BENCH_DIALOGFLOW_ADDRESS"]
+    create_dialogflow_helpers = bot.create_dialogflow_helpers
+
+    def create_on_fake():
+        from channel_pool import ClientPool, channel_options
+
+        helper, async_helper = create_dialogflow_helpers()
+        # As many channels as the bot's pool (DIALOGFLOW_CHANNELS)
+        size = len(helper.clients)
+        options = channel_options(bot.DIALOGFLOW_KEEPALIVE_MS, separate=size > 1)
+        helper.set_client_pool(ClientPool([sessions_client(address, options) for _ in range(size)],
+                                          helper.clients.policy))
+        if async_helper is not None:
+            async_helper._client_factory = lambda: async_sessions_client(address, options)
+        return helper, async_helper
+
+    # The helpers are created after bind, by the warm-up
+    bot.create_dialogflow_helpers = create_on_fake
+    bot.run()
+
+
+def load_events(path, count, chats):
+    """
+    :return: Callback bodies (bytes) and the number of text messages among them
+    """
+    if path is None:
+        bodies = [message_event(f"om_e2e_{i}", chat_id=f"oc_{i % chats}", text=f"hello #{i}")
+                  for i in range(count)]
+        return [json.dumps(b).encode() for b in bodies], count
+
+    with open(path, encoding="utf-8") as f:
+        recorded = [json.loads(line) for line in f if line.strip()]
+    if not recorded:
+        raise SystemExit(f"no events in {path}")
+    bodies, texts = [], 0
+    for i in range(count):
+        # Replays of the same recording must not be dropped as duplicates
+        event = copy.deepcopy(recorded[i % len(recorded)])
+        header = event.setdefault("header", {})
+        header["token"] = VERIFICATION_TOKEN
+        if "token" in event:
+            event["token"] = VERIFICATION_TOKEN
+        header["event_id"] = f"{header.get('event_id', 'ev')}-{i}"
+        message = event.get("event", {}).get("message", {})
+        if message:
+            message["message_id"] = f"{message.get('message_id', 'om')}-{i}"
+        if message.get("message_type") == "text":
+            content = json.loads(message.get("content", "{}"))
+            content["text"] = f"{content.get('text', '')} #{i}"
+            message["content"] = json.dumps(content)
+            texts += 1
+        bodies.append(json.dumps(event).encode())
+    return bodies, texts
+
+
+def proc_status(pid):
+    """
+    :return: (threads, RSS in MiB) of a process, or (None, None) without /proc
+    """
+    threads = rss = None
+    try:
+        with open(f"/proc/{pid}/status") as f:
+            for line in f:
+                if line.startswith("Threads:"):
+                    threads = int(line.split()[1])
+                elif line.startswith("VmRSS:"):
+                    rss = int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return threads, rss
+
+
+class ProcSampler:
+    """Samples a process' thread count and RSS in the background."""
+
+    def __init__(self, pid, interval=0.25):
+        self.pid = pid
+        self.interval = interval
+        self.samples = []
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+
+    def _run(self):
+        while not self._stop.is_set():
+            threads, rss = proc_status(self.pid)
+            if threads is not None:
+                self.samples.append((threads, rss))
+            self._stop.wait(self.interval)
+
+
+def drive(port, bodies, rate, concurrency):
+    """
+    Post every body at its due time (start + n / rate), one connection per callback.
+
+    :return: (due times, ack latencies from the due time or None on error, wall time)
+    """
+    start = time.perf_counter() + 0.1
+    due = [start + i / rate for i in range(len(bodies))]
+
+    def post(i):
+        delay = due[i] - time.perf_counter()
+        if delay > 0:
+            time.sleep(delay)
+        conn = http.client.HTTPConnection("127.0.0.1", port, timeout=30)
+        try:
+            conn.request("POST", "/", body=bodies[i], headers={"Content-Type": "application/json"})
+            rsp = conn.getresponse()
+            rsp.read()
+            if rsp.status != 200:
+                return None
+        except OSError:
+            return None
+        finally:
+            conn.close()
+        return time.perf_counter() - due[i]
+
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        acks = list(pool.map(post, range(len(bodies))))
+    return due, acks, time.perf_counter() - start
+
+
+def wait_replies(lark, expected, timeout, idle=2.0):
+    """Wait for `expected` replies, or until none arrived for `idle` seconds."""
+    deadline = time.monotonic() + timeout
+    last, last_change = -1, time.monotonic()
+    while time.monotonic() < deadline:
+        if lark.wait_for(expected, 0.2):
+            return
+        delivered = lark.delivered()
+        if delivered != last:
+            last, last_change = delivered, time.monotonic()
+        elif time.monotonic() - last_change > idle:
+            return
+
+
+def e2e_latencies(lark, due):
+    """Callback due time to arrival of its first reply, matched on the #n tag."""
+    first = {}
+    for messages in lark.received.values():
+        for arrived, _, content in messages:
+            match = TAG.search(json.dumps(content))
+            if match:
+                n = int(match.group(1))
+                if n < len(due) and n not in first:
+                    first[n] = arrived - due[n]
+    return list(first.values())
+
+
+def run(args):
+    lark = FakeLark(latency=args.lark_latency_ms / 1000.0, error_rate=args.lark_error_rate).start()
+    dialogflow = FakeSessions(latency=args.df_latency_ms / 1000.0, jitter=args.df_jitter_ms / 1000.0,
+                              error_rate=args.df_error_rate).start()
+    count = int(args.rate * args.duration)
+    bodies, expected = load_events(args.events, count, args.chats)
+
+    port = free_port()
+    env = dict(os.environ,
+               BENCH_BOT=args.bot,
+               BENCH_DIALOGFLOW_ADDRESS=dialogflow.address,
+               SERVER_PORT=str(port),
+               SERVER_MODE=args.mode,
+               LARK_API_BASE=lark.base_url,
+               PYTHONUNBUFFERED="1")
+    # The fake doesn't enforce Lark's send limits, so neither does the bot by default
+    env.setdefault("LARK_SEND_RATE", "1000000")
+    env.setdefault("LARK_CHAT_SEND_RATE", "1000000")
+
+    with tempfile.TemporaryFile("w+") as log:
+        spawned = time.perf_counter()
+        proc = subprocess.Popen([sys.executable, "-m", "benchmarks.bench_e2e", "--child"],
+                                env=env, stdout=subprocess.DEVNULL, stderr=log)
+        try:
+            if not wait_ready(port, timeout=60):
+                log.seek(0)
+                sys.stderr.write(log.read()[-4000:])
+                raise SystemExit("FAILED: the bot did not start")
+            startup = time.perf_counter() - spawned
+            idle_threads, idle_rss = proc_status(proc.pid)
+
+            sampler = ProcSampler(proc.pid).start()
+            due, acks, elapsed = drive(port, bodies, args.rate, args.concurrency)
+            wait_replies(lark, expected, timeout=args.drain_timeout)
+            finished = time.perf_counter()
+            sampler.stop()
+        finally:
+            proc.terminate()
+            try:
+                proc.wait(30)
+            except subprocess.TimeoutExpired:
+                proc.kill()
+
+    acked = [a for a in acks if a is not None]
+    e2e = e2e_latencies(lark, due)
+    threads = [t for t, _ in sampler.samples]
+    rss = [r for _, r in sampler.samples]
+    result = {
+        "bot": args.bot,
+        "mode": args.mode,
+        "events": count,
+        "rate_target": args.rate,
+        "startup_s": round(startup, 3),
+        "acked": len(acked),
+        "ack_errors": count - len(acked),
+        "ack_rate": round(len(acked) / elapsed, 1),
+        "ack_p50_ms": round(percentile(acked, 50) * 1000, 2),
+        "ack_p90_ms": round(percentile(acked, 90) * 1000, 2),
+        "ack_p99_ms": round(percentile(acked, 99) * 1000, 2),
+        "replies": len(e2e),
+        "replies_missing": expected - len(e2e),
+        "throughput": round(len(e2e) / (finished - due[0]), 1) if due else 0.0,
+        "e2e_p50_ms": round(percentile(e2e, 50) * 1000, 2),
+        "e2e_p90_ms": round(percentile(e2e, 90) * 1000, 2),
+        "e2e_p99_ms": round(percentile(e2e, 99) * 1000, 2),
+        "threads_idle": idle_threads,
+        "threads_max": max(threads) if threads else None,
+        "rss_idle_mb": round(idle_rss, 1) if idle_rss is not None else None,
+        "rss_max_mb": round(max(rss), 1) if rss else None,
+        "dialogflow_calls": dialogflow.calls,
+        "lark_sends": lark.send_calls,
+        "lark_failures": lark.failures,
+    }
+    dialogflow.stop()
+    lark.stop()
+    return result
+
+
+def report(result):
+    print(f"{result['bot']} ({result['mode']}) {result['events']} events at {result['rate_target']}/s, "
+          f"started in {result['startup_s']}s")
+    print(f"  ack      acked={result['acked']} errors={result['ack_errors']} rate={result['ack_rate']}/s "
+          f"p50={result['ack_p50_ms']}ms p90={result['ack_p90_ms']}ms p99={result['ack_p99_ms']}ms")
+    print(f"  replies  delivered={result['replies']} missing={result['replies_missing']} "
+          f"throughput={result['throughput']}/s "
+          f"p50={result['e2e_p50_ms']}ms p90={result['e2e_p90_ms']}ms p99={result['e2e_p99_ms']}ms")
+    print(f"  process  threads idle={result['threads_idle']} max={result['threads_max']} "
+          f"rss idle={result['rss_idle_mb']}MiB max={result['rss_max_mb']}MiB")
+    print(f"  fakes    dialogflow_calls={result['dialogflow_calls']} lark_sends={result['lark_sends']} "
+          f"lark_failures={result['lark_failures']}")
+
+
+def regressions(result, baseline, tolerance):
+    """
+    :return: List of "metric: baseline -> result" for the metrics that got worse
+    """
+    found = []
+    for key in COMPARED:
+        old, new = baseline.get(key), result.get(key)
+        if old is None or new is None:
+            continue
+        if key == "throughput":
+            worse = new < old * (1 - tolerance)
+        else:
+            # A little absolute slack, so noise on tiny values isn't a regression
+            worse = new > old * (1 + tolerance) + (1 if key == "threads_max" else 2.0)
+        if worse:
+            found.append(f"{key}: {old} -> {new}")
+    return found
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--bot", default="bot_v2", choices=["bot_v1", "bot_v2"])
+    parser.add_argument("--mode", default="threaded", choices=["threaded", "asyncio"],
+                        help="SERVER_MODE of bot_v2")
+    parser.add_argument("--rate", type=float, default=50.0, help="callbacks per second")
+    parser.add_argument("--duration", type=float, default=10.0, help="seconds of traffic")
+    parser.add_argument("--chats", type=int, default=50, help="distinct chats of synthetic events")
+    parser.add_argument("--events", help="JSONL file of recorded callback bodies to replay")
+    parser.add_argument("--concurrency", type=int, default=64, help="callbacks in flight at most")
+    parser.add_argument("--df-latency-ms", type=float, default=50.0)
+    parser.add_argument("--df-jitter-ms", type=float, default=20.0)
+    parser.add_argument("--df-error-rate", type=float, default=0.0)
+    parser.add_argument("--lark-latency-ms", type=float, default=10.0)
+    parser.add_argument("--lark-error-rate", type=float, default=0.0)
+    parser.add_argument("--drain-timeout", type=float, default=30.0,
+                        help="seconds to wait for the replies after the last callback")
+    parser.add_argument("--save", help="write the results as JSON")
+    parser.add_argument("--baseline", help="JSON results to compare with")
+    parser.add_argument("--tolerance", type=float, default=0.2,
+                        help="relative change accepted before it counts as a regression")
+    parser.add_argument("--child", action="store_true", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        child()
+        return
+
+    result = run(args)
+    report(result)
+    if args.save:
+        with open(args.save, "w") as f:
+            json.dump(result, f, indent=2)
+    if args.baseline:
+        with open(args.baseline) as f:
+            found = regressions(result, json.load(f), args.tolerance)
+        for line in found:
+            print("  REGRESSION", line)
+        if found:
+            raise SystemExit("FAILED: regressions against the baseline")
+
+
+if __name__ == "__main__":
+    main()
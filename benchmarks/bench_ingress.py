@@ -0,0 +1,116 @@
+"""
+Ack latency / throughput benchmark for the webhook ingress.
+
+Fires synthetic im.message.receive_v1 callbacks at the threaded
+RequestHandler (http.server) and at the asyncio server, and reports the
+p50/p99 ack latency and events/sec. The Dialogflow + send path is replaced
+by a sleep so only the ingress is measured.
+
+Usage: python -m benchmarks.bench_ingress [--events 2000] [--concurrency 32] [--work-ms 50]
+"""
+
+import argparse
+import asyncio
+import http.client
+import json
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from http.server import HTTPServer
+
+from benchmarks._offline import import_bot, message_event, percentile, start_thread
+
+
+def fire(port, bodies, concurrency):
+    """
+    Send every body with `concurrency` parallel clients, one connection per request.
+
+    :return: (list of ack latencies in seconds, error count, wall time in seconds)
+    """
+    def post(body):
+        start = time.perf_counter()
+        conn = http.client.HTTPConnection("127.0.0.1", port, timeout=30)
+        try:
+            conn.request("POST", "/", body=body, headers={"Content-Type": "application/json"})
+            rsp = conn.getresponse()
+            rsp.read()
+        except OSError:
+            # http.server's listen backlog is small; bursts get reset
+            return None
+        finally:
+            conn.close()
+        return time.perf_counter() - start
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        results = list(pool.map(post, bodies))
+    elapsed = time.perf_counter() - start
+    latencies = [r for r in results if r is not None]
+    return latencies, len(results) - len(latencies), elapsed
+
+
+def report(name, latencies, errors, elapsed):
+    print(f"{name:<10} acked={len(latencies):<6} errors={errors:<5} "
+          f"p50={percentile(latencies, 50) * 1000:7.2f}ms "
+          f"p99={percentile(latencies, 99) * 1000:7.2f}ms "
+          f"throughput={len(latencies) / elapsed:8.1f} ev/s")
+
+
+def bench_threaded(bot, bodies, concurrency):
+    class QuietHandler(bot.RequestHandler):
+        def log_message(self, *args):
+            pass
+
+    httpd = HTTPServer(("127.0.0.1", 0), QuietHandler)
+    start_thread(httpd.serve_forever)
+    try:
+        return fire(httpd.server_address[1], bodies, concurrency)
+    finally:
+        httpd.shutdown()
+        httpd.server_close()
+
+
+def bench_asyncio(bot, bodies, concurrency):
+    from async_server import AsyncWebhookServer
+
+    loop = asyncio.new_event_loop()
+    server = AsyncWebhookServer(bot.APP_VERIFICATION_TOKEN, bot.handle_message,
+                                host="127.0.0.1", port=0)
+    ready = threading.Event()
+
+    def serve():
+        asyncio.set_event_loop(loop)
+        loop.run_until_complete(server.start())
+        ready.set()
+        loop.run_forever()
+
+    start_thread(serve)
+    ready.wait()
+    try:
+        return fire(server.port, bodies, concurrency)
+    finally:
+        asyncio.run_coroutine_threadsafe(server.stop(), loop).result()
+        loop.call_soon_threadsafe(loop.stop)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--events", type=int, default=2000)
+    parser.add_argument("--concurrency", type=int, default=32)
+    parser.add_argument("--work-ms", type=float, default=50.0,
+                        help="simulated Dialogflow + send time per message")
+    args = parser.parse_args()
+
+    bot = import_bot("bot_v2")
+    work = args.work_ms / 1000.0
+    bot.handle_message = lambda message: time.sleep(work)
+    bot.worker_pool.handler = bot.handle_message
+
+    for name, bench in (("threaded", bench_threaded), ("asyncio", bench_asyncio)):
+        bodies = [json.dumps(message_event(f"{name}_{i}")).encode()
+                  for i in range(args.events)]
+        report(name, *bench(bot, bodies, args.concurrency))
+
+
+if __name__ == "__main__":
+    main()
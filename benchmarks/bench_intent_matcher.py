@@ -0,0 +1,267 @@
+"""
+Local intent matcher: match latency, hit rate and wrong answers by threshold.
+
+Builds an IntentMatcher from a Dialogflow ES agent export and replays
+queries through it. Reports the time to load the export, the latency of
+match() (p50/p99, exact and fuzzy), and for a range of thresholds the
+share of queries answered locally and, for labelled queries, how many of
+those answers named the wrong intent (or answered a query Dialogflow
+should have handled). Then checks hot reload: an intent added to the
+export is picked up, and a broken export keeps the previous index.
+
+Without --agent, a synthetic agent (static FAQ intents sharing verbs and
+nouns, a few with parameters, a fallback with negative examples, a
+follow-up needing a context) and labelled traffic (exact phrases, noisy
+variants, and queries no static intent covers) are generated.
+
+--traffic is a JSONL file of recorded callback bodies (as for bench_e2e)
+or of {"text": ..., "intent": ...} lines, "intent" being the expected
+static intent or null for Dialogflow; unlabelled queries only count
+towards the hit rate.
+
+Exits non-zero if the wrong answers at --threshold exceed --max-wrong, or
+if the reload check fails.
+
+Usage: python -m benchmarks.bench_intent_matcher [--agent export.zip --traffic recorded.jsonl]
+                                                 [--threshold 0.85] [--max-wrong 0.01]
+"""
+
+import argparse
+import json
+import os
+import random
+import tempfile
+import time
+
+from benchmarks._offline import percentile
+from intent_matcher import IntentMatcher
+
+VERBS = ["reset", "change", "cancel", "track", "update", "return", "renew", "check", "upgrade", "pause"]
+NOUNS = ["password", "order", "subscription", "address", "invoice", "plan", "device", "account",
+         "delivery", "payment method"]
+TEMPLATES = ["how do i {verb} my {noun}", "i want to {verb} my {noun}", "can you help me {verb} my {noun}",
+             "{verb} {noun}", "how can i {verb} the {noun}", "i need to {verb} my {noun}",
+             "help me {verb} {noun}", "is it possible to {verb} my {noun}"]
+FILLERS = ["please", "hi", "hey", "thanks", "quickly", "now", "today"]
+THRESHOLDS = (0.6, 0.7, 0.8, 0.85, 0.9, 0.95, 1.0)
+
+
+def intent_file(name, phrases, speech=None, parameters=False, contexts=(), fallback=False):
+    """:return: (intent JSON, usersays JSON) of an exported intent"""
+    intent = {
+        "name": name,
+        "auto": True,
+        "contexts": list(contexts),
+        "responses": [{
+            "resetContexts": False,
+            "affectedContexts": [],
+            "parameters": [{"name": "date", "dataType": "@sys.date"}] if parameters else [],
+            "messages": [{"type": "0", "lang": "en", "condition": "", "speech": speech or [f"About {name}."]}],
+        }],
+        "priority": 500000,
+        "webhookUsed": False,
+        "fallbackIntent": fallback,
+    }
+    usersays = [{"data": [{"text": p, "userDefined": False}], "isTemplate": False, "lang": "en"}
+                for p in phrases]
+    return intent, usersays
+
+
+def write_intent(directory, name, intent, usersays):
+    with open(os.path.join(directory, "intents", f"{name}.json"), "w", encoding="utf-8") as f:
+        json.dump(intent, f, ensure_ascii=False)
+    with open(os.path.join(directory, "intents", f"{name}_usersays_en.json"), "w", encoding="utf-8") as f:
+        json.dump(usersays, f, ensure_ascii=False)
+
+
+def synthetic_agent(directory, rng):
+    """
+    Write a synthetic export and return its labelled traffic.
+
+    :return: List of (text, expected intent or None)
+    """
+    os.makedirs(os.path.join(directory, "intents"))
+    with open(os.path.join(directory, "agent.json"), "w") as f:
+        json.dump({"language": "en"}, f)
+
+    pairs = [(v, n) for v in VERBS for n in NOUNS]
+    rng.shuffle(pairs)
+    # Half of the verb/noun pairs are FAQ intents, the rest are left to Dialogflow
+    trained, untrained = pairs[:len(pairs) // 2], pairs[len(pairs) // 2:]
+    phrases_of = {}
+    for verb, noun in trained:
+        name = f"{verb}_{noun.replace(' ', '_')}"
+        phrases = [t.format(verb=verb, noun=noun) for t in rng.sample(TEMPLATES, 6)]
+        phrases_of[name] = phrases
+        write_intent(directory, name, *intent_file(name, phrases))
+
+    write_intent(directory, "greeting", *intent_file("greeting", ["hi", "hello", "good morning", "你好"],
+                                                      speech=["Hi!", "Hello!"]))
+    phrases_of["greeting"] = ["hi", "hello", "good morning", "你好"]
+    write_intent(directory, "order_status_zh", *intent_file("order_status_zh", ["查询订单", "我的订单在哪里"]))
+    phrases_of["order_status_zh"] = ["查询订单", "我的订单在哪里"]
+    # Not static: parameters, a fallback, a follow-up
+    write_intent(directory, "book_call", *intent_file("book_call", ["book a call tomorrow", "schedule a call"],
+                                                      parameters=True))
+    write_intent(directory, "Default Fallback Intent",
+                 *intent_file("Default Fallback Intent", ["asdf", "what is the meaning of life"], fallback=True))
+    write_intent(directory, "confirm_yes", *intent_file("confirm_yes", ["yes", "sure"], contexts=["confirm"]))
+
+    traffic = []
+    for _ in range(2000):
+        kind = rng.random()
+        if kind < 0.4:
+            name = rng.choice(list(phrases_of))
+            traffic.append((rng.choice(phrases_of[name]), name))
+        elif kind < 0.7:
+            name = rng.choice(list(phrases_of))
+            traffic.append((noisy(rng.choice(phrases_of[name]), rng), name))
+        else:
+            verb, noun = rng.choice(untrained)
+            text = rng.choice(TEMPLATES).format(verb=verb, noun=noun)
+            traffic.append((rng.choice([text, noisy(text, rng), "book a call next week", "yes", "asdf"]), None))
+    return traffic
+
+
+def noisy(text, rng):
+    """A variant of a phrase: casing, punctuation, a filler word added or a word dropped."""
+    words = text.split()
+    change = rng.random()
+    if change < 0.3:
+        words.insert(rng.randrange(len(words) + 1), rng.choice(FILLERS))
+    elif change < 0.5 and len(words) > 3:
+        words.pop(rng.randrange(1, len(words)))
+    text = " ".join(words)
+    if rng.random() < 0.5:
+        text = text.capitalize()
+    return text + rng.choice(["", "?", "!", "...", " ?"])
+
+
+def load_traffic(path):
+    """:return: List of (text, expected intent, or False when not labelled)"""
+    traffic = []
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            if not line.strip():
+                continue
+            obj = json.loads(line)
+            if "text" in obj:
+                traffic.append((obj["text"], obj.get("intent", False)))
+                continue
+            message = obj.get("event", {}).get("message", {})
+            if message.get("message_type") == "text":
+                traffic.append((json.loads(message.get("content", "{}")).get("text", ""), False))
+    return traffic
+
+
+def replay(matcher, traffic):
+    """:return: (answers: list of intent or None, latencies by method)"""
+    answers = []
+    latencies = {"exact": [], "fuzzy": [], "miss": []}
+    for text, _ in traffic:
+        start = time.perf_counter()
+        match = matcher.match(text)
+        elapsed = time.perf_counter() - start
+        answers.append(match.intent if match is not None else None)
+        latencies[match.method if match is not None else "miss"].append(elapsed)
+    return answers, latencies
+
+
+def score(answers, traffic):
+    """
+    :return: (share answered locally, recall of the covered queries,
+              wrong answers, labelled queries)
+    """
+    answered = sum(1 for a in answers if a is not None)
+    labelled = [(a, expected) for a, (_, expected) in zip(answers, traffic) if expected is not False]
+    wrong = sum(1 for a, expected in labelled if a is not None and a != expected)
+    # Queries a static intent covers, answered locally
+    covered = sum(1 for _, expected in labelled if expected)
+    right = sum(1 for a, expected in labelled if expected and a == expected)
+    return answered / len(traffic), right / covered if covered else 0.0, wrong, len(labelled)
+
+
+def sweep(matcher, traffic, thresholds):
+    for threshold in thresholds:
+        matcher.threshold = threshold
+        answered, recall, wrong, labelled = score(replay(matcher, traffic)[0], traffic)
+        print(f"threshold={threshold:<5} answered={answered:6.1%} recall={recall:6.1%} "
+              f"wrong={wrong:<4} ({wrong / labelled if labelled else 0:5.2%} of {labelled} labelled)")
+
+
+def check_reload(directory):
+    """Hot reload of a directory export: an added intent is picked up, a broken one is not."""
+    matcher = IntentMatcher(directory, reload_interval=0.05)
+    try:
+        before = matcher.match("where is the nearest store") is None
+        intent, usersays = intent_file("store_locator", ["where is the nearest store"])
+        write_intent(directory, "store_locator", intent, usersays)
+        deadline = time.monotonic() + 5
+        while matcher.match("where is the nearest store") is None and time.monotonic() < deadline:
+            time.sleep(0.01)
+        picked_up = matcher.match("where is the nearest store") is not None
+
+        # The intent and its phrases are two files, let both reloads happen
+        time.sleep(0.3)
+        reloads = matcher.stats()["reloads"]
+        with open(os.path.join(directory, "intents", "store_locator.json"), "w") as f:
+            f.write("{broken")
+        time.sleep(0.3)
+        kept = matcher.match("where is the nearest store") is not None and matcher.stats()["reloads"] == reloads
+    finally:
+        matcher.stop()
+    ok = before and picked_up and kept
+    print(f"hot reload    new intent picked up={picked_up} broken export kept previous index={kept} "
+          f"{'OK' if ok else 'FAILED'}")
+    return ok
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--agent", help="agent export (zip or directory)")
+    parser.add_argument("--traffic", help="JSONL of recorded callbacks or labelled queries")
+    parser.add_argument("--threshold", type=float, default=0.85)
+    parser.add_argument("--max-wrong", type=float, default=0.01, help="wrong answers allowed at --threshold")
+    parser.add_argument("--seed", type=int, default=7)
+    args = parser.parse_args()
+    if bool(args.agent) != bool(args.traffic):
+        parser.error("--agent and --traffic go together")
+
+    with tempfile.TemporaryDirectory() as tmp:
+        if args.agent:
+            agent, traffic = args.agent, load_traffic(args.traffic)
+        else:
+            agent = os.path.join(tmp, "agent")
+            traffic = synthetic_agent(agent, random.Random(args.seed))
+
+        start = time.perf_counter()
+        matcher = IntentMatcher(agent, threshold=args.threshold)
+        stats = matcher.stats()
+        print(f"load          intents={stats['intents']} phrases={stats['phrases']} "
+              f"time={(time.perf_counter() - start) * 1000:.1f}ms queries={len(traffic)}")
+
+        answers, latencies = replay(matcher, traffic)
+        for method, samples in latencies.items():
+            if samples:
+                print(f"match {method:<7} calls={len(samples):<5} p50={percentile(samples, 50) * 1e6:6.1f}us "
+                      f"p99={percentile(samples, 99) * 1e6:6.1f}us")
+
+        sweep(matcher, traffic, THRESHOLDS)
+        matcher.threshold = args.threshold
+        _, _, wrong, labelled = score(answers, traffic)
+        wrong_rate = wrong / labelled if labelled else 0.0
+        within = wrong_rate <= args.max_wrong
+        print(f"at threshold {args.threshold}: wrong answers {wrong_rate:.2%} "
+              f"(max {args.max_wrong:.2%}) {'OK' if within else 'FAILED'}")
+
+        reload_ok = True
+        if not args.agent:
+            reload_ok = check_reload(agent)
+
+    if not (within and reload_ok):
+        raise SystemExit("FAILED: see the checks above")
+
+
+
+if __name__ == "__main__":
+    main()
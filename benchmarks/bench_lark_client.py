@@ -0,0 +1,113 @@
+"""
+Outbound latency benchmark: urllib.request.urlopen vs the pooled LarkClient.
+
+Runs a local stub of the Open API send endpoint and times N sequential
+send_message calls through each path. With --tls the stub serves HTTPS with
+a throwaway self-signed certificate, which is what makes a new handshake
+per call expensive in production.
+
+Usage: python -m benchmarks.bench_lark_client [--calls 500] [--threads 1] [--tls]
+"""
+
+import argparse
+import json
+import os
+import ssl
+import subprocess
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib import request
+
+from benchmarks._offline import percentile, start_thread
+from lark_client import LarkClient
+
+
+class StubOpenAPI(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    # Headers and body go out in separate writes; without this, Nagle +
+    # delayed ACK add ~40ms to every keep-alive response
+    disable_nagle_algorithm = True
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get("content-length", 0)))
+        body = json.dumps({"code": 0, "msg": "success", "data": {}}).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+def make_cert(directory):
+    cert = os.path.join(directory, "cert.pem")
+    key = os.path.join(directory, "key.pem")
+    subprocess.run(["openssl", "req", "-x509", "-newkey", "rsa:2048", "-nodes",
+                    "-keyout", key, "-out", cert, "-days", "1", "-subj", "/CN=127.0.0.1"],
+                   check=True, capture_output=True)
+    return cert, key
+
+
+def urlopen_send(base_url, context):
+    req_body = {"chat_id": "oc_bench", "msg_type": "text", "content": {"text": "hi"}}
+    data = bytes(json.dumps(req_body), encoding='utf8')
+    headers = {"Authorization": "Bearer t-bench", "Content-Type": "application/json"}
+    req = request.Request(url=base_url + "/open-apis/message/v4/send/", data=data,
+                          headers=headers, method='POST')
+    response = request.urlopen(req, context=context)
+    json.loads(response.read().decode('utf-8'))
+
+
+def run(name, call, calls, threads):
+    def timed(_):
+        start = time.perf_counter()
+        call()
+        return time.perf_counter() - start
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=threads) as pool:
+        latencies = list(pool.map(timed, range(calls)))
+    elapsed = time.perf_counter() - start
+    print(f"{name:<10} calls={calls:<6} "
+          f"p50={percentile(latencies, 50) * 1000:7.2f}ms "
+          f"p99={percentile(latencies, 99) * 1000:7.2f}ms "
+          f"throughput={calls / elapsed:8.1f} req/s")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--calls", type=int, default=500)
+    parser.add_argument("--threads", type=int, default=1)
+    parser.add_argument("--tls", action="store_true")
+    args = parser.parse_args()
+
+    httpd = ThreadingHTTPServer(("127.0.0.1", 0), StubOpenAPI)
+    context = None
+    scheme = "http"
+    with tempfile.TemporaryDirectory() as tmp:
+        if args.tls:
+            cert, key = make_cert(tmp)
+            server_ctx = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+            server_ctx.load_cert_chain(cert, key)
+            httpd.socket = server_ctx.wrap_socket(httpd.socket, server_side=True)
+            context = ssl._create_unverified_context()
+            scheme = "https"
+        start_thread(httpd.serve_forever)
+        base_url = f"{scheme}://127.0.0.1:{httpd.server_address[1]}"
+
+        client = LarkClient(base_url=base_url, pool_size=max(1, args.threads))
+        if args.tls:
+            client.pool.connection_pool_kw["cert_reqs"] = "CERT_NONE"
+
+        run("urlopen", lambda: urlopen_send(base_url, context), args.calls, args.threads)
+        run("pooled", lambda: client.send_message("t-bench", "oc_bench", "hi"),
+            args.calls, args.threads)
+        httpd.shutdown()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,160 @@
+"""
+Overhead of the metrics and logging left on in the request path.
+
+Times the per-call cost of Counter.inc, Histogram.observe / time(), a
+disabled logger.debug, a queued logger.info, and a print to a slow
+stream, plus the time to render /metrics. Then serves a batch of
+synthetic callbacks with the threaded RequestHandler and with the
+asyncio server, scrapes GET /metrics from each and checks that the event
+counter and the ack histogram count every event; exits non-zero if not.
+
+Usage: python -m benchmarks.bench_metrics [--calls 200000] [--events 300]
+"""
+
+import argparse
+import asyncio
+import http.client
+import io
+import json
+import logging
+import re
+import threading
+import time
+from http.server import HTTPServer
+
+from benchmarks._offline import import_bot, message_event, start_thread
+from metrics import Counter, Histogram, Registry
+from structured_log import setup_logging, stop_logging
+
+SAMPLE = re.compile(r'^[a-zA-Z_:][a-zA-Z0-9_:]*(\{[^}]*\})? [-+0-9.e]+$')
+
+
+class SlowStream(io.StringIO):
+    """A stdout that takes 50us per write, like a busy pipe or terminal."""
+
+    def write(self, s):
+        time.sleep(0.00005)
+        return super().write(s)
+
+
+def per_call(name, fn, calls):
+    start = time.perf_counter()
+    for _ in range(calls):
+        fn()
+    elapsed = time.perf_counter() - start
+    print(f"{name:<28} {elapsed / calls * 1e9:9.0f} ns/call")
+
+
+def micro(calls):
+    registry = Registry()
+    counter = Counter("bench_total", "bench", registry=registry)
+    labelled = Counter("bench_labelled_total", "bench", ["event_type"], registry=registry)
+    histogram = Histogram("bench_seconds", "bench", registry=registry)
+
+    def timed():
+        with histogram.time():
+            pass
+
+    per_call("Counter.inc", counter.inc, calls)
+    per_call("Counter.labels().inc", lambda: labelled.labels("im.message.receive_v1").inc(), calls)
+    per_call("Histogram.observe", lambda: histogram.observe(0.003), calls)
+    per_call("Histogram.time", timed, calls)
+
+    logger = logging.getLogger("bench")
+    stream = SlowStream()
+    setup_logging("INFO", "json", stream=stream, max_queue=calls)
+    per_call("logger.debug (disabled)", lambda: logger.debug("event", extra={"event_type": "x"}), calls)
+    per_call("logger.info (queued)", lambda: logger.info("message received", extra={"chat_id": "oc_1"}),
+             calls // 10)
+    stop_logging()
+    per_call("print (slow stdout)", lambda: print("[RECEIVED] hi", file=stream), calls // 100)
+
+    start = time.perf_counter()
+    for _ in range(100):
+        registry.render()
+    print(f"{'render /metrics':<28} {(time.perf_counter() - start) / 100 * 1e6:9.1f} us")
+
+
+def get(port, path):
+    conn = http.client.HTTPConnection("127.0.0.1", port, timeout=10)
+    conn.request("GET", path)
+    rsp = conn.getresponse()
+    body = rsp.read().decode()
+    conn.close()
+    return rsp.status, rsp.getheader("Content-Type"), body
+
+
+def post(port, body):
+    conn = http.client.HTTPConnection("127.0.0.1", port, timeout=10)
+    conn.request("POST", "/", body=body, headers={"Content-Type": "application/json"})
+    conn.getresponse().read()
+    conn.close()
+
+
+def sample(text, name):
+    for line in text.splitlines():
+        if line.startswith(name + " ") or line.startswith(name + "{"):
+            return float(line.rsplit(" ", 1)[1])
+    return 0.0
+
+
+def check_scrape(name, port, count, before):
+    status, content_type, text = get(port, "/metrics")
+    bad = [line for line in text.splitlines() if not line.startswith("#") and not SAMPLE.match(line)]
+    events = sample(text, 'bot_events_total{event_type="im.message.receive_v1"}') - before[0]
+    acks = sample(text, "bot_ack_seconds_count") - before[1]
+    ok = status == 200 and content_type.startswith("text/plain") and not bad and events == count and acks == count
+    print(f"scrape ({name:<8}) status={status} events={events:.0f}/{count} acks={acks:.0f}/{count} "
+          f"malformed_lines={len(bad)} {'OK' if ok else 'FAILED'}")
+    return ok, (before[0] + events, before[1] + acks)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--calls", type=int, default=200000)
+    parser.add_argument("--events", type=int, default=300)
+    args = parser.parse_args()
+
+    micro(args.calls)
+
+    bot = import_bot("bot_v2")
+    bot.handle_message = lambda message: None
+    bot.worker_pool.handler = bot.handle_message
+
+    httpd = HTTPServer(("127.0.0.1", 0), bot.RequestHandler)
+    start_thread(httpd.serve_forever)
+    port = httpd.server_address[1]
+    for i in range(args.events):
+        post(port, json.dumps(message_event(f"om_threaded_{i}")))
+    ok_threaded, seen = check_scrape("threaded", port, args.events, (0.0, 0.0))
+    httpd.shutdown()
+    httpd.server_close()
+
+    from async_server import AsyncWebhookServer
+
+    loop = asyncio.new_event_loop()
+    server = AsyncWebhookServer(bot.APP_VERIFICATION_TOKEN, bot.handle_message, host="127.0.0.1", port=0,
+                                is_duplicate=bot.is_duplicate_event, on_request=bot.count_request,
+                                routes=bot.routes)
+    ready = threading.Event()
+
+    def serve():
+        asyncio.set_event_loop(loop)
+        loop.run_until_complete(server.start())
+        ready.set()
+        loop.run_forever()
+
+    threading.Thread(target=serve, daemon=True).start()
+    ready.wait()
+    for i in range(args.events):
+        post(server.port, json.dumps(message_event(f"om_asyncio_{i}")))
+    ok_asyncio, _ = check_scrape("asyncio", server.port, args.events, seen)
+    asyncio.run_coroutine_threadsafe(server.stop(), loop).result()
+    loop.call_soon_threadsafe(loop.stop)
+
+    if not (ok_threaded and ok_asyncio):
+        raise SystemExit("FAILED: /metrics does not count every event")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,113 @@
+"""
+Per-chat ordering benchmark for the worker pool.
+
+Submits messages round-robin over a growing number of distinct chats to
+WorkerPool with and without the per-chat key, with a handler that sleeps
+a random 0..--work-ms. Reports messages/sec and counts messages handled
+out of submission order within their chat; the keyed pool must have none
+(the script exits non-zero otherwise), the unordered pool shows the race.
+
+The asyncio server's keyed pipeline is checked the same way.
+
+Usage: python -m benchmarks.bench_ordering [--messages 2000] [--workers 16] [--work-ms 5]
+"""
+
+import argparse
+import asyncio
+import random
+import threading
+import time
+
+from async_server import AsyncWebhookServer
+from worker_pool import WorkerPool
+
+
+def chat_key(message):
+    return message["chat_id"]
+
+
+class Recorder:
+    """Handler recording, per chat, the sequence numbers in handling order."""
+
+    def __init__(self, work):
+        self.work = work
+        self.seen = {}
+        self.lock = threading.Lock()
+        self.done = threading.Semaphore(0)
+
+    def __call__(self, message):
+        time.sleep(random.uniform(0, self.work))
+        with self.lock:
+            self.seen.setdefault(message["chat_id"], []).append(message["seq"])
+        self.done.release()
+
+    def violations(self):
+        return sum(1 for seqs in self.seen.values()
+                   for a, b in zip(seqs, seqs[1:]) if b < a)
+
+
+def messages(count, chats):
+    return [{"chat_id": f"oc_{i % chats}", "seq": i} for i in range(count)]
+
+
+def bench_pool(batch, workers, work, key):
+    recorder = Recorder(work)
+    pool = WorkerPool(recorder, workers=workers, max_queue=len(batch), key=key)
+    start = time.perf_counter()
+    for message in batch:
+        pool.submit(message)
+    for _ in batch:
+        recorder.done.acquire()
+    elapsed = time.perf_counter() - start
+    stats = pool.stats()
+    pool.shutdown(wait=True)
+    return len(batch) / elapsed, recorder.violations(), stats
+
+
+def bench_async(batch, workers, work):
+    recorder = Recorder(work)
+
+    async def run():
+        server = AsyncWebhookServer("bench-token", recorder, port=0, workers=workers,
+                                    max_queue=len(batch), key=chat_key)
+        await server.start()
+        start = time.perf_counter()
+        for message in batch:
+            server._enqueue(message)
+        await server.queue.join()
+        elapsed = time.perf_counter() - start
+        await server.stop()
+        return elapsed
+
+    elapsed = asyncio.run(run())
+    return len(batch) / elapsed, recorder.violations()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--messages", type=int, default=2000)
+    parser.add_argument("--workers", type=int, default=16)
+    parser.add_argument("--work-ms", type=float, default=5.0)
+    parser.add_argument("--chats", type=int, nargs="+", default=[1, 4, 16, 64, 256])
+    args = parser.parse_args()
+    work = args.work_ms / 1000.0
+
+    failed = False
+    for chats in args.chats:
+        batch = messages(args.messages, chats)
+        rate, violations, _ = bench_pool(batch, args.workers, work, key=None)
+        print(f"chats={chats:<5} unordered  {rate:8.1f} msg/s  out_of_order={violations}")
+        rate, violations, stats = bench_pool(batch, args.workers, work, key=chat_key)
+        print(f"chats={chats:<5} keyed      {rate:8.1f} msg/s  out_of_order={violations}"
+              f"  keys_left={stats['keys']}")
+        failed = failed or violations or stats["keys"]
+        rate, violations = bench_async(batch, args.workers, work)
+        print(f"chats={chats:<5} async-keyed {rate:7.1f} msg/s  out_of_order={violations}")
+        failed = failed or violations
+
+    if failed:
+        raise SystemExit("FAILED: per-chat order violated or idle keys not cleaned up")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,140 @@
+"""
+Outbound send limiter benchmark against a throttling Open API stub.
+
+The stub enforces a per-app and a per-chat rate with fixed one-second
+windows and answers code 99991400 beyond them, like Lark does. A burst of
+replies over a few chats is sent directly through LarkClient, then
+through OutboundLimiter, then through OutboundLimiter with coalescing.
+Reports the replies delivered, lost, throttled, the Lark messages it took
+and the queueing delay. Every chat must see its replies in order; the
+script exits non-zero otherwise, or if the limiter lost a reply.
+
+Usage: python -m benchmarks.bench_outbound [--replies 300] [--chats 10]
+"""
+
+import argparse
+import json
+import threading
+import time
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from benchmarks._offline import start_thread
+from lark_client import LarkClient
+from rate_limiter import OutboundLimiter
+
+
+class ThrottlingStub(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    disable_nagle_algorithm = True
+    app_rate = 50
+    chat_rate = 5
+    lock = threading.Lock()
+    windows = defaultdict(int)
+    received = defaultdict(list)
+    throttled = 0
+
+    def do_POST(self):
+        req = json.loads(self.rfile.read(int(self.headers.get("content-length", 0))))
+        chat_id = req["chat_id"]
+        second = int(time.monotonic())
+        cls = type(self)
+        with cls.lock:
+            ok = (cls.windows[("app", second)] < cls.app_rate
+                  and cls.windows[(chat_id, second)] < cls.chat_rate)
+            if ok:
+                cls.windows[("app", second)] += 1
+                cls.windows[(chat_id, second)] += 1
+                cls.received[chat_id].extend(req["content"]["text"].split("\n\n"))
+            else:
+                cls.throttled += 1
+        rsp = {"code": 0, "msg": "success"} if ok else {"code": 99991400, "msg": "request trigger frequency limit"}
+        body = json.dumps(rsp).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+    @classmethod
+    def reset(cls):
+        with cls.lock:
+            cls.windows.clear()
+            cls.received.clear()
+            cls.throttled = 0
+
+
+def out_of_order(received):
+    violations = 0
+    for texts in received.values():
+        seqs = [int(t.split("#")[1]) for t in texts]
+        violations += sum(1 for a, b in zip(seqs, seqs[1:]) if b < a)
+    return violations
+
+
+def run(name, send, replies, chats, limiter=None):
+    ThrottlingStub.reset()
+    start = time.perf_counter()
+
+    def one_chat(chat):
+        # Replies of a chat are produced in order, like ReplySender does
+        for i in range(chat, replies, chats):
+            send(f"oc_{chat}", f"reply #{i}")
+
+    with ThreadPoolExecutor(max_workers=chats) as pool:
+        list(pool.map(one_chat, range(chats)))
+    if limiter is not None:
+        limiter.shutdown(wait=True, timeout=120)
+    elapsed = time.perf_counter() - start
+
+    delivered = sum(len(t) for t in ThrottlingStub.received.values())
+    violations = out_of_order(ThrottlingStub.received)
+    line = (f"{name:<10} delivered={delivered:<5} lost={replies - delivered:<5} "
+            f"throttled_by_lark={ThrottlingStub.throttled:<5} "
+            f"time={elapsed:6.2f}s out_of_order={violations}")
+    if limiter is not None:
+        stats = limiter.stats()
+        line += (f" lark_messages={stats['sent'] - stats['coalesced']}"
+                 f" queue_delay p50={stats['queue_delay_p50_ms']}ms"
+                 f" p99={stats['queue_delay_p99_ms']}ms")
+    print(line)
+    return delivered, violations
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--replies", type=int, default=300)
+    parser.add_argument("--chats", type=int, default=10)
+    args = parser.parse_args()
+
+    httpd = ThreadingHTTPServer(("127.0.0.1", 0), ThrottlingStub)
+    start_thread(httpd.serve_forever)
+    base_url = f"http://127.0.0.1:{httpd.server_address[1]}"
+    # No client-side retries: show what the limiter alone does
+    client = LarkClient(base_url=base_url, pool_size=args.chats, max_retries=0)
+
+    def post(chat_id, msg_type, content):
+        return client.send("t-bench", chat_id, msg_type, content)
+
+    run("direct", lambda chat_id, text: post(chat_id, "text", {"text": text}),
+        args.replies, args.chats)
+
+    failed = False
+    for name, coalesce in (("limited", False), ("coalesced", True)):
+        # Stay a little under the stub's limits, its windows are not aligned with ours
+        limiter = OutboundLimiter(post, rate=45, chat_rate=4.5, coalesce=coalesce)
+        delivered, violations = run(name, lambda chat_id, text: limiter.send(chat_id, "text", {"text": text}),
+                                    args.replies, args.chats, limiter)
+        failed = failed or violations or delivered != args.replies
+
+    httpd.shutdown()
+    if failed:
+        raise SystemExit("FAILED: replies lost or out of order")
+
+
+if __name__ == "__main__":
+    main()
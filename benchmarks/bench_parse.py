@@ -0,0 +1,110 @@
+"""
+parse_rich_responses microbenchmark: MessageToDict over the whole
+query_result (the previous implementation) vs the proto-native walk.
+
+Uses a large synthetic response (big diagnostic_info, parameters, output
+contexts and payload cards), or recorded responses given with --responses,
+a JSON lines file of DetectIntentResponse in proto3 JSON form.
+
+Usage: python -m benchmarks.bench_parse [--iterations 2000] [--responses recorded.jsonl]
+"""
+
+import argparse
+import time
+import tracemalloc
+
+from google.cloud import dialogflow_v2 as dialogflow
+from google.protobuf.json_format import MessageToDict
+
+from benchmarks._offline import import_google_auth_offline
+from dialogflow_helper import DialogflowHelper
+
+
+def parse_with_message_to_dict(response):
+    """The previous parse_rich_responses, kept as the baseline."""
+    query_result_dict = MessageToDict(response.query_result._pb)
+    text_responses = []
+    payload_responses = []
+    for fm in query_result_dict.get("fulfillmentMessages", []):
+        if "text" in fm:
+            text_responses.extend(fm["text"].get("text", []))
+        if "payload" in fm:
+            payload_responses.append(fm["payload"])
+    return {"text": text_responses, "payload": payload_responses}
+
+
+def synthetic_response():
+    card = {
+        "richContent": [[
+            {"type": "info", "title": f"Item {i}", "subtitle": "details " * 5,
+             "image": {"src": {"rawUrl": "https://example.com/image.png"}},
+             "actionLink": "https://example.com"}
+            for i in range(10)
+        ]]
+    }
+    diagnostic = {
+        "webhook_latency_ms": 120,
+        "trace": [{"step": i, "detail": "x" * 80, "scores": list(range(20))} for i in range(200)],
+    }
+    params = {f"param_{i}": f"value {i}" for i in range(50)}
+    return dialogflow.DetectIntentResponse(
+        response_id="synthetic",
+        query_result=dialogflow.QueryResult(
+            query_text="show me the catalogue",
+            fulfillment_text="Here is the catalogue",
+            parameters=params,
+            output_contexts=[
+                dialogflow.Context(name=f"projects/p/agent/sessions/s/contexts/ctx{i}",
+                                   lifespan_count=5, parameters=params)
+                for i in range(10)
+            ],
+            fulfillment_messages=[
+                dialogflow.Intent.Message(text=dialogflow.Intent.Message.Text(text=["Here is the catalogue"])),
+                dialogflow.Intent.Message(payload=card),
+                dialogflow.Intent.Message(text=dialogflow.Intent.Message.Text(text=["Anything else?"])),
+            ],
+            intent=dialogflow.Intent(display_name="Catalogue"),
+            intent_detection_confidence=0.93,
+            diagnostic_info=diagnostic,
+        ),
+    )
+
+
+def load_responses(path):
+    with open(path, "r", encoding="utf-8") as f:
+        return [dialogflow.DetectIntentResponse.from_json(line, ignore_unknown_fields=True)
+                for line in f if line.strip()]
+
+
+def measure(name, parse, responses, iterations):
+    start = time.process_time()
+    for i in range(iterations):
+        parse(responses[i % len(responses)])
+    cpu = (time.process_time() - start) / iterations
+
+    tracemalloc.start()
+    parse(responses[0])
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    print(f"{name:<14} cpu={cpu * 1e6:9.1f}us/response  peak_alloc={peak / 1024:8.1f}KiB")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--iterations", type=int, default=2000)
+    parser.add_argument("--responses", help="JSON lines file of recorded DetectIntentResponses")
+    args = parser.parse_args()
+
+    import_google_auth_offline()
+    helper = DialogflowHelper("bench-project", "bench-session")
+    responses = load_responses(args.responses) if args.responses else [synthetic_response()]
+
+    for response in responses:
+        assert helper.parse_rich_responses(response) == parse_with_message_to_dict(response)
+
+    measure("MessageToDict", parse_with_message_to_dict, responses, args.iterations)
+    measure("proto-native", helper.parse_rich_responses, responses, args.iterations)
+
+
+if __name__ == "__main__":
+    main()
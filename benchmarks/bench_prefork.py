@@ -0,0 +1,80 @@
+"""
+Ack throughput of the multi-process mode as the number of workers grows.
+
+Starts prefork.PreforkSupervisor with 1, 2, ... N workers of the bot
+(offline, Dialogflow + send replaced by a sleep, SQLite dedup and event
+queue shared through a temporary directory) on one SO_REUSEPORT port,
+fires synthetic callbacks at it and reports acked events/sec. Workers can
+only add throughput up to the number of cores of the machine.
+
+Usage: python -m benchmarks.bench_prefork [--workers 1 2 4] [--events 3000] [--mode threaded]
+"""
+
+import argparse
+import json
+import os
+import sys
+import tempfile
+import time
+
+from benchmarks._offline import free_port, message_event, wait_ready
+from benchmarks.bench_ingress import fire, report
+from prefork import PreforkSupervisor
+
+
+def child():
+    """One worker: the real bot with the Dialogflow + send path stubbed out."""
+    from benchmarks._offline import import_bot
+
+    bot = import_bot("bot_v2")
+    work = float(os.environ.get("BENCH_WORK_MS", "0")) / 1000.0
+    bot.handle_message = lambda message: time.sleep(work)
+    bot.run()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4])
+    parser.add_argument("--events", type=int, default=3000)
+    parser.add_argument("--concurrency", type=int, default=32)
+    parser.add_argument("--mode", default="threaded", choices=["threaded", "asyncio"])
+    parser.add_argument("--work-ms", type=float, default=5.0)
+    parser.add_argument("--child", action="store_true", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        child()
+        return
+
+    print(f"cores={os.cpu_count()} mode={args.mode}")
+    with tempfile.TemporaryDirectory() as tmp:
+        for workers in args.workers:
+            port = free_port()
+            env = {
+                "SERVER_MODE": args.mode,
+                "SERVER_PORT": str(port),
+                "DEDUP_BACKEND": "sqlite",
+                "DEDUP_SQLITE_PATH": os.path.join(tmp, f"dedup-{workers}.sqlite3"),
+                "EVENT_QUEUE": "sqlite",
+                "EVENT_QUEUE_PATH": os.path.join(tmp, f"events-{workers}.sqlite3"),
+                "BENCH_WORK_MS": str(args.work_ms),
+                "PYTHONUNBUFFERED": "1",
+            }
+            supervisor = PreforkSupervisor([sys.executable, "-m", "benchmarks.bench_prefork", "--child"],
+                                           workers, env=env)
+            bodies = [json.dumps(message_event(f"om_{workers}_{i}", chat_id=f"oc_{i % 64}"))
+                      for i in range(args.events)]
+            supervisor.start()
+            try:
+                if not wait_ready(port):
+                    raise SystemExit("FAILED: workers did not start")
+                # Give every worker time to bind, not just the first one
+                time.sleep(2.0 + workers)
+                latencies, errors, elapsed = fire(port, bodies, args.concurrency)
+            finally:
+                supervisor.stop()
+            report(f"workers={workers}", latencies, errors, elapsed)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,159 @@
+"""
+Time-to-first-reply benchmark for multi-message fulfillments.
+
+Messages from several chats are pushed through a WorkerPool, each answered
+by a local fake Dialogflow with --replies text messages and sent to a local
+stub of the Open API that takes --send-ms per call. Compares sending every
+reply from the worker thread ("inline") with the ReplySender pipeline, and
+checks that every chat received its replies in order.
+
+Usage: python -m benchmarks.bench_replies [--messages 400] [--chats 40] [--replies 3]
+"""
+
+import argparse
+import json
+import threading
+import time
+from collections import defaultdict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from benchmarks._offline import percentile, start_thread
+from benchmarks.fake_dialogflow import FakeSessions
+from dialogflow_helper import DialogflowHelper
+from lark_client import LarkClient
+from reply_pipeline import ReplySender, build_replies
+from worker_pool import WorkerPool
+
+
+class StubSend(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    disable_nagle_algorithm = True
+    delay = 0.0
+    received = defaultdict(list)
+    lock = threading.Lock()
+
+    def do_POST(self):
+        req = json.loads(self.rfile.read(int(self.headers.get("content-length", 0))))
+        time.sleep(self.delay)
+        with self.lock:
+            self.received[req["chat_id"]].append(req["content"]["text"])
+        body = json.dumps({"code": 0, "msg": "success", "data": {}}).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+def check_order(received):
+    """
+    Every message's replies arrive in order (k/n ascending) and are not
+    interleaved with another message's replies of the same chat.
+
+    :return: Number of violations
+    """
+    violations = 0
+    for texts in received.values():
+        current, expected, total = None, 1, 0
+        for text in texts:
+            # "echo: <message> (k/n)"
+            message, _, part = text[len("echo: "):].rpartition(" (")
+            k, n = (int(x) for x in part.rstrip(")").split("/"))
+            if message != current:
+                if current is not None and expected != total + 1:
+                    violations += 1
+                current, expected, total = message, 1, n
+            if k != expected:
+                violations += 1
+            expected = k + 1
+        # The chat's last message must be complete too
+        if current is not None and expected != total + 1:
+            violations += 1
+    return violations
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--messages", type=int, default=400)
+    parser.add_argument("--chats", type=int, default=40)
+    parser.add_argument("--replies", type=int, default=3)
+    parser.add_argument("--workers", type=int, default=8)
+    parser.add_argument("--latency-ms", type=float, default=20.0)
+    parser.add_argument("--send-ms", type=float, default=10.0)
+    args = parser.parse_args()
+
+    StubSend.delay = args.send_ms / 1000.0
+    httpd = ThreadingHTTPServer(("127.0.0.1", 0), StubSend)
+    start_thread(httpd.serve_forever)
+    client = LarkClient(base_url=f"http://127.0.0.1:{httpd.server_address[1]}", pool_size=32)
+    fake = FakeSessions(latency=args.latency_ms / 1000.0, replies=args.replies).start()
+    helper = DialogflowHelper("bench-project", "bench-session",
+                              sessions_client=fake.sessions_client())
+
+    def replies_for(message):
+        response = helper._detect_intent_text(message["text"], message["chat_id"])
+        return build_replies(helper.iter_fulfillment_messages(response))
+
+    def deliver(chat_id, msg_type, content):
+        status, rsp_dict = client.send("t-bench", chat_id, msg_type, content)
+        return status == 200 and rsp_dict.get("code") == 0
+
+    def inline(message, ttfr, lock):
+        for i, (msg_type, content) in enumerate(replies_for(message)):
+            deliver(message["chat_id"], msg_type, content)
+            if i == 0:
+                with lock:
+                    ttfr.append(time.monotonic() - message["submitted"])
+
+    sender = ReplySender(deliver, workers=32)
+
+    def pipelined(message, ttfr, lock):
+        # submit() returns once the first reply is sent
+        sender.submit(message["chat_id"], replies_for(message))
+        with lock:
+            ttfr.append(time.monotonic() - message["submitted"])
+
+    failed = False
+    for name, handler in (("inline", inline), ("pipelined", pipelined)):
+        ttfr = []
+        StubSend.received.clear()
+        lock = threading.Lock()
+        done = threading.Semaphore(0)
+
+        def handle(message, handler=handler):
+            try:
+                handler(message, ttfr, lock)
+            finally:
+                done.release()
+
+        pool = WorkerPool(handle, workers=args.workers, max_queue=args.messages, name=name)
+        start = time.perf_counter()
+        for i in range(args.messages):
+            pool.submit({"chat_id": f"oc_{i % args.chats}", "text": f"m{i}",
+                         "submitted": time.monotonic()})
+        for _ in range(args.messages):
+            done.acquire()
+        if name == "pipelined":
+            sender.shutdown(wait=True)
+        elapsed = time.perf_counter() - start
+        pool.shutdown(wait=True)
+
+        sent = sum(len(t) for t in StubSend.received.values())
+        violations = check_order(StubSend.received)
+        failed = failed or violations or sent != args.messages * args.replies
+        print(f"{name:<10} messages={args.messages:<5} replies={sent:<6} "
+              f"ttfr p50={percentile(ttfr, 50) * 1000:7.1f}ms "
+              f"p99={percentile(ttfr, 99) * 1000:7.1f}ms "
+              f"all sent in {elapsed:6.2f}s order_violations={violations}")
+
+    fake.stop()
+    httpd.shutdown()
+    if failed:
+        raise SystemExit("FAILED: replies lost or out of order")
+
+
+if __name__ == "__main__":
+    main()
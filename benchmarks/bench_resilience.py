@@ -0,0 +1,177 @@
+"""
+Deadlines, hedged requests and the circuit breaker, against a fake Sessions service with a latency tail.
+
+- deadline: a call to a fake slower than DIALOGFLOW_TIMEOUT raises
+  DeadlineExceeded on time instead of holding its thread
+- hedging: the same queries through DialogflowHelper (from a thread pool)
+  and AsyncDialogflowHelper, without and with a HedgePolicy, against a
+  fake where --slow-rate of the calls take --slow-ms. Reports latency
+  percentiles, the hedges sent, their win rate and the extra calls
+- circuit breaker: once the fake stops answering, calls fail on their
+  deadline until the breaker opens, then fail at once with
+  CircuitOpenError; once the fake recovers, the trial call after the
+  reset timeout closes it again
+
+Exits non-zero if the deadline isn't kept, if hedging doesn't cut the p99
+by half or sends more extra calls than its budget allows, or if the
+breaker doesn't open, short-circuit and close.
+
+Usage: python -m benchmarks.bench_resilience [--queries 400] [--concurrency 8] [--slow-rate 0.05] [--slow-ms 1000]
+"""
+
+import argparse
+import asyncio
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from google.api_core import exceptions
+
+from async_dialogflow_helper import AsyncDialogflowHelper
+from benchmarks._offline import percentile
+from benchmarks.fake_dialogflow import FakeSessions
+from dialogflow_helper import DialogflowHelper
+from resilience import CLOSED, OPEN, CircuitBreaker, CircuitOpenError, HedgePolicy
+
+
+def timed_sync(helper, texts, concurrency):
+    def one(i):
+        start = time.perf_counter()
+        response = helper._detect_intent_text(texts[i], f"chat-{i}")
+        assert response.query_result.query_text == texts[i]
+        return time.perf_counter() - start
+
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        return list(pool.map(one, range(len(texts))))
+
+
+async def timed_async(helper, texts, concurrency):
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def one(i):
+        async with semaphore:
+            start = time.perf_counter()
+            response = await helper.detect_intent(texts[i], f"chat-{i}")
+            assert response.query_result.query_text == texts[i]
+            return time.perf_counter() - start
+
+    try:
+        return await asyncio.gather(*(one(i) for i in range(len(texts))))
+    finally:
+        await helper.close()
+
+
+def compare_hedging(args):
+    """:return: True if hedging cut the p99 within its budget, for both helpers"""
+    fake = FakeSessions(latency=args.latency_ms / 1000.0, jitter=args.latency_ms / 2000.0,
+                        slow_rate=args.slow_rate, slow_latency=args.slow_ms / 1000.0,
+                        max_workers=4 * args.concurrency).start()
+    texts = [f"query {i}" for i in range(args.queries)]
+    ok = True
+    try:
+        for kind in ("sync", "async"):
+            p99 = {}
+            for hedged in (False, True):
+                hedge = HedgePolicy(95, budget=args.budget) if hedged else None
+                calls = fake.calls
+                if kind == "sync":
+                    helper = DialogflowHelper("bench-project", "bench-session", timeout=10.0,
+                                              sessions_client=fake.sessions_client(), hedge=hedge)
+                    samples = timed_sync(helper, texts, args.concurrency)
+                else:
+                    helper = AsyncDialogflowHelper("bench-project", "bench-session", timeout=10.0,
+                                                   client_factory=fake.async_sessions_client, hedge=hedge)
+                    samples = asyncio.run(timed_async(helper, texts, args.concurrency))
+                extra = (fake.calls - calls) / len(texts) - 1
+                p99[hedged] = percentile(samples, 99)
+                line = (f"{kind:<5} {'hedged' if hedged else 'plain':<6} p50={percentile(samples, 50) * 1000:6.1f}ms "
+                        f"p95={percentile(samples, 95) * 1000:6.1f}ms p99={p99[hedged] * 1000:6.1f}ms "
+                        f"max={max(samples) * 1000:6.1f}ms extra_calls={extra:5.1%}")
+                if hedge is not None:
+                    stats = hedge.stats()
+                    line += (f" hedges={stats['hedges']} win_rate={stats['win_rate']:.0%} "
+                             f"delay={stats['delay_ms']}ms")
+                    # The budget, plus the hedge it starts with
+                    ok = ok and extra <= args.budget + 1.0 / len(texts) + 1e-9
+                print(line)
+            ok = ok and p99[True] <= p99[False] / 2
+    finally:
+        fake.stop()
+    print(f"hedging       p99 at least halved within a {args.budget:.0%} budget {'OK' if ok else 'FAILED'}")
+    return ok
+
+
+def check_deadline():
+    fake = FakeSessions(latency=1.0).start()
+    helper = DialogflowHelper("bench-project", "bench-session", timeout=0.2,
+                              sessions_client=fake.sessions_client())
+    start = time.perf_counter()
+    try:
+        helper._detect_intent_text("slow")
+        outcome = "answered"
+    except exceptions.DeadlineExceeded:
+        outcome = "DeadlineExceeded"
+    finally:
+        fake.stop()
+    elapsed = time.perf_counter() - start
+    ok = outcome == "DeadlineExceeded" and elapsed < 0.4
+    print(f"deadline      timeout=0.2s latency=1s -> {outcome} after {elapsed:.3f}s {'OK' if ok else 'FAILED'}")
+    return ok
+
+
+def check_breaker():
+    fake = FakeSessions(latency=1.0).start()
+    breaker = CircuitBreaker(failure_threshold=3, reset_timeout=0.5)
+    helper = DialogflowHelper("bench-project", "bench-session", timeout=0.1,
+                              sessions_client=fake.sessions_client(), breaker=breaker)
+
+    def call():
+        start = time.perf_counter()
+        try:
+            helper._detect_intent_text("ping")
+            outcome = "answered"
+        except CircuitOpenError:
+            outcome = "short-circuited"
+        except exceptions.GoogleAPICallError as e:
+            outcome = type(e).__name__
+        return outcome, time.perf_counter() - start
+
+    try:
+        # Dialogflow too slow for the deadline
+        failures = [call() for _ in range(3)]
+        opened = breaker.state == OPEN
+        short, short_time = call()
+        calls = fake.calls
+        refused = [call() for _ in range(100)]
+        spared = fake.calls == calls
+        # Dialogflow recovers; the trial call after the reset timeout closes the breaker
+        fake.latency = 0.005
+        time.sleep(0.6)
+        trial, _ = call()
+        closed = breaker.state == CLOSED
+    finally:
+        fake.stop()
+    ok = (opened and short == "short-circuited" and short_time < 0.005 and spared
+          and all(o == "short-circuited" for o, _ in refused) and trial == "answered" and closed)
+    print(f"breaker       {len(failures)} x {failures[0][0]} -> open={opened}, then {short} in "
+          f"{short_time * 1e6:.0f}us (101 calls, none reached Dialogflow={spared}), "
+          f"trial after reset {trial} -> closed={closed} {'OK' if ok else 'FAILED'}")
+    return ok
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--queries", type=int, default=400)
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--latency-ms", type=float, default=20.0)
+    parser.add_argument("--slow-rate", type=float, default=0.05, help="share of calls in the latency tail")
+    parser.add_argument("--slow-ms", type=float, default=1000.0)
+    parser.add_argument("--budget", type=float, default=0.1, help="hedges per call at most")
+    args = parser.parse_args()
+
+    checks = [check_deadline(), compare_hedging(args), check_breaker()]
+    if not all(checks):
+        raise SystemExit("FAILED: see the checks above")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,178 @@
+"""
+Startup time of bot_v2: import time and cold start to the first acked event.
+
+Imports bot_v2 in fresh interpreters and reports the median import time,
+checking it against --budget-ms and that the import does not load the
+Dialogflow SDK or grpc. Then starts the bot in a child process against
+local fakes (benchmarks/fake_lark.py, benchmarks/fake_dialogflow.py) and
+measures, from the spawn:
+- bound: the port accepts connections
+- first ack: a message callback is answered with 200
+- ready: GET /ready answers 200 (the Dialogflow channel is connected)
+- first reply: the reply to that message reached the fake Lark
+
+--eager builds the Dialogflow client before binding instead, like the bot
+used to, for comparison. Exits non-zero when over budget.
+
+Usage: python -m benchmarks.bench_startup [--runs 5] [--budget-ms 250] [--mode threaded] [--eager]
+"""
+
+import argparse
+import http.client
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+from benchmarks._offline import free_port, message_event, offline_env
+
+HEAVY_MODULES = ("google.cloud.dialogflow_v2", "grpc", "google.protobuf")
+
+IMPORT_SNIPPET = """
+import json, sys, time
+start = time.perf_counter()
+import bot_v2
+elapsed = time.perf_counter() - start
+heavy = [m for m in {heavy!r} if m in sys.modules]
+print(json.dumps({{"seconds": elapsed, "heavy": heavy}}))
+"""
+
+
+def child():
+    """The bot under test; helpers are pointed at the fake once created."""
+    import importlib
+
+    bot = importlib.import_module("bot_v2")
+    address = os.environ["BENCH_DIALOGFLOW_ADDRESS"]
+    create_dialogflow_helpers = bot.create_dialogflow_helpers
+
+    def create_on_fake():
+        from benchmarks._offline import import_google_auth_offline
+        from benchmarks.fake_dialogflow import sessions_client
+
+        import_google_auth_offline()
+        helper, async_helper = create_dialogflow_helpers()
+        helper.sessions_client = sessions_client(address)
+        return helper, async_helper
+
+    bot.create_dialogflow_helpers = create_on_fake
+    if os.environ.get("BENCH_EAGER"):
+        # What the bot did before: the SDK and the channel before the bind
+        bot.warm_up_dialogflow()
+        bot.start_warm_up = lambda: None
+    bot.run()
+
+
+def measure_import(runs):
+    env = offline_env(dict(os.environ))
+    samples, heavy = [], set()
+    for _ in range(runs):
+        out = subprocess.run([sys.executable, "-c", IMPORT_SNIPPET.format(heavy=HEAVY_MODULES)],
+                             env=env, capture_output=True, text=True, check=True)
+        result = json.loads(out.stdout.strip().splitlines()[-1])
+        samples.append(result["seconds"])
+        heavy.update(result["heavy"])
+    return samples, sorted(heavy)
+
+
+def request(port, method, path, body=None):
+    """:return: HTTP status, or None if the server isn't accepting connections yet"""
+    try:
+        conn = http.client.HTTPConnection("127.0.0.1", port, timeout=5)
+        conn.request(method, path, body=body, headers={"Content-Type": "application/json"})
+        status = conn.getresponse().status
+        conn.close()
+        return status
+    except OSError:
+        return None
+
+
+def cold_start(args, lark, dialogflow):
+    port = free_port()
+    env = offline_env(dict(os.environ,
+                           BENCH_DIALOGFLOW_ADDRESS=dialogflow.address,
+                           SERVER_PORT=str(port),
+                           SERVER_MODE=args.mode,
+                           LARK_API_BASE=lark.base_url))
+    if args.eager:
+        env["BENCH_EAGER"] = "1"
+    body = json.dumps(message_event("om_startup", text="hello")).encode()
+
+    lark.reset()
+    spawned = time.perf_counter()
+    proc = subprocess.Popen([sys.executable, "-m", "benchmarks.bench_startup", "--child"],
+                            env=env, stdout=subprocess.DEVNULL)
+    marks = {}
+    try:
+        deadline = spawned + 60
+        while "first_ack" not in marks and time.perf_counter() < deadline:
+            status = request(port, "POST", "/", body)
+            if status is not None:
+                marks.setdefault("bound", time.perf_counter() - spawned)
+            if status == 200:
+                marks["first_ack"] = time.perf_counter() - spawned
+            else:
+                time.sleep(0.002)
+        while "ready" not in marks and time.perf_counter() < deadline:
+            if request(port, "GET", "/ready") == 200:
+                marks["ready"] = time.perf_counter() - spawned
+            else:
+                # Polling harder would take CPU from the warm-up on small machines
+                time.sleep(0.02)
+        if lark.wait_for(1, max(0.0, deadline - time.perf_counter())):
+            marks["first_reply"] = lark.received["oc_bench"][0][0] - spawned
+    finally:
+        proc.terminate()
+        proc.wait(timeout=30)
+    return marks
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--budget-ms", type=float, default=250.0, help="median import time allowed")
+    parser.add_argument("--mode", default="threaded", choices=["threaded", "asyncio"])
+    parser.add_argument("--eager", action="store_true", help="create the Dialogflow client before the bind")
+    parser.add_argument("--child", action="store_true", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.child:
+        return child()
+
+    samples, heavy = measure_import(args.runs)
+    median_ms = statistics.median(samples) * 1000
+    within = median_ms <= args.budget_ms and not heavy
+    print(f"import bot_v2  median={median_ms:.1f}ms min={min(samples) * 1000:.1f}ms "
+          f"budget={args.budget_ms:.0f}ms heavy_modules={heavy or 'none'} {'OK' if within else 'FAILED'}")
+
+    # Imported here: the child runs this module too, and shouldn't pay for grpc
+    from benchmarks.fake_dialogflow import FakeSessions
+    from benchmarks.fake_lark import FakeLark
+
+    lark = FakeLark().start()
+    dialogflow = FakeSessions(latency=0.02).start()
+    runs = []
+    try:
+        for _ in range(args.runs):
+            runs.append(cold_start(args, lark, dialogflow))
+    finally:
+        lark.stop()
+        dialogflow.stop()
+
+    label = "eager" if args.eager else "lazy"
+    for mark in ("bound", "first_ack", "ready", "first_reply"):
+        values = [run[mark] for run in runs if mark in run]
+        if not values:
+            print(f"{label:<5} {args.mode:<8} {mark:<12} never")
+            within = False
+            continue
+        print(f"{label:<5} {args.mode:<8} {mark:<12} median={statistics.median(values) * 1000:7.1f}ms "
+              f"max={max(values) * 1000:7.1f}ms ({len(values)}/{len(runs)} runs)")
+
+    if not within:
+        raise SystemExit("FAILED: startup over budget")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,266 @@
+"""
+Per-event CPU cost of parsing Lark callbacks: the previous handler code vs WebhookParser (json and orjson).
+
+Parses the same callbacks (synthetic, or recorded ones with --events, one
+callback body per line as for bench_e2e) the way RequestHandler did before
+(decode to str, json.loads, walk the dicts, then json.loads the message
+content in the worker) and with WebhookParser.parse + content(), with the
+standard json module and with orjson when it is installed. Reports the CPU
+time per event for every kind of callback, and the cost of rejecting
+bodies that aren't callbacks (wrong token, malformed, too large).
+
+Then sends bad requests to both server modes: a missing or invalid
+Content-Length, an oversized body, malformed JSON, a wrong token, a URL
+verification, and request lines and headers over the limits. Exits non-zero if the parser picks out other fields
+than the previous code, if a bad request isn't answered with its 4xx
+status (or crashes the handler), or if rejecting a body costs more than
+parsing a valid one.
+
+Usage: python -m benchmarks.bench_webhook_parse [--events recorded.jsonl] [--repeat 2000]
+"""
+
+import argparse
+import asyncio
+import json
+import socket
+import threading
+import time
+from collections import defaultdict
+from http.server import HTTPServer
+
+from benchmarks._offline import VERIFICATION_TOKEN, import_bot, message_event, start_thread
+from webhook_parser import MESSAGE_EVENT, InvalidCallback, WebhookParser, json_loads
+
+
+def previous_parse(body, token=VERIFICATION_TOKEN):
+    """What RequestHandler.handle_post and the worker did with a callback before."""
+    obj = json.loads(body.decode("utf-8"))
+    if (obj.get("token", "") or obj.get("header", {}).get("token", "")) != token:
+        return None
+    event_type = obj.get("type", "") or obj.get("header", {}).get("event_type", "")
+    if event_type == "url_verification":
+        return event_type, "", obj.get("challenge", ""), None
+    if event_type != MESSAGE_EVENT:
+        return event_type, "", "", None
+    event_id = obj.get("header", {}).get("event_id", "")
+    event = obj.get("event", {})
+    message = event.get("message", {})
+    message["sender"] = event.get("sender", {})
+    text = json.loads(message.get("content", "{}")).get("text", "") if message.get("message_type") == "text" else None
+    return event_type, event_id, "", text
+
+
+def lean_parse(parser, body):
+    """The same through WebhookParser."""
+    event = parser.parse(body)
+    if not event.verified:
+        return None
+    if event.event_type == "url_verification":
+        return event.event_type, "", event.challenge, None
+    if event.event_type != MESSAGE_EVENT:
+        return event.event_type, "", "", None
+    message = event.message
+    text = parser.content(message).get("text", "") if message.get("message_type") == "text" else None
+    return event.event_type, event.event_id, "", text
+
+
+def synthetic_events():
+    """:return: List of (kind, body) of the callbacks the bot typically gets"""
+    events = []
+    for i in range(40):
+        events.append(("text", message_event(f"om_parse_{i}", chat_id=f"oc_{i % 7}",
+                                             text=f"where is my order #{i}, it was due yesterday")))
+    long_text = "please help " * 200
+    for i in range(5):
+        events.append(("long text", message_event(f"om_long_{i}", text=long_text)))
+    for i in range(5):
+        image = message_event(f"om_image_{i}")
+        image["event"]["message"]["message_type"] = "image"
+        image["event"]["message"]["content"] = json.dumps({"image_key": f"img_v2_{i}"})
+        events.append(("image", image))
+    for i in range(5):
+        other = message_event(f"om_read_{i}")
+        other["header"]["event_type"] = "im.message.message_read_v1"
+        events.append(("other event", other))
+    events.append(("url_verification", {"type": "url_verification", "token": VERIFICATION_TOKEN,
+                                        "challenge": "ajls384kdjx98XX"}))
+    return [(kind, json.dumps(body, ensure_ascii=False).encode()) for kind, body in events]
+
+
+def recorded_events(path):
+    with open(path, encoding="utf-8") as f:
+        recorded = [json.loads(line) for line in f if line.strip()]
+    if not recorded:
+        raise SystemExit(f"no events in {path}")
+    events = []
+    for obj in recorded:
+        # Recorded with the production token
+        if "token" in obj:
+            obj["token"] = VERIFICATION_TOKEN
+        if isinstance(obj.get("header"), dict):
+            obj["header"]["token"] = VERIFICATION_TOKEN
+        kind = obj.get("type", "") or obj.get("header", {}).get("event_type", "")
+        events.append((kind, json.dumps(obj, ensure_ascii=False).encode()))
+    return events
+
+
+def cpu_per_event(fn, bodies, repeat):
+    """:return: CPU seconds per call of fn(body), over `repeat` passes of bodies"""
+    start = time.process_time()
+    for _ in range(repeat):
+        for body in bodies:
+            fn(body)
+    return (time.process_time() - start) / (repeat * len(bodies))
+
+
+def rejected(fn):
+    def reject(body):
+        try:
+            return fn(body)
+        except (InvalidCallback, ValueError):
+            return None
+    return reject
+
+
+def measure(events, repeat):
+    """:return: True if the parser agrees with the previous code and rejects cheaply"""
+    parsers = {"json": WebhookParser(VERIFICATION_TOKEN, loads=json_loads("json"))}
+    try:
+        parsers["orjson"] = WebhookParser(VERIFICATION_TOKEN, loads=json_loads("orjson"))
+    except ImportError:
+        print("orjson not installed, json only")
+
+    ok = True
+    for name, parser in parsers.items():
+        mismatches = [kind for kind, body in events if lean_parse(parser, body) != previous_parse(body)]
+        if mismatches:
+            print(f"{name}: fields differ from the previous code for {sorted(set(mismatches))}")
+            ok = False
+
+    by_kind = defaultdict(list)
+    for kind, body in events:
+        by_kind[kind].append(body)
+    columns = ["previous"] + list(parsers)
+    print(f"{'us/event':<18}" + "".join(f"{c:>10}" for c in columns))
+    all_bodies = [body for _, body in events]
+    for kind, bodies in list(by_kind.items()) + [("all", all_bodies)]:
+        # Enough passes for a stable number whatever the mix
+        passes = max(1, repeat * len(events) // (len(bodies) * 10))
+        cost = {"previous": cpu_per_event(previous_parse, bodies, passes)}
+        for name, parser in parsers.items():
+            cost[name] = cpu_per_event(lambda body, p=parser: lean_parse(p, body), bodies, passes)
+        print(f"{kind:<18}" + "".join(f"{cost[c] * 1e6:10.2f}" for c in columns))
+        if kind == "all":
+            valid_cost = cost
+
+    # Bodies that aren't callbacks; the previous code raised on most of them
+    big = b'{"header": {"token": "x"}, "pad": "' + b"x" * (2 * 1024 * 1024) + b'"}'
+    bad = {
+        "wrong token": json.dumps(message_event("om_forged", token="forged-token")).encode(),
+        "malformed": b"<xml>not a callback</xml>" * 20,
+        "too large": big,
+    }
+    print(f"{'rejected':<18}" + "".join(f"{c:>10}" for c in columns))
+    for kind, body in bad.items():
+        passes = max(1, repeat // 20) if kind == "too large" else repeat * 5
+        cost = {"previous": cpu_per_event(rejected(previous_parse), [body], max(1, passes // 50))}
+        for name, parser in parsers.items():
+            cost[name] = cpu_per_event(rejected(parser.parse), [body], passes)
+        print(f"{kind:<18}" + "".join(f"{cost[c] * 1e6:10.2f}" for c in columns))
+        ok = ok and all(cost[name] <= valid_cost[name] for name in parsers)
+    print(f"parse         same fields as before, rejections cheaper than a parse {'OK' if ok else 'FAILED'}")
+    return ok
+
+
+def raw_request(port, head, body=b""):
+    """:return: HTTP status of a hand-written request, None if the connection broke"""
+    with socket.create_connection(("127.0.0.1", port), timeout=5) as sock:
+        sock.sendall(head.encode("latin-1") + b"\r\n\r\n" + body)
+        try:
+            status_line = sock.makefile("rb").readline().decode("latin-1")
+        except OSError:
+            return None
+    parts = status_line.split()
+    return int(parts[1]) if len(parts) > 1 and parts[1].isdigit() else None
+
+
+def bad_requests():
+    """:return: (name, request head, body, expected status)"""
+    verification = json.dumps({"type": "url_verification", "token": VERIFICATION_TOKEN,
+                               "challenge": "c"}).encode()
+    forged = json.dumps(message_event("om_forged", token="forged-token")).encode()
+    truncated = verification[:-10]
+    post = "POST / HTTP/1.1\r\nHost: bot\r\nContent-Type: application/json\r\nConnection: close"
+    return [
+        ("url verification", f"{post}\r\nContent-Length: {len(verification)}", verification, 200),
+        ("no content-length", post, verification, 411),
+        ("bad content-length", f"{post}\r\nContent-Length: many", verification, 400),
+        ("chunked", f"{post}\r\nTransfer-Encoding: chunked", b"0\r\n\r\n", 411),
+        ("body too large", f"{post}\r\nContent-Length: {64 * 1024 * 1024}", b"", 413),
+        ("malformed", f"{post}\r\nContent-Length: 9", b"not json!", 400),
+        ("truncated JSON", f"{post}\r\nContent-Length: {len(truncated)}", truncated, 400),
+        ("wrong token", f"{post}\r\nContent-Length: {len(forged)}", forged, 200),
+        ("long request line", "GET /" + "x" * 70000 + " HTTP/1.1\r\nHost: bot", b"", 414),
+        ("long header", f"{post}\r\nX-Pad: {'x' * 70000}", b"", 431),
+        ("too many headers", post + "".join(f"\r\nX-Pad-{i}: x" for i in range(120)), b"", 431),
+    ]
+
+
+def check_servers(bot):
+    """:return: True if both server modes answer every bad request with its status"""
+    from async_server import AsyncWebhookServer
+
+    class QuietHandler(bot.RequestHandler):
+        def log_message(self, *args):
+            pass
+
+    httpd = HTTPServer(("127.0.0.1", 0), QuietHandler)
+    start_thread(httpd.serve_forever)
+
+    loop = asyncio.new_event_loop()
+    server = AsyncWebhookServer(bot.APP_VERIFICATION_TOKEN, lambda message: None,
+                                is_duplicate=bot.is_duplicate_event, host="127.0.0.1", port=0,
+                                loads=bot.webhook_parser.loads)
+    ready = threading.Event()
+
+    def serve():
+        asyncio.set_event_loop(loop)
+        loop.run_until_complete(server.start())
+        ready.set()
+        loop.run_until_complete(server.serve_forever())
+
+    threading.Thread(target=serve, daemon=True).start()
+    ready.wait()
+
+    ok = True
+    try:
+        for mode, port in (("threaded", httpd.server_address[1]), ("asyncio", server.port)):
+            results = []
+            for name, head, body, expected in bad_requests():
+                status = raw_request(port, head, body)
+                ok = ok and status == expected
+                results.append(f"{name}={status}" + ("" if status == expected else f"(expected {expected})"))
+            print(f"{mode:<9} " + " ".join(results))
+    finally:
+        httpd.shutdown()
+        httpd.server_close()
+        server.request_stop()
+    print(f"ingress       bad requests answered with their status in both modes {'OK' if ok else 'FAILED'}")
+    return ok
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--events", help="recorded callbacks, one JSON body per line")
+    parser.add_argument("--repeat", type=int, default=2000, help="passes over the events")
+    args = parser.parse_args()
+
+    bot = import_bot("bot_v2")
+    events = recorded_events(args.events) if args.events else synthetic_events()
+    checks = [measure(events, args.repeat), check_servers(bot)]
+    if not all(checks):
+        raise SystemExit("FAILED: see the checks above")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,145 @@
+"""
+A local stand-in for the Dialogflow ES Sessions gRPC service.
+
+It answers DetectIntent with a canned response after a configurable
+latency (optionally with a slow tail), and fails a configurable fraction
+of the calls with a gRPC error,
+so the helper can be benchmarked without network access or a GCP project.
+Like Google's front ends, it can cap the concurrent calls of a connection,
+and it counts the connections its calls came in on.
+"""
+
+import random
+import threading
+import time
+from concurrent import futures
+
+import grpc
+from google.cloud import dialogflow_v2 as dialogflow
+from google.cloud.dialogflow_v2.services.sessions.transports import (
+    SessionsGrpcAsyncIOTransport,
+    SessionsGrpcTransport,
+)
+from google.auth.credentials import AnonymousCredentials
+
+SERVICE = "google.cloud.dialogflow.v2.Sessions"
+
+
+def sessions_client(address, options=None):
+    """
+    A SessionsClient talking to a fake at `address` (e.g. from another process).
+
+    :param options: Optional channel options, e.g. channel_pool.channel_options()
+    """
+    channel = grpc.insecure_channel(address, options=options)
+    transport = SessionsGrpcTransport(credentials=AnonymousCredentials(), channel=channel)
+    return dialogflow.SessionsClient(transport=transport)
+
+
+def async_sessions_client(address, options=None):
+    """A SessionsAsyncClient talking to a fake at `address`; call it on the event loop that will use it."""
+    channel = grpc.aio.insecure_channel(address, options=options)
+    transport = SessionsGrpcAsyncIOTransport(credentials=AnonymousCredentials(), channel=channel)
+    return dialogflow.SessionsAsyncClient(transport=transport)
+
+
+class FakeSessions:
+    """
+    The fake service. Start it with start(), point clients at `address`.
+    """
+
+    def __init__(self, latency=0.05, jitter=0.0, error_rate=0.0,
+                 error_code=grpc.StatusCode.UNAVAILABLE, max_workers=64, replies=1,
+                 slow_rate=0.0, slow_latency=1.0, max_streams=0):
+        """
+        :param latency: Seconds every DetectIntent call takes
+        :param jitter: Extra random latency, uniform in [0, jitter] seconds
+        :param error_rate: Fraction of calls failed with error_code
+        :param error_code: grpc.StatusCode of injected failures (UNAVAILABLE is
+                           retried by the client's default policy, INTERNAL is not)
+        :param max_workers: Server threads, i.e. calls handled concurrently
+        :param replies: Number of text fulfillment messages in every response
+        :param slow_rate: Fraction of calls taking slow_latency instead (a latency tail)
+        :param slow_latency: Seconds those calls take
+        :param max_streams: Concurrent calls per connection (HTTP/2
+                            SETTINGS_MAX_CONCURRENT_STREAMS), 0 for gRPC's default
+        """
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.error_code = error_code
+        self.max_workers = max_workers
+        self.replies = replies
+        self.slow_rate = slow_rate
+        self.slow_latency = slow_latency
+        self.max_streams = max_streams
+        self.calls = 0
+        # Client addresses the calls came from, i.e. the connections used
+        self.peers = set()
+        self._lock = threading.Lock()
+        self._server = None
+        self.address = None
+
+    def detect_intent(self, request, context):
+        with self._lock:
+            self.calls += 1
+            self.peers.add(context.peer())
+        if self.slow_rate and random.random() < self.slow_rate:
+            delay = self.slow_latency
+        else:
+            delay = self.latency + random.uniform(0, self.jitter)
+        if delay:
+            time.sleep(delay)
+        if self.error_rate and random.random() < self.error_rate:
+            context.abort(self.error_code, "injected failure")
+        return self.build_response(request)
+
+    def build_response(self, request):
+        text = request.query_input.text.text or request.query_input.event.name
+        if self.replies == 1:
+            texts = [f"echo: {text}"]
+        else:
+            texts = [f"echo: {text} ({i + 1}/{self.replies})" for i in range(self.replies)]
+        return dialogflow.DetectIntentResponse(
+            response_id=f"fake-{self.calls}",
+            query_result=dialogflow.QueryResult(
+                query_text=text,
+                language_code=request.query_input.text.language_code or "en",
+                fulfillment_text=texts[0],
+                fulfillment_messages=[
+                    dialogflow.Intent.Message(text=dialogflow.Intent.Message.Text(text=[t]))
+                    for t in texts
+                ],
+                intent=dialogflow.Intent(display_name="Echo"),
+                intent_detection_confidence=1.0,
+            ),
+        )
+
+    def start(self):
+        handler = grpc.method_handlers_generic_handler(SERVICE, {
+            "DetectIntent": grpc.unary_unary_rpc_method_handler(
+                self.detect_intent,
+                request_deserializer=dialogflow.DetectIntentRequest.deserialize,
+                response_serializer=dialogflow.DetectIntentResponse.serialize,
+            ),
+        })
+        options = [("grpc.max_concurrent_streams", self.max_streams)] if self.max_streams else None
+        self._server = grpc.server(futures.ThreadPoolExecutor(max_workers=self.max_workers),
+                                   options=options)
+        self._server.add_generic_rpc_handlers((handler,))
+        port = self._server.add_insecure_port("127.0.0.1:0")
+        self._server.start()
+        self.address = f"127.0.0.1:{port}"
+        return self
+
+    def stop(self):
+        if self._server is not None:
+            self._server.stop(grace=None)
+
+    def sessions_client(self, options=None):
+        """A SessionsClient talking to this fake over an insecure channel."""
+        return sessions_client(self.address, options)
+
+    def async_sessions_client(self, options=None):
+        """A SessionsAsyncClient talking to this fake; call it on the event loop that will use it."""
+        return async_sessions_client(self.address, options)
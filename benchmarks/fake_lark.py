@@ -0,0 +1,133 @@
+"""
+A local stand-in for the Lark Open API endpoints the bots call.
+
+It issues tenant_access_tokens and accepts send message calls after a
+configurable latency, failing a configurable fraction of the sends (with a
+5xx, or with Lark's rate limit code), and records every delivered message
+with its arrival time, so a benchmark can check what the bot sent and when.
+"""
+
+import json
+import random
+import threading
+import time
+from collections import defaultdict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+TOKEN_PATH = "/open-apis/auth/v3/tenant_access_token/internal/"
+SEND_PATH = "/open-apis/message/v4/send/"
+RATE_LIMIT_CODE = 99991400
+
+
+class FakeLark:
+    """
+    The fake Open API. Start it with start(), point clients at `base_url`.
+    """
+
+    def __init__(self, latency=0.0, jitter=0.0, error_rate=0.0, rate_limited=False, token_expire=7200):
+        """
+        :param latency: Seconds every send call takes
+        :param jitter: Extra random latency, uniform in [0, jitter] seconds
+        :param error_rate: Fraction of sends that fail
+        :param rate_limited: Fail them with code 99991400 (retried later by the
+                             send limiter) instead of HTTP 500 (retried by LarkClient)
+        :param token_expire: Lifetime of the issued tokens, in seconds
+        """
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.rate_limited = rate_limited
+        self.token_expire = token_expire
+        # chat_id -> [(arrival perf_counter, msg_type, content)]
+        self.received = defaultdict(list)
+        self.token_calls = 0
+        self.send_calls = 0
+        self.failures = 0
+        self._lock = threading.Lock()
+        self._cond = threading.Condition(self._lock)
+        self._httpd = None
+        self.base_url = None
+
+    def delivered(self):
+        """
+        :return: Number of messages delivered so far
+        """
+        with self._lock:
+            return sum(len(messages) for messages in self.received.values())
+
+    def wait_for(self, count, timeout):
+        """
+        Wait until `count` messages were delivered.
+
+        :return: True if they were, False on timeout
+        """
+        deadline = time.monotonic() + timeout
+        with self._cond:
+            while sum(len(messages) for messages in self.received.values()) < count:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return False
+                self._cond.wait(remaining)
+        return True
+
+    def reset(self):
+        with self._lock:
+            self.received.clear()
+            self.token_calls = self.send_calls = self.failures = 0
+
+    def start(self):
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+            disable_nagle_algorithm = True
+
+            def do_POST(self):
+                req = json.loads(self.rfile.read(int(self.headers.get("content-length", 0))) or b"{}")
+                status, rsp = fake.handle(self.path, req)
+                body = json.dumps(rsp).encode()
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self._httpd = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self._httpd.daemon_threads = True
+        threading.Thread(target=self._httpd.serve_forever, daemon=True).start()
+        self.base_url = f"http://127.0.0.1:{self._httpd.server_address[1]}"
+        return self
+
+    def stop(self):
+        if self._httpd is not None:
+            self._httpd.shutdown()
+            self._httpd.server_close()
+
+    def handle(self, path, req):
+        """
+        :return: (HTTP status, response dict) for one Open API call
+        """
+        if path.startswith(TOKEN_PATH):
+            with self._lock:
+                self.token_calls += 1
+            return 200, {"code": 0, "msg": "ok", "tenant_access_token": "t-fake", "expire": self.token_expire}
+        if not path.startswith(SEND_PATH):
+            return 404, {"code": 404, "msg": "not found"}
+
+        delay = self.latency + random.uniform(0, self.jitter)
+        if delay:
+            time.sleep(delay)
+        with self._cond:
+            self.send_calls += 1
+            if self.error_rate and random.random() < self.error_rate:
+                self.failures += 1
+                if self.rate_limited:
+                    return 200, {"code": RATE_LIMIT_CODE, "msg": "request trigger frequency limit"}
+                return 500, {"code": 1, "msg": "injected failure"}
+            content = req.get("card") if req.get("msg_type") == "interactive" else req.get("content")
+            self.received[req.get("chat_id", "")].append((time.perf_counter(), req.get("msg_type"), content))
+            self._cond.notify_all()
+        return 200, {"code": 0, "msg": "success", "data": {"message_id": f"om_fake_{self.send_calls}"}}
@@ -4,9 +4,10 @@
 from http.server import BaseHTTPRequestHandler, HTTPServer
 from os import path, environ
 import json
-from urllib import request, parse
 from dotenv import load_dotenv
-from dialogflow_helper import DialogflowHelper
+from dedup import create_deduplicator
+from lark_client import LarkClient
+from token_manager import TenantTokenManager, is_invalid_token
 
 # 加载 .env 文件中的环境变量
 load_dotenv()
@@ -18,15 +19,14 @@ DIALOGFLOW_PROJECT_ID = environ.get("DIALOGFLOW_PROJECT_ID")
 DIALOGFLOW_SESSION_ID = environ.get("DIALOGFLOW_SESSION_ID")
 language_code = "en"
 
+# APP_SECRET and APP_VERIFICATION_TOKEN are secrets, don't print them
 print("APP_ID =", APP_ID)
-print("APP_SECRET =", APP_SECRET)
-print("APP_VERIFICATION_TOKEN =", APP_VERIFICATION_TOKEN)
 print("DIALOGFLOW_PROJECT_ID =", DIALOGFLOW_PROJECT_ID)
 print("DIALOGFLOW_SESSION_ID =", DIALOGFLOW_SESSION_ID)
 
-df_helper = DialogflowHelper(DIALOGFLOW_PROJECT_ID, 
-                             DIALOGFLOW_SESSION_ID, 
-                             language_code)
+lark_client = LarkClient(base_url=environ.get("LARK_API_BASE", "https://open.feishu.cn"))
+token_manager = TenantTokenManager(APP_ID, APP_SECRET, client=lark_client)
+deduplicator = create_deduplicator("memory")
 
 class RequestHandler(BaseHTTPRequestHandler):
     def do_POST(self):
@@ -44,8 +44,13 @@ class RequestHandler(BaseHTTPRequestHandler):
 
         # 根据 type 处理不同类型事件
         event_type = obj.get("type", "") or obj.get("header", {}).get("event_type", "")
-        # event_id = obj.get("header", {}).get("event_id", "") # 字段判断事件唯一性
+        event_id = obj.get("header", {}).get("event_id", "") # 字段判断事件唯一性
         print("event_type =", event_type)
+        # 重复推送的事件直接返回，不再处理
+        if event_id and not deduplicator.claim(event_id, reason="event_id"):
+            print("[DUPLICATE] event_id =", event_id)
+            self.response("")
+            return
         if "url_verification" == event_type:  # 验证请求 URL 是否有效
             self.handle_request_url_verify(obj)
         elif "im.message.receive_v1" == event_type:  # 事件回调
@@ -101,53 +106,19 @@ class RequestHandler(BaseHTTPRequestHandler):
         # self.wfile.flush()
 
     def get_tenant_access_token(self):
-        url = "https://open.feishu.cn/open-apis/auth/v3/tenant_access_token/internal/"
-        headers = {
-            "Content-Type" : "application/json"
-        }
-        req_body = {
-            "app_id": APP_ID,
-            "app_secret": APP_SECRET
-        }
-
-        data = bytes(json.dumps(req_body), encoding='utf8')
-        req = request.Request(url=url, data=data, headers=headers, method='POST')
-        try:
-            response = request.urlopen(req)
-        except Exception as e:
-            print(e.read().decode())
-            return ""
-
-        rsp_body = response.read().decode('utf-8')
-        rsp_dict = json.loads(rsp_body)
-        code = rsp_dict.get("code", -1)
-        if code != 0:
-            print("get tenant_access_token error, code =", code)
-            return ""
-        return rsp_dict.get("tenant_access_token", "")
+        # 进程内共享的 tenant_access_token 缓存，过期前自动刷新
+        return token_manager.get()
 
     def send_message(self, token, chat_id, text):
-        url = "https://open.feishu.cn/open-apis/message/v4/send/"
-        headers = {
-            "Authorization": "Bearer " + token,
-            "Content-Type": "application/json"
-        }
-        req_body = {
-            "chat_id": chat_id,
-            "msg_type": "text",
-            "content": {
-                "text": text
-            }
-        }
-        
-        data = bytes(json.dumps(req_body), encoding='utf8')
-        req = request.Request(url=url, data=data, headers=headers, method='POST')
-        try:
-            response = request.urlopen(req)
-            rsp_body = response.read().decode('utf-8')
-            print("[RESPONSE]", rsp_body)
-        except Exception as e:
-            print(e.read().decode())
+        # 复用连接池中的长连接，带超时和退避重试
+        status, rsp_dict = lark_client.send_message(token, chat_id, text)
+        # token 失效时刷新缓存，并用新 token 重发一次
+        if is_invalid_token(status, rsp_dict):
+            token = token_manager.invalidate(token)
+            if token:
+                status, rsp_dict = lark_client.send_message(token, chat_id, text)
+        if rsp_dict.get("code", -1) != 0:
+            print("send message failed", status, rsp_dict)
 
 def run():
     port = 8000
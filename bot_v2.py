@@ -3,13 +3,31 @@
 
 from http.server import BaseHTTPRequestHandler, HTTPServer
 from os import path, environ
+import asyncio
+import logging
+import signal
+import sys
+import threading
+import time
 import json
-from urllib import request, parse
 from dotenv import load_dotenv
-import threading
-import redis
 
-from dialogflow_helper import DialogflowHelper
+from async_server import AsyncWebhookServer
+from worker_pool import WorkerPool
+from message_debouncer import MessageDebouncer
+from dedup import create_deduplicator
+from response_cache import IntentResponseCache
+from intent_matcher import IntentMatcher
+from lark_client import LarkClient
+from token_manager import TenantTokenManager, is_invalid_token
+from reply_pipeline import FALLBACK_TEXT, ReplySender, build_replies
+from resilience import CLOSED, HALF_OPEN, OPEN, CircuitBreaker, CircuitOpenError, HedgePolicy
+from rate_limiter import OutboundLimiter
+from event_queue import EventConsumer, RedisStreamQueue, SqliteEventQueue
+from prefork import WorkerLifetime
+from webhook_parser import MESSAGE_EVENT, InvalidCallback, WebhookParser, json_loads
+from metrics import CONTENT_TYPE, REGISTRY, Counter, Gauge, Histogram
+from structured_log import dropped as log_records_dropped, setup_logging
 
 # Load environment variables from .env
 load_dotenv()
@@ -21,187 +39,960 @@ DIALOGFLOW_PROJECT_ID = environ.get("DIALOGFLOW_PROJECT_ID")
 DIALOGFLOW_SESSION_ID = environ.get("DIALOGFLOW_SESSION_ID")
 language_code = "en"
 
-print("APP_ID =", APP_ID)
-print("APP_SECRET =", APP_SECRET)
-print("APP_VERIFICATION_TOKEN =", APP_VERIFICATION_TOKEN)
-print("DIALOGFLOW_PROJECT_ID =", DIALOGFLOW_PROJECT_ID)
-print("DIALOGFLOW_SESSION_ID =", DIALOGFLOW_SESSION_ID)
+# Per-chat Dialogflow sessions
+DIALOGFLOW_SESSION_TTL = int(environ.get("DIALOGFLOW_SESSION_TTL", "1200"))
+DIALOGFLOW_MAX_SESSIONS = int(environ.get("DIALOGFLOW_MAX_SESSIONS", "10000"))
+
+# Response cache for context-free intents: "off" (default), "memory" or "redis"
+DIALOGFLOW_CACHE = environ.get("DIALOGFLOW_CACHE", "off")
+DIALOGFLOW_CACHE_SIZE = int(environ.get("DIALOGFLOW_CACHE_SIZE", "1000"))
+DIALOGFLOW_CACHE_TTL = int(environ.get("DIALOGFLOW_CACHE_TTL", "300"))
+
+# In asyncio mode, call Dialogflow with the asyncio client instead of from executor threads
+DIALOGFLOW_ASYNC = environ.get("DIALOGFLOW_ASYNC", "false").lower() == "true"
+# Deadline of a Dialogflow call in seconds, retries included
+DIALOGFLOW_TIMEOUT = float(environ.get("DIALOGFLOW_TIMEOUT", "10"))
+# Hedged requests: a second detect_intent for a call slower than this
+# percentile of the recent ones (e.g. 95), 0 (default) to never hedge; at most
+# DIALOGFLOW_HEDGE_BUDGET extra calls per call
+DIALOGFLOW_HEDGE_PERCENTILE = float(environ.get("DIALOGFLOW_HEDGE_PERCENTILE", "0"))
+DIALOGFLOW_HEDGE_BUDGET = float(environ.get("DIALOGFLOW_HEDGE_BUDGET", "0.1"))
+# Circuit breaker: after this many consecutive failed calls (deadlines
+# included), Dialogflow isn't called for DIALOGFLOW_BREAKER_RESET seconds and
+# messages get the fallback reply; 0 to disable
+DIALOGFLOW_BREAKER_FAILURES = int(environ.get("DIALOGFLOW_BREAKER_FAILURES", "5"))
+DIALOGFLOW_BREAKER_RESET = float(environ.get("DIALOGFLOW_BREAKER_RESET", "30"))
+# Location of the agent, e.g. "europe-west1": calls go to its regional
+# endpoint and sessions live under it; "global" (default) for agents without one
+DIALOGFLOW_LOCATION = environ.get("DIALOGFLOW_LOCATION", "global")
+# gRPC channels (each its own HTTP/2 connection) Dialogflow calls are spread
+# over, "round_robin" or to the "least_loaded" one
+DIALOGFLOW_CHANNELS = int(environ.get("DIALOGFLOW_CHANNELS", "1"))
+DIALOGFLOW_CHANNEL_POLICY = environ.get("DIALOGFLOW_CHANNEL_POLICY", "round_robin")
+# Keepalive pings on idle channels, so the next message doesn't reconnect; 0 to disable
+DIALOGFLOW_KEEPALIVE_MS = int(environ.get("DIALOGFLOW_KEEPALIVE_MS", "60000"))
+
+# Local fast path: answer the static intents of an exported ES agent (zip or
+# directory) in-process; empty (default) to always ask Dialogflow
+INTENT_MATCHER_AGENT = environ.get("INTENT_MATCHER_AGENT", "")
+INTENT_MATCHER_THRESHOLD = float(environ.get("INTENT_MATCHER_THRESHOLD", "0.85"))
+# Seconds between checks for an updated export, 0 to load it once
+INTENT_MATCHER_RELOAD = float(environ.get("INTENT_MATCHER_RELOAD", "30"))
+
+# Ingress mode: "threaded" (default) or "asyncio"
+SERVER_MODE = environ.get("SERVER_MODE", "threaded")
+SERVER_PORT = int(environ.get("SERVER_PORT", "8000"))
+
+# Multi-process mode (see prefork.py, which sets WORKER_INDEX for every worker)
+SERVER_WORKERS = int(environ.get("SERVER_WORKERS", "1"))
+WORKER_INDEX = int(environ["WORKER_INDEX"]) if environ.get("WORKER_INDEX") else None
+WORKER_MAX_REQUESTS = int(environ.get("WORKER_MAX_REQUESTS", "0"))
+WORKER_MAX_RSS_MB = int(environ.get("WORKER_MAX_RSS_MB", "0"))
+ASYNC_WORKERS = int(environ.get("ASYNC_WORKERS", "16"))
+# Largest callback body accepted, in bytes; larger ones get 413 unread
+WEBHOOK_MAX_BODY = int(environ.get("WEBHOOK_MAX_BODY", str(1024 * 1024)))
+# JSON decoder of callbacks and message contents: "auto" (default, orjson if
+# installed), "orjson" or "json"
+WEBHOOK_JSON = environ.get("WEBHOOK_JSON", "auto")
+
+# Worker pool for the threaded mode
+WORKER_POOL_SIZE = int(environ.get("WORKER_POOL_SIZE", "16"))
+WORKER_QUEUE_SIZE = int(environ.get("WORKER_QUEUE_SIZE", "1000"))
+WORKER_OVERFLOW = environ.get("WORKER_OVERFLOW", "drop")  # drop | busy | spill
+WORKER_SPILL_PATH = environ.get("WORKER_SPILL_PATH", "spill.jsonl")
+BUSY_REPLY_TEXT = "I'm a bit busy right now, please try again in a moment."
+
+# Merge a burst of text messages from one sender ("hi" / "I need" / "help with
+# my order") into one Dialogflow call and one reply: milliseconds of silence
+# ending a burst, 0 (default) to handle every message on its own
+DEBOUNCE_WINDOW_MS = int(environ.get("DEBOUNCE_WINDOW_MS", "0"))
+# Cap on the latency added to the first message of a burst, and on its size
+DEBOUNCE_MAX_DELAY_MS = int(environ.get("DEBOUNCE_MAX_DELAY_MS", "2000"))
+DEBOUNCE_MAX_MESSAGES = int(environ.get("DEBOUNCE_MAX_MESSAGES", "5"))
+
+# Share the tenant_access_token between processes through Redis
+TOKEN_SHARED_REDIS = environ.get("TOKEN_SHARED_REDIS", "false").lower() == "true"
+# Seconds allowed to connect to Redis and to wait for a reply; keep the reply
+# timeout above the event queue's 1s blocking read
+REDIS_CONNECT_TIMEOUT = float(environ.get("REDIS_CONNECT_TIMEOUT", "1"))
+REDIS_TIMEOUT = float(environ.get("REDIS_TIMEOUT", "5"))
+
+# Message dedup backend: "redis" (default), "sqlite" or "memory"
+DEDUP_BACKEND = environ.get("DEDUP_BACKEND", "redis")
+DEDUP_SQLITE_PATH = environ.get("DEDUP_SQLITE_PATH", "dedup.sqlite3")
+
+# Durable event queue: "auto" (default, Redis Streams if Redis answers, else
+# SQLite), "redis", "sqlite" or "off" (in-memory only)
+EVENT_QUEUE = environ.get("EVENT_QUEUE", "auto")
+EVENT_QUEUE_PATH = environ.get("EVENT_QUEUE_PATH", "events.sqlite3")
+EVENT_QUEUE_VISIBILITY = int(environ.get("EVENT_QUEUE_VISIBILITY", "120"))
+# Queue messages claimed and not acked yet; keep it well under what the
+# workers handle in EVENT_QUEUE_VISIBILITY seconds
+EVENT_QUEUE_MAX_INFLIGHT = int(environ.get("EVENT_QUEUE_MAX_INFLIGHT", "200"))
+SHUTDOWN_TIMEOUT = float(environ.get("SHUTDOWN_TIMEOUT", "30"))
+
+# Lark Open API client
+LARK_API_BASE = environ.get("LARK_API_BASE", "https://open.feishu.cn")
+LARK_POOL_SIZE = int(environ.get("LARK_POOL_SIZE", "16"))
+LARK_CONNECT_TIMEOUT = float(environ.get("LARK_CONNECT_TIMEOUT", "3"))
+LARK_READ_TIMEOUT = float(environ.get("LARK_READ_TIMEOUT", "10"))
+
+# Open API send limits (per app and per chat), and merging of queued replies
+LARK_SEND_RATE = float(environ.get("LARK_SEND_RATE", "50"))
+LARK_CHAT_SEND_RATE = float(environ.get("LARK_CHAT_SEND_RATE", "5"))
+LARK_SEND_COALESCE = environ.get("LARK_SEND_COALESCE", "false").lower() == "true"
+# Threads sending queued messages
+LARK_SEND_WORKERS = int(environ.get("LARK_SEND_WORKERS", "4"))
+
+# Threads sending the 2nd, 3rd, ... reply of multi-message fulfillments
+REPLY_WORKERS = int(environ.get("REPLY_WORKERS", "8"))
+
+# Logs are written by a background thread: "json" (one object per line) or "text"
+LOG_LEVEL = environ.get("LOG_LEVEL", "INFO")
+LOG_FORMAT = environ.get("LOG_FORMAT", "json")
+
+setup_logging(LOG_LEVEL, LOG_FORMAT)
+logger = logging.getLogger("bot")
+
+# No secrets (APP_SECRET, APP_VERIFICATION_TOKEN) in the logs
+logger.info("config", extra={"app_id": APP_ID,
+                             "dialogflow_project_id": DIALOGFLOW_PROJECT_ID,
+                             "dialogflow_session_id": DIALOGFLOW_SESSION_ID})
+
+# Metrics, served on GET /metrics
+ACK_SECONDS = Histogram("bot_ack_seconds", "Time to acknowledge a Lark event callback")
+DEDUP_SECONDS = Histogram("bot_dedup_seconds", "Time to claim an event in the dedup store")
+TOKEN_SECONDS = Histogram("bot_token_seconds", "Time to get the tenant_access_token")
+DETECT_INTENT_SECONDS = Histogram("bot_detect_intent_seconds", "Dialogflow detect_intent latency")
+SEND_SECONDS = Histogram("bot_send_seconds", "Lark send message latency")
+EVENTS = Counter("bot_events_total", "Lark event callbacks received", ["event_type"])
+DUPLICATES = Counter("bot_duplicates_total", "Duplicate events dropped at ingress or redelivered by the event queue", ["reason"])
+ERRORS = Counter("bot_errors_total", "Errors by stage", ["stage"])
+LOCAL_MATCHES = Counter("bot_intent_matcher_total", "Queries seen by the local intent matcher",
+                        ["result"])
+DEBOUNCED_MESSAGES = Counter("bot_debounce_messages_total", "Text messages flushed by the debounce window")
+DEBOUNCED_BATCHES = Counter("bot_debounce_batches_total",
+                            "Merged messages (Dialogflow calls) flushed by the debounce window")
+DEBOUNCE_DELAY_SECONDS = Histogram("bot_debounce_delay_seconds", "Latency added by the debounce window")
+SHORT_CIRCUITS = Counter("bot_dialogflow_short_circuits_total",
+                         "Messages answered with the fallback reply while the circuit breaker was open")
+MESSAGES_IN_FLIGHT = Gauge("bot_messages_in_flight", "Messages between Dialogflow and their first reply")
+
+def create_redis_client():
+    """:return: redis.Redis for the local server"""
+    # Imported here: it takes a while and many deployments don't need it
+    import redis
+    # Connects on the first command
+    return redis.Redis(host="127.0.0.1", port=6379, decode_responses=True,
+                       socket_connect_timeout=REDIS_CONNECT_TIMEOUT,
+                       socket_timeout=REDIS_TIMEOUT)
+
+# Features set up at import that use Redis; the event queue connects after the bind
+redis_client = (create_redis_client()
+                if DEDUP_BACKEND == "redis" or TOKEN_SHARED_REDIS or DIALOGFLOW_CACHE == "redis"
+                else None)
+
+def create_response_cache():
+    if DIALOGFLOW_CACHE == "off":
+        return None
+    return IntentResponseCache(max_size=DIALOGFLOW_CACHE_SIZE,
+                               ttl=DIALOGFLOW_CACHE_TTL,
+                               redis_client=redis_client if DIALOGFLOW_CACHE == "redis" else None)
+
+response_cache = create_response_cache()
+
+def create_intent_matcher():
+    if not INTENT_MATCHER_AGENT:
+        return None
+    return IntentMatcher(INTENT_MATCHER_AGENT,
+                         language_code,
+                         threshold=INTENT_MATCHER_THRESHOLD,
+                         reload_interval=INTENT_MATCHER_RELOAD,
+                         max_sessions=DIALOGFLOW_MAX_SESSIONS)
+
+intent_matcher = create_intent_matcher()
+
+# Shared by both helpers, so the sync and asyncio paths see the same failures
+dialogflow_breaker = (CircuitBreaker(DIALOGFLOW_BREAKER_FAILURES, DIALOGFLOW_BREAKER_RESET)
+                      if DIALOGFLOW_BREAKER_FAILURES > 0 else None)
+dialogflow_hedge = (HedgePolicy(DIALOGFLOW_HEDGE_PERCENTILE,
+                                max_delay=DIALOGFLOW_TIMEOUT / 2,
+                                budget=DIALOGFLOW_HEDGE_BUDGET)
+                    if DIALOGFLOW_HEDGE_PERCENTILE > 0 else None)
+
+# The Dialogflow SDK (grpc, protobuf, credential discovery) takes most of the
+# startup time, so the helpers are created by warm_up_dialogflow() once the
+# server is bound; callbacks are acked in the meantime
+df_helper = None
+async_df_helper = None
+dialogflow_created = threading.Event()
+dialogflow_ready = threading.Event()
+dialogflow_error = None
+
+def create_dialogflow_helpers():
+    """:return: (DialogflowHelper, AsyncDialogflowHelper or None)"""
+    from channel_pool import channel_options, create_async_sessions_client, create_client_pool
+    from dialogflow_helper import DialogflowHelper
+
+    helper = DialogflowHelper(DIALOGFLOW_PROJECT_ID,
+                              DIALOGFLOW_SESSION_ID,
+                              language_code,
+                              session_ttl=DIALOGFLOW_SESSION_TTL,
+                              max_sessions=DIALOGFLOW_MAX_SESSIONS,
+                              response_cache=response_cache,
+                              timeout=DIALOGFLOW_TIMEOUT,
+                              breaker=dialogflow_breaker,
+                              hedge=dialogflow_hedge,
+                              location=DIALOGFLOW_LOCATION,
+                              client_pool=create_client_pool(DIALOGFLOW_CHANNELS,
+                                                             DIALOGFLOW_LOCATION,
+                                                             DIALOGFLOW_KEEPALIVE_MS,
+                                                             DIALOGFLOW_CHANNEL_POLICY))
+    if not DIALOGFLOW_ASYNC:
+        return helper, None
+
+    from async_dialogflow_helper import AsyncDialogflowHelper
+
+    options = channel_options(DIALOGFLOW_KEEPALIVE_MS, separate=DIALOGFLOW_CHANNELS > 1)
+
+    # Its clients are created on the event loop by the first call
+    async_helper = AsyncDialogflowHelper(DIALOGFLOW_PROJECT_ID,
+                                         DIALOGFLOW_SESSION_ID,
+                                         language_code,
+                                         session_ttl=DIALOGFLOW_SESSION_TTL,
+                                         max_sessions=DIALOGFLOW_MAX_SESSIONS,
+                                         response_cache=response_cache,
+                                         timeout=DIALOGFLOW_TIMEOUT,
+                                         breaker=dialogflow_breaker,
+                                         hedge=dialogflow_hedge,
+                                         location=DIALOGFLOW_LOCATION,
+                                         client_factory=lambda: create_async_sessions_client(
+                                             DIALOGFLOW_LOCATION, options),
+                                         pool_size=DIALOGFLOW_CHANNELS,
+                                         pool_policy=DIALOGFLOW_CHANNEL_POLICY)
+    return helper, async_helper
+
+def warm_up_dialogflow():
+    """
+    Create the Dialogflow helpers and connect their channels, then flip
+    GET /ready. Runs in the background, started once the server is bound.
+    """
+    global df_helper, async_df_helper, dialogflow_error
+    started = time.monotonic()
+    try:
+        df_helper, async_df_helper = create_dialogflow_helpers()
+    except Exception as e:
+        dialogflow_error = e
+        ERRORS.labels("startup").inc()
+        logger.exception("Dialogflow client creation failed")
+        return
+    finally:
+        dialogflow_created.set()
+
+    import grpc
+
+    for channel in df_helper.clients.channels():
+        while True:
+            try:
+                grpc.channel_ready_future(channel).result(timeout=DIALOGFLOW_TIMEOUT)
+                break
+            except grpc.FutureTimeoutError:
+                # Not ready yet (network, DNS): keep trying, /ready stays 503
+                logger.warning("Dialogflow channel not ready after %ss, retrying", DIALOGFLOW_TIMEOUT)
+    dialogflow_ready.set()
+    logger.info("ready", extra={"startup_seconds": round(time.monotonic() - started, 3)})
+
+def start_warm_up():
+    """Once the server is bound: open the event queue and connect Dialogflow."""
+    threading.Thread(target=open_event_queue, name="event-queue", daemon=True).start()
+    threading.Thread(target=warm_up_dialogflow, name="warm-up", daemon=True).start()
+
+def get_df_helper():
+    """:return: The DialogflowHelper, once warm_up_dialogflow() created it"""
+    if df_helper is None:
+        dialogflow_created.wait()
+        if df_helper is None:
+            raise RuntimeError(f"Dialogflow client unavailable: {dialogflow_error!r}")
+    return df_helper
+
+
+# Shared keep-alive client for the Lark Open API. Throttled sends are
+# retried by the outbound limiter, not by sleeping in the client
+lark_client = LarkClient(base_url=LARK_API_BASE,
+                         pool_size=LARK_POOL_SIZE,
+                         connect_timeout=LARK_CONNECT_TIMEOUT,
+                         read_timeout=LARK_READ_TIMEOUT,
+                         retry_throttled=False)
+
+# Process-wide tenant_access_token cache
+token_manager = TenantTokenManager(APP_ID, APP_SECRET,
+                                   client=lark_client,
+                                   redis_client=redis_client if TOKEN_SHARED_REDIS else None)
 
-df_helper = DialogflowHelper(DIALOGFLOW_PROJECT_ID, 
-                             DIALOGFLOW_SESSION_ID, 
-                             language_code)
+# Callback parsing of both server modes
+webhook_parser = WebhookParser(APP_VERIFICATION_TOKEN,
+                               max_body=WEBHOOK_MAX_BODY,
+                               loads=json_loads(WEBHOOK_JSON))
 
-# Redis client
-redis_client = redis.Redis(host="127.0.0.1", port=6379, decode_responses=True)
+# Exactly-once claim of message_ids (Redis, SQLite or in-memory)
+deduplicator = create_deduplicator(DEDUP_BACKEND,
+                                   redis_client=redis_client,
+                                   sqlite_path=DEDUP_SQLITE_PATH)
 
 # Check if message_id already processed
-def is_message_processed(message_id: str, expiration_seconds=43200) -> bool:
-    """
-    Returns True if message_id already processed (exists in Redis),
-    else sets it in Redis and returns False.
-    """
-    if not message_id:
-        return True
-    
-    # If key already exists => duplicated message
-    if redis_client.exists(message_id):
-        return True
-    
-    # If not exists => set it, with a 12 hour (43200s) expiration
-    redis_client.setex(message_id, expiration_seconds, "processed")
-    return False
+def is_message_processed(message_id: str) -> bool:
+    """
+    Returns True if message_id already processed, else claims it (a single
+    atomic SET NX in Redis) and returns False.
+    """
+    return not deduplicator.claim(message_id)
+
+def event_dedup_key(event):
+    """
+    :return: (dedup key, reason) of a message callback. Lark resends an event
+             with the same header.event_id until it is acked; v1 callbacks
+             have no event_id, so fall back to the message_id.
+    """
+    if event.event_id:
+        return "event:" + event.event_id, "event_id"
+    return event.message.get("message_id", ""), "message_id"
+
+def is_duplicate_event(event) -> bool:
+    """
+    Ingress dedup, run before the message is decoded or queued.
+
+    :param event: CallbackEvent of a message
+    """
+    event_id = event.event_id
+    key, reason = event_dedup_key(event)
+    with DEDUP_SECONDS.time():
+        duplicate = not deduplicator.claim(key, reason=reason)
+    if duplicate:
+        DUPLICATES.labels(reason).inc()
+        logger.info("duplicate event dropped", extra={"event_id": event_id, "reason": reason})
+    return duplicate
+
+def forget_event(event):
+    """
+    Undo the ingress claim of a message that could not be queued, so Lark's
+    retry of it (after the 5xx we answer) is not dropped as a duplicate.
+    """
+    deduplicator.release(event_dedup_key(event)[0])
+
+def get_tenant_access_token():
+    with TOKEN_SECONDS.time():
+        token = token_manager.get()
+    if token == "":
+        ERRORS.labels("token").inc()
+        logger.error("get tenant_access_token failed")
+    return token
+
+def send_lark_message(chat_id, msg_type, content):
+    """
+    Send one message of any type right away, with the current token.
+
+    :return: (HTTP status, response dict)
+    """
+    token = get_tenant_access_token()
+    if token == "":
+        return 0, {"code": -1, "msg": "no tenant_access_token"}
+
+    # Retry once with a fresh token if the cached one was rejected
+    for attempt in range(2):
+        with SEND_SECONDS.time():
+            status, rsp_dict = lark_client.send(token, chat_id, msg_type, content)
+        if attempt == 0 and is_invalid_token(status, rsp_dict):
+            token = token_manager.invalidate(token)
+            if token:
+                continue
+        if rsp_dict.get("code", -1) != 0:
+            ERRORS.labels("send").inc()
+            logger.warning("send message failed", extra={"chat_id": chat_id, "status": status,
+                                                         "code": rsp_dict.get("code"), "error": rsp_dict.get("msg")})
+        else:
+            logger.debug("message sent", extra={"chat_id": chat_id, "msg_type": msg_type})
+        return status, rsp_dict
+
+# Every outgoing message goes through the per-app / per-chat send limits
+outbound = OutboundLimiter(send_lark_message,
+                           rate=LARK_SEND_RATE,
+                           chat_rate=LARK_CHAT_SEND_RATE,
+                           coalesce=LARK_SEND_COALESCE,
+                           workers=LARK_SEND_WORKERS)
+
+def send_message(chat_id, text) -> bool:
+    return outbound.send(chat_id, "text", {"text": text})
+
+def deliver_reply(chat_id, msg_type, content) -> bool:
+    """Send (or queue, when over the send limits) one reply of the reply pipeline."""
+    logger.debug("reply", extra={"chat_id": chat_id, "msg_type": msg_type})
+    return outbound.send(chat_id, msg_type, content)
+
+# Sends every fulfillment message as its own Lark message, in order per chat
+reply_sender = ReplySender(deliver_reply, workers=REPLY_WORKERS)
+
+def read_text_message(message, helper):
+    """
+    :return: (text, chat_id, session_id) of a Lark text message, None for other types
+    """
+    msg_type = message.get("message_type", "")
+    if msg_type != "text":
+        logger.info("unknown msg_type", extra={"msg_type": msg_type})
+        return None
+
+    # Lark's retries were dropped at ingress (is_duplicate_event), queue
+    # redeliveries by handle_queued()
+    content = webhook_parser.content(message)
+    text = content.get("text", "")
+    chat_id = message.get("chat_id", "")
+    sender_id = message.get("sender", {}).get("sender_id", {}).get("open_id", "")
+
+    # Every chat (and every user of a group chat) has its own Dialogflow session
+    session_id = helper.session_for(chat_id, sender_id, message.get("chat_type", "p2p"))
+
+    logger.info("message received", extra={"chat_id": chat_id, "message_id": message.get("message_id", "")})
+    logger.debug("message text", extra={"chat_id": chat_id, "text": text})
+    return text, chat_id, session_id
+
+def send_replies(chat_id, response, started):
+    """Send every fulfillment message of a DetectIntentResponse to the chat."""
+    helper = get_df_helper()
+    fulfillment_text = helper.get_fulfillment_text(response)
+    replies = build_replies(helper.iter_fulfillment_messages(response),
+                            fallback_text=fulfillment_text or FALLBACK_TEXT)
+
+    # The first reply goes out from this thread, the rest in the background
+    reply_sender.submit(chat_id, replies, started=started)
+
+def match_locally(text, session_id):
+    """
+    :return: Replies from the local intent matcher, or None to ask Dialogflow
+    """
+    if intent_matcher is None:
+        return None
+    match = intent_matcher.match(text, session_id)
+    if match is None:
+        LOCAL_MATCHES.labels("miss").inc()
+        return None
+    LOCAL_MATCHES.labels(match.method).inc()
+    logger.debug("answered locally", extra={"intent": match.intent, "confidence": round(match.confidence, 3)})
+    return build_replies(match.messages)
+
+def short_circuit_replies():
+    """
+    :return: Replies while the circuit breaker keeps Dialogflow out of the
+             path: the fallback text, right away rather than after a deadline
+    """
+    SHORT_CIRCUITS.inc()
+    return build_replies(())
+
+def observe_response(session_id, response):
+    """Let the local intent matcher know whether Dialogflow left contexts active."""
+    if intent_matcher is not None:
+        intent_matcher.observe(session_id, response)
+
+def handle_message(message):
+    """
+    Handle a single Lark text message:
+      - sending user message to Dialogflow
+      - getting back the result
+      - sending every fulfillment message (text, cards, Lark payloads)
+        to the user, the first one as soon as it is ready
+
+    Runs off the request path, either on a worker pool thread (threaded mode)
+    or in the asyncio pipeline's executor (asyncio mode).
+    """
+    started = time.monotonic()
+    helper = get_df_helper()
+    parsed = read_text_message(message, helper)
+    if parsed is None:
+        return
+    text, chat_id, session_id = parsed
+
+    # Static intents ("hi", FAQs) may be answered without Dialogflow
+    replies = match_locally(text, session_id)
+    if replies is not None:
+        reply_sender.submit(chat_id, replies, started=started)
+        return
+
+    MESSAGES_IN_FLIGHT.inc()
+    try:
+        # Pass the user message to Dialogflow
+        try:
+            with DETECT_INTENT_SECONDS.time():
+                single_response = helper._detect_intent_text(text, session_id)
+        except CircuitOpenError:
+            reply_sender.submit(chat_id, short_circuit_replies(), started=started)
+            return
+        except Exception:
+            ERRORS.labels("detect_intent").inc()
+            raise
+        observe_response(session_id, single_response)
+        send_replies(chat_id, single_response, started)
+    finally:
+        MESSAGES_IN_FLIGHT.dec()
+
+async def handle_message_async(message):
+    """
+    handle_message for the asyncio pipeline with DIALOGFLOW_ASYNC: the
+    Dialogflow call is awaited on the event loop, only the blocking Open
+    API calls (token, first reply) run in the default executor.
+    """
+    started = time.monotonic()
+    loop = asyncio.get_running_loop()
+    if not dialogflow_created.is_set():
+        await loop.run_in_executor(None, dialogflow_created.wait)
+    if async_df_helper is None:
+        raise RuntimeError(f"Dialogflow client unavailable: {dialogflow_error!r}")
+    parsed = read_text_message(message, async_df_helper)
+    if parsed is None:
+        return
+    text, chat_id, session_id = parsed
+
+    replies = match_locally(text, session_id)
+    if replies is not None:
+        await loop.run_in_executor(None, reply_sender.submit, chat_id, replies, started)
+        return
+
+    MESSAGES_IN_FLIGHT.inc()
+    try:
+        try:
+            with DETECT_INTENT_SECONDS.time():
+                single_response = await async_df_helper.detect_intent(text, session_id)
+        except CircuitOpenError:
+            await loop.run_in_executor(None, reply_sender.submit, chat_id, short_circuit_replies(), started)
+            return
+        except Exception:
+            ERRORS.labels("detect_intent").inc()
+            raise
+        observe_response(session_id, single_response)
+        await loop.run_in_executor(None, send_replies, chat_id, single_response, started)
+    finally:
+        MESSAGES_IN_FLIGHT.dec()
+
+def reply_busy(message):
+    """Overflow handler for the worker pool: tell the user to retry later."""
+    send_message(message.get("chat_id", ""), BUSY_REPLY_TEXT)
+
+def claim_queued(message) -> bool:
+    """
+    Claim the message_ids of a durable queue message (and of the earlier
+    messages merged into it) before it is handled. The queue delivers at
+    least once: an entry is delivered again when the process died, or its
+    claim timed out, before the ack. A burst whose messages were all claimed
+    by an earlier delivery was already sent to Dialogflow, so it is only
+    acked; a crash between the claim and the reply loses that reply rather
+    than sending it twice.
+
+    :return: True if the message should be handled
+    """
+    claimed = [deduplicator.claim("msg:" + m["message_id"], reason="redelivered")
+               for m in [*message.get("merged", ()), message] if m.get("message_id")]
+    if claimed and not any(claimed):
+        DUPLICATES.labels("redelivered").inc()
+        logger.info("redelivered message dropped", extra={"message_id": message["message_id"]})
+        return False
+    return True
+
+def handle_queued(message):
+    """Handle a message, then ack its durable queue entry (if it came from one)."""
+    try:
+        if message.get("queue_id") is None or claim_queued(message):
+            handle_message(message)
+    finally:
+        if event_consumer is not None:
+            # A merged burst also acks the entries of its earlier messages
+            for original in message.get("merged", ()):
+                event_consumer.done(original)
+            event_consumer.done(message)
+
+def observe_debounce(count, delays):
+    DEBOUNCED_MESSAGES.inc(count)
+    DEBOUNCED_BATCHES.inc()
+    for delay in delays:
+        DEBOUNCE_DELAY_SECONDS.observe(delay)
+
+def chat_key(message):
+    """
+    Ordering key of a message: messages of one chat are handled one at a
+    time and in order, different chats in parallel.
+    """
+    return message.get("chat_id", "")
+
+# Bounded pool that handles text messages in the threaded mode
+worker_pool = WorkerPool(handle_queued,
+                         workers=WORKER_POOL_SIZE,
+                         max_queue=WORKER_QUEUE_SIZE,
+                         overflow=WORKER_OVERFLOW,
+                         on_busy=reply_busy,
+                         spill_path=WORKER_SPILL_PATH,
+                         key=chat_key)
+
+def submit_to_pool(message):
+    """
+    Queue a message for the worker pool. Durable queue entries are refused
+    when the pool is full rather than dropped, answered or spilled by
+    WORKER_OVERFLOW: the consumer offers them again, in order, and only it acks them.
+    """
+    if message.get("queue_id") is not None:
+        return worker_pool.offer(message)
+    return worker_pool.submit(message)
+
+def release_message(message):
+    """
+    A message the pipeline refused after the durable queue consumer handed
+    it over: give its entry back unacked, so it is delivered again.
+    """
+    if event_consumer is not None:
+        event_consumer.release(message)
+
+def create_debouncer():
+    if DEBOUNCE_WINDOW_MS <= 0:
+        return None
+    return MessageDebouncer(submit_to_pool,
+                            window=DEBOUNCE_WINDOW_MS / 1000.0,
+                            max_delay=DEBOUNCE_MAX_DELAY_MS / 1000.0,
+                            max_messages=DEBOUNCE_MAX_MESSAGES,
+                            on_flush=observe_debounce,
+                            on_reject=release_message)
+
+# Holds the text messages of a sender for DEBOUNCE_WINDOW_MS before they reach
+# the worker pool, and merges the ones sent in a burst
+debouncer = create_debouncer()
+submit_message = debouncer.submit if debouncer is not None else submit_to_pool
+
+def create_event_queue():
+    if EVENT_QUEUE == "off":
+        return None
+    if EVENT_QUEUE in ("auto", "redis"):
+        import redis
+        client = redis_client or create_redis_client()
+        try:
+            # Bounded by REDIS_CONNECT_TIMEOUT when nothing listens
+            client.ping()
+            return RedisStreamQueue(client, visibility=EVENT_QUEUE_VISIBILITY,
+                                    partitions=SERVER_WORKERS, partition=WORKER_INDEX)
+        except redis.RedisError as e:
+            if EVENT_QUEUE == "redis":
+                raise
+            logger.warning("Redis unavailable, using the SQLite event queue: %r", e)
+    # With several workers, each one handles the chats of its own partition
+    return SqliteEventQueue(EVENT_QUEUE_PATH, visibility=EVENT_QUEUE_VISIBILITY,
+                            partitions=SERVER_WORKERS, partition=WORKER_INDEX)
+
+# Acked messages are written here before the ack and drained into the worker
+# pool (through the debounce window), so a restart or crash doesn't lose them.
+# Opened by open_event_queue() once the server is bound (it may wait for Redis
+# and creates the SQLite files); messages acked before go to the pool directly
+event_queue = None
+event_consumer = None
+
+def open_event_queue():
+    """Open the durable event queue and start its consumer; part of the warm-up."""
+    global event_queue, event_consumer
+    try:
+        queue = create_event_queue()
+    except Exception:
+        ERRORS.labels("startup").inc()
+        logger.exception("event queue unavailable, handling messages in memory")
+        return
+    if queue is None:
+        return
+    event_consumer = EventConsumer(queue, submit_message,
+                                   max_inflight=min(EVENT_QUEUE_MAX_INFLIGHT, WORKER_QUEUE_SIZE))
+    event_queue = queue
+
+def enqueue_message(message) -> bool:
+    """
+    Hand a text message to the pipeline: to the durable event queue when
+    it is open (the caller acks only after this returned), else straight
+    to the worker pool (or the debounce window in front of it).
+    """
+    if event_queue is not None:
+        try:
+            event_queue.put(message)
+            return True
+        except Exception as e:
+            ERRORS.labels("enqueue").inc()
+            logger.warning("event queue unavailable, handling in memory: %r", e)
+    return submit_message(message)
+
+if SERVER_WORKERS > 1:
+    if DEDUP_BACKEND == "memory":
+        logger.warning("DEDUP_BACKEND=memory is per process, use redis or sqlite with several workers")
+    if EVENT_QUEUE == "off":
+        logger.warning("without the event queue, messages of a chat are only ordered per worker")
+
+BREAKER_STATES = {CLOSED: 0, HALF_OPEN: 1, OPEN: 2}
+
+# In-flight work, read when /metrics is scraped
+Gauge("bot_worker_pool_active", "Messages being handled by the worker pool",
+      fn=lambda: worker_pool.load()[0])
+Gauge("bot_worker_pool_queued", "Messages waiting for a worker",
+      fn=lambda: worker_pool.load()[1])
+Gauge("bot_replies_chats_sending", "Chats with follow-up replies being sent",
+      fn=lambda: reply_sender.stats()["chats_sending"])
+Gauge("bot_outbound_pending", "Messages queued by the send limiter",
+      fn=lambda: outbound.stats()["pending"])
+Gauge("bot_event_queue_inflight", "Durable queue entries handed out and not acked yet",
+      fn=lambda: event_consumer.stats()["inflight"] if event_consumer is not None else 0)
+Gauge("bot_debounce_coalescing_ratio", "Text messages per Dialogflow call out of the debounce window",
+      fn=lambda: debouncer.coalescing_ratio() if debouncer is not None else 1.0)
+Gauge("bot_dialogflow_breaker_state", "Dialogflow circuit breaker: 0 closed, 1 half open, 2 open",
+      fn=lambda: BREAKER_STATES[dialogflow_breaker.state] if dialogflow_breaker is not None else 0)
+Gauge("bot_dialogflow_hedge_win_rate", "Share of hedged detect_intent calls the hedge answered first",
+      fn=lambda: dialogflow_hedge.win_rate() if dialogflow_hedge is not None else 0.0)
+Gauge("bot_log_records_dropped", "Log records dropped because the log queue was full",
+      fn=log_records_dropped)
+
+# Retire this worker after WORKER_MAX_REQUESTS requests or above WORKER_MAX_RSS_MB
+lifetime = WorkerLifetime(WORKER_MAX_REQUESTS, WORKER_MAX_RSS_MB)
+retire = threading.Event()
+
+def count_request(event_type=None, elapsed=None):
+    """
+    Record a served request.
+
+    :param event_type: Event type of a verified callback, None for other requests
+    :param elapsed: Seconds it took to acknowledge it
+    """
+    if event_type is not None:
+        EVENTS.labels(event_type).inc()
+        ACK_SECONDS.observe(elapsed)
+    if lifetime.tick():
+        retire.set()
+
+def render_stats():
+    """:return: JSON of the worker pool, dedup, reply and response cache metrics"""
+    stats = {"worker_pool": worker_pool.stats(),
+             "event_queue": event_consumer.stats() if event_consumer is not None else None,
+             "dedup": deduplicator.stats(),
+             "replies": reply_sender.stats(),
+             "outbound": outbound.stats()}
+    if response_cache is not None:
+        stats["response_cache"] = response_cache.stats()
+    if intent_matcher is not None:
+        stats["intent_matcher"] = intent_matcher.stats()
+    if debouncer is not None:
+        stats["debounce"] = debouncer.stats()
+    if dialogflow_breaker is not None:
+        stats["dialogflow_breaker"] = dialogflow_breaker.stats()
+    if dialogflow_hedge is not None:
+        stats["dialogflow_hedge"] = dialogflow_hedge.stats()
+    if df_helper is not None:
+        stats["dialogflow_channels"] = df_helper.clients.stats()
+    return json.dumps(stats)
+
+def render_ready():
+    """GET /ready: 200 once the Dialogflow channel is connected, 503 before."""
+    if dialogflow_ready.is_set():
+        return "application/json", '{"ready": true}', 200
+    return "application/json", '{"ready": false}', 503
+
+# GET routes of both server modes: path -> () -> (content type, body[, status])
+routes = {
+    "/ready": render_ready,
+    "/stats": lambda: ("application/json", render_stats()),
+    "/metrics": lambda: (CONTENT_TYPE, REGISTRY.render()),
+}
+
+def drain():
+    """
+    Graceful shutdown, once the server stopped accepting callbacks: finish
+    the queued messages and flush the replies still waiting to be sent.
+    """
+    logger.info("draining.....")
+    if event_consumer is not None:
+        event_consumer.stop(drain=True, timeout=SHUTDOWN_TIMEOUT)
+    if debouncer is not None:
+        # Flush the bursts still in their window
+        debouncer.shutdown()
+    worker_pool.shutdown(wait=True)
+    reply_sender.shutdown(wait=True)
+    outbound.shutdown(wait=True, timeout=SHUTDOWN_TIMEOUT)
 
 class RequestHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        # /stats (JSON), /metrics (Prometheus) and /ready
+        route = routes.get(self.path.partition("?")[0])
+        if route is not None:
+            content_type, body, *status = route()
+            self.response(body, content_type, *status)
+            return
+        self.send_error(404)
+
     def do_POST(self):
-        # Read request body
-        req_body = self.rfile.read(int(self.headers['content-length']))
-        obj = json.loads(req_body.decode("utf-8"))
+        started = time.perf_counter()
+        self.event_type = None
+        try:
+            self.handle_post()
+        finally:
+            count_request(self.event_type, time.perf_counter() - started)
+
+    def handle_post(self):
+        # Check the size, then read and parse the request body
+        try:
+            length = webhook_parser.body_length(self.headers.get("content-length"),
+                                                self.headers.get("transfer-encoding"))
+            event = webhook_parser.parse(self.rfile.read(length))
+        except InvalidCallback as e:
+            ERRORS.labels("ingress").inc()
+            logger.warning("callback rejected", extra={"reason": e.reason})
+            # The body may be unread, so the connection can't be reused
+            self.close_connection = True
+            self.response("", status=e.status)
+            return
 
         # Verify token
-        token = obj.get("token", "") or obj.get("header", {}).get("token", "")
-        if token != APP_VERIFICATION_TOKEN:
-            print("verification token not match, token =", token)
+        if not event.verified:
+            ERRORS.labels("verification").inc()
+            logger.warning("verification token not match", extra={"token": event.token})
             self.response("")
             return
 
         # Get event type
-        event_type = obj.get("type", "") or obj.get("header", {}).get("event_type", "")
-        print("event_type =", event_type)
+        event_type = event.event_type
+        self.event_type = event_type
+        logger.debug("event", extra={"event_type": event_type})
 
         if event_type == "url_verification":
             # Respond to Feishu's URL verification challenge
-            self.handle_request_url_verify(obj)
+            self.handle_request_url_verify(event)
             return
-        elif event_type == "im.message.receive_v1":
-            # Immediately acknowledge receipt so Feishu won't resend:
-            self.response(json.dumps({"msg": "ok"}))
+        elif event_type == MESSAGE_EVENT:
+            # Drop Lark retries before they cost a worker
+            if is_duplicate_event(event):
+                self.response(json.dumps({"msg": "ok"}))
+                return
 
-            # Spawn a separate thread to handle Dialogflow
-            event = obj.get("event", {})
-            message = event.get("message", {})
-            
-            # We'll handle message in a new thread (if it's text, etc.)
+            message = event.message
+
+            # Hand the message (not this handler) to the pipeline; with the
+            # durable queue it is on disk / in Redis before we ack
             if message.get("message_type", "") == "text":
-                t = threading.Thread(target=self.handle_message_in_thread, args=(message, threading.get_ident()))
-                t.start()
+                try:
+                    enqueue_message(message)
+                except Exception:
+                    ERRORS.labels("enqueue").inc()
+                    logger.exception("enqueue failed", extra={"message_id": message.get("message_id", "")})
+                    forget_event(event)
+                    # Lark retries on a 5xx
+                    self.response("", status=500)
+                    return
 
+            # Acknowledge receipt so Feishu won't resend
+            self.response(json.dumps({"msg": "ok"}))
             return
         else:
             # For other event types, just return 200 quickly
             self.response("")
             return
 
-    def handle_request_url_verify(self, post_obj):
-        challenge = post_obj.get("challenge", "")
-        rsp = {'challenge': challenge}
+    def handle_request_url_verify(self, event):
+        rsp = {'challenge': event.challenge}
         self.response(json.dumps(rsp))
 
-    def handle_message_in_thread(self, message, thread_id):
-        """
-        This method will run in a background thread to handle:
-          - sending user message to Dialogflow
-          - getting back the result
-          - sending the result to the user
-        """
-        msg_type = message.get("message_type", "")
-        if msg_type != "text":
-            print("unknown msg_type =", msg_type)
-            return
-        
-
-        # Acquire the message_id for dedup
-        message_id = message.get("message_id", "")
-        
-        # If we have already processed this exact message_id, skip
-        if is_message_processed(message_id):
-            print(f"[DUPLICATE] message_id={message_id} was processed before; ignoring.")
-            print(f"Thread {thread_id} finished")
-            return
-        
-        content = json.loads(message.get("content", "{}"))
-        text = content.get("text", "")
-        chat_id = message.get("chat_id", "")
-        
-        
-        print("Message", message)
-        print("[RECEIVED]", text)
-
-        # Get tenant access token
-        access_token = self.get_tenant_access_token()
-        if access_token == "":
-            print("get tenant_access_token failed")
-            return
+    def log_message(self, format, *args):
+        # Access log through the non-blocking logging instead of stderr
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug(format % args, extra={"client": self.address_string()})
 
-        # Pass the user message to Dialogflow
-        single_response = df_helper._detect_intent_text(text)
-        fulfillment_text = df_helper.get_fulfillment_text(single_response)
-        reply_text = fulfillment_text if fulfillment_text else "Sorry, I don't understand."
-        print("[SEND]", chat_id, reply_text)
-    
-        # Asynchronously send message back to user
-        self.send_message(access_token, chat_id, reply_text)
-        print(f"Thread {thread_id} finished")
-
-    def response(self, body):
-        """Send an immediate HTTP 200 response with provided body."""
-        self.send_response(200)
-        self.send_header('Content-Type', 'application/json')
+    def response(self, body, content_type='application/json', status=200):
+        """Send an immediate HTTP response (200 by default) with provided body."""
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
         self.end_headers()
         self.wfile.write(body.encode())
 
-    def get_tenant_access_token(self):
-        url = "https://open.feishu.cn/open-apis/auth/v3/tenant_access_token/internal/"
-        headers = {"Content-Type": "application/json"}
-        req_body = {
-            "app_id": APP_ID,
-            "app_secret": APP_SECRET
-        }
+class ReusePortHTTPServer(HTTPServer):
+    allow_reuse_port = True
 
-        data = bytes(json.dumps(req_body), encoding='utf8')
-        req = request.Request(url=url, data=data, headers=headers, method='POST')
-        try:
-            response = request.urlopen(req)
-        except Exception as e:
-            print(e.read().decode())
-            return ""
-
-        rsp_body = response.read().decode('utf-8')
-        rsp_dict = json.loads(rsp_body)
-        code = rsp_dict.get("code", -1)
-        if code != 0:
-            print("get tenant_access_token error, code =", code)
-            return ""
-        return rsp_dict.get("tenant_access_token", "")
-
-    def send_message(self, token, chat_id, text):
-        url = "https://open.feishu.cn/open-apis/message/v4/send/"
-        headers = {
-            "Authorization": "Bearer " + token,
-            "Content-Type": "application/json"
-        }
-        req_body = {
-            "chat_id": chat_id,
-            "msg_type": "text",
-            "content": {
-                "text": text
-            }
-        }
-        
-        data = bytes(json.dumps(req_body), encoding='utf8')
-        req = request.Request(url=url, data=data, headers=headers, method='POST')
-        try:
-            response = request.urlopen(req)
-            rsp_body = response.read().decode('utf-8')
-            print("[RESPONSE]", rsp_body)
-        except Exception as e:
-            print(e.read().decode())
+def watch_retire(stop_server):
+    """Stop the server (between requests) once this worker should retire."""
+    def watch():
+        retire.wait()
+        stop_server()
+    threading.Thread(target=watch, name="retire", daemon=True).start()
+
+def stop_signals():
+    """Ignore further SIGTERM / Ctrl+C so they don't cut the drain short."""
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+def run(mode=None):
+    """
+    Start the webhook server.
+
+    :param mode: "threaded" (http.server, one connection at a time) or
+                 "asyncio" (concurrent ingress + async pipeline).
+                 Defaults to the SERVER_MODE environment variable.
+    """
+    mode = mode or SERVER_MODE
+    port = SERVER_PORT
+    # Several workers (prefork.py) share the port
+    reuse_port = SERVER_WORKERS > 1
+
+    # Stop on SIGTERM like on Ctrl+C, then drain
+    signal.signal(signal.SIGTERM, signal.default_int_handler)
+
+    # The asyncio pipeline only handles messages without the durable queue and
+    # the debounce window; otherwise (and in the threaded mode) the worker pool does
+    use_pool = mode != "asyncio" or EVENT_QUEUE != "off" or debouncer is not None
+    if DIALOGFLOW_ASYNC and use_pool:
+        logger.warning("DIALOGFLOW_ASYNC ignored: it needs SERVER_MODE=asyncio, EVENT_QUEUE=off and "
+                       "DEBOUNCE_WINDOW_MS=0", extra={"mode": mode, "event_queue": EVENT_QUEUE,
+                                                      "debounce": debouncer is not None})
+
+    if mode == "asyncio":
+        use_async_df = DIALOGFLOW_ASYNC and not use_pool
+        server = AsyncWebhookServer(APP_VERIFICATION_TOKEN,
+                                    handle_message_async if use_async_df else handle_message,
+                                    is_duplicate=is_duplicate_event,
+                                    forget=forget_event,
+                                    port=port,
+                                    max_body=WEBHOOK_MAX_BODY,
+                                    loads=webhook_parser.loads,
+                                    workers=ASYNC_WORKERS,
+                                    key=chat_key,
+                                    enqueue=enqueue_message if use_pool else None,
+                                    reuse_port=reuse_port,
+                                    on_request=count_request,
+                                    routes=routes,
+                                    drain_timeout=SHUTDOWN_TIMEOUT)
+        watch_retire(server.request_stop)
+
+        async def serve():
+            # Stop between requests rather than raising inside the event loop
+            loop = asyncio.get_running_loop()
+            for signum in (signal.SIGTERM, signal.SIGINT):
+                loop.add_signal_handler(signum, server.request_stop)
+            await server.start()
+            start_warm_up()
+            try:
+                # Cancels the Dialogflow calls still in flight after SHUTDOWN_TIMEOUT
+                await server.serve_forever()
+            finally:
+                if async_df_helper is not None:
+                    await async_df_helper.close()
+
+        logger.info("start (asyncio).....")
+        asyncio.run(serve())
+        stop_signals()
+        drain()
+        return
 
-def run():
-    port = 8000
     server_address = ('', port)
-    httpd = HTTPServer(server_address, RequestHandler)
-    print("start.....")
-    httpd.serve_forever()
+    httpd = (ReusePortHTTPServer if reuse_port else HTTPServer)(server_address, RequestHandler)
+    watch_retire(httpd.shutdown)
+    start_warm_up()
+    logger.info("start.....")
+    try:
+        httpd.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    stop_signals()
+    httpd.server_close()
+    drain()
 
 if __name__ == '__main__':
-    run()
\ No newline at end of file
+    run(sys.argv[1] if len(sys.argv) > 1 else None)
\ No newline at end of file
@@ -0,0 +1,205 @@
+#!/usr/bin/env python
+# --coding:utf-8--
+
+import itertools
+import threading
+from contextlib import contextmanager
+
+GLOBAL = "global"
+
+ROUND_ROBIN = "round_robin"
+LEAST_LOADED = "least_loaded"
+POLICIES = (ROUND_ROBIN, LEAST_LOADED)
+
+
+class ClientPool:
+    """
+    Dialogflow clients on separate gRPC channels, and which one a call uses.
+
+    A single channel multiplexes every concurrent call over one HTTP/2
+    connection, so they share its concurrent stream limit (calls past it
+    queue in the client) and stall together on a lost packet. Clients built
+    with channel_options() each get their own connection; calls are spread
+    over them in turn (round_robin) or to the one with the fewest calls in
+    flight (least_loaded, ties in turn).
+
+    The pool only hands out clients: it doesn't import grpc, so the sync
+    and asyncio clients both fit.
+    """
+
+    def __init__(self, clients, policy=ROUND_ROBIN):
+        """
+        :param clients: Non-empty list of clients, e.g. from create_sessions_clients()
+        :param policy: ROUND_ROBIN or LEAST_LOADED
+        """
+        if not clients:
+            raise ValueError("a client pool needs at least one client")
+        if policy not in POLICIES:
+            raise ValueError(f"unknown channel policy {policy!r}, expected one of {POLICIES}")
+        self.clients = list(clients)
+        self.policy = policy
+
+        self._turn = itertools.count()
+        self._in_flight = [0] * len(self.clients)
+        self._lock = threading.Lock()
+
+        # Counters
+        self.calls = [0] * len(self.clients)
+
+    def __len__(self):
+        return len(self.clients)
+
+    def acquire(self):
+        """
+        Pick the client of the next call; hand it back with release().
+
+        :return: (index, client)
+        """
+        with self._lock:
+            start = next(self._turn) % len(self.clients)
+            index = start
+            if self.policy == LEAST_LOADED:
+                # Scan from the round robin position, so ties are spread too
+                for offset in range(1, len(self.clients)):
+                    candidate = (start + offset) % len(self.clients)
+                    if self._in_flight[candidate] < self._in_flight[index]:
+                        index = candidate
+            self._in_flight[index] += 1
+            self.calls[index] += 1
+            return index, self.clients[index]
+
+    def release(self, index):
+        """:param index: Index acquire() returned, once the call has ended"""
+        with self._lock:
+            self._in_flight[index] -= 1
+
+    @contextmanager
+    def client(self):
+        """Context manager acquiring a client for one call."""
+        index, client = self.acquire()
+        try:
+            yield client
+        finally:
+            self.release(index)
+
+    def channels(self):
+        """:return: The gRPC channel of every client"""
+        return [client.transport.grpc_channel for client in self.clients]
+
+    def stats(self):
+        """
+        :return: dict of the policy, calls sent and calls in flight per channel
+        """
+        with self._lock:
+            return {
+                "policy": self.policy,
+                "channels": len(self.clients),
+                "calls": list(self.calls),
+                "in_flight": list(self._in_flight),
+            }
+
+    def close(self):
+        """Close the channel of every client (sync clients)."""
+        for client in self.clients:
+            client.transport.close()
+
+
+def regional_endpoint(location=GLOBAL):
+    """
+    :param location: Dialogflow ES location, e.g. "global" or "europe-west1"
+    :return: host:port of its API endpoint
+    """
+    if not location or location == GLOBAL:
+        return "dialogflow.googleapis.com:443"
+    return f"{location}-dialogflow.googleapis.com:443"
+
+
+def session_path(project, session, location=GLOBAL):
+    """
+    Session path of a Dialogflow ES agent in a location. Global agents keep
+    the path without a location, as SessionsClient.session_path builds it.
+
+    :return: str
+    """
+    if not location or location == GLOBAL:
+        return f"projects/{project}/agent/sessions/{session}"
+    return f"projects/{project}/locations/{location}/agent/sessions/{session}"
+
+
+def context_path(project, session, context, location=GLOBAL):
+    """:return: Path of a context of a session_path() session"""
+    return f"{session_path(project, session, location)}/contexts/{context}"
+
+
+def channel_options(keepalive_ms=60000, separate=True):
+    """
+    gRPC channel arguments of pooled Dialogflow channels.
+
+    :param keepalive_ms: Interval of HTTP/2 keepalive pings, sent even while
+                         the channel is idle, so NATs and load balancers don't
+                         drop its connection and the next message doesn't pay
+                         for a new handshake; 0 to disable
+    :param separate: Give the channel its own subchannels, so channels to the
+                     same endpoint don't end up on one shared connection
+    :return: List of (key, value) channel options
+    """
+    options = []
+    if separate:
+        options.append(("grpc.use_local_subchannel_pool", 1))
+    if keepalive_ms:
+        options += [
+            ("grpc.keepalive_time_ms", keepalive_ms),
+            ("grpc.keepalive_timeout_ms", 20000),
+            ("grpc.keepalive_permit_without_calls", 1),
+            ("grpc.http2.max_pings_without_data", 0),
+        ]
+    return options
+
+
+def create_sessions_client(location=GLOBAL, options=()):
+    """
+    A SessionsClient on the endpoint of `location`, with extra channel
+    options; credentials are discovered as SessionsClient() does.
+
+    :param location: Dialogflow ES location
+    :param options: Channel options, e.g. from channel_options()
+    :return: dialogflow.SessionsClient
+    """
+    from google.cloud import dialogflow_v2 as dialogflow
+    from google.cloud.dialogflow_v2.services.sessions.transports import SessionsGrpcTransport
+
+    transport = SessionsGrpcTransport(host=regional_endpoint(location),
+                                      channel=_channel_factory(SessionsGrpcTransport, options))
+    return dialogflow.SessionsClient(transport=transport)
+
+
+def create_async_sessions_client(location=GLOBAL, options=()):
+    """
+    asyncio counterpart of create_sessions_client(); call it on the event
+    loop that will use the client.
+
+    :return: dialogflow.SessionsAsyncClient
+    """
+    from google.cloud import dialogflow_v2 as dialogflow
+    from google.cloud.dialogflow_v2.services.sessions.transports import SessionsGrpcAsyncIOTransport
+
+    transport = SessionsGrpcAsyncIOTransport(host=regional_endpoint(location),
+                                             channel=_channel_factory(SessionsGrpcAsyncIOTransport, options))
+    return dialogflow.SessionsAsyncClient(transport=transport)
+
+
+def create_client_pool(size=1, location=GLOBAL, keepalive_ms=60000, policy=ROUND_ROBIN):
+    """
+    :param size: Number of channels
+    :return: ClientPool of `size` SessionsClients, each on its own connection
+    """
+    options = channel_options(keepalive_ms, separate=size > 1)
+    return ClientPool([create_sessions_client(location, options) for _ in range(max(1, size))], policy)
+
+
+def _channel_factory(transport_class, options):
+    """:return: Channel callable for a transport, adding `options` to its own"""
+    def create_channel(host, **kwargs):
+        kwargs["options"] = list(kwargs.get("options") or ()) + list(options)
+        return transport_class.create_channel(host, **kwargs)
+    return create_channel
@@ -0,0 +1,246 @@
+#!/usr/bin/env python
+# --coding:utf-8--
+
+import logging
+import sqlite3
+import threading
+import time
+from collections import Counter, OrderedDict
+
+logger = logging.getLogger(__name__)
+
+
+class MemoryDedupStore:
+    """
+    Bounded in-memory set of claimed keys with a per-key expiry.
+
+    Used on its own for single-process deployments without Redis, and as
+    the in-process front cache of MessageDeduplicator.
+    """
+
+    def __init__(self, max_keys=100000):
+        """
+        :param max_keys: Maximum number of keys kept; the oldest are evicted first
+        """
+        self.max_keys = max_keys
+        self._keys = OrderedDict()
+        self._lock = threading.Lock()
+
+    def claim(self, key, ttl):
+        """
+        Atomically mark a key as processed.
+
+        :param key: Dedup key
+        :param ttl: Seconds the key is remembered
+        :return: True if this call claimed the key, False if it was already claimed
+        """
+        now = time.monotonic()
+        with self._lock:
+            expires_at = self._keys.get(key)
+            if expires_at is not None and expires_at > now:
+                return False
+            self._keys[key] = now + ttl
+            self._keys.move_to_end(key)
+            while len(self._keys) > self.max_keys:
+                self._keys.popitem(last=False)
+            return True
+
+    def release(self, key):
+        """Forget a claimed key, so the next claim of it wins."""
+        with self._lock:
+            self._keys.pop(key, None)
+
+    def __contains__(self, key):
+        with self._lock:
+            expires_at = self._keys.get(key)
+            return expires_at is not None and expires_at > time.monotonic()
+
+    def __len__(self):
+        with self._lock:
+            return len(self._keys)
+
+
+class RedisDedupStore:
+    """
+    Dedup keys in Redis, claimed with a single atomic SET NX EX.
+    """
+
+    def __init__(self, redis_client, prefix=""):
+        """
+        :param redis_client: redis.Redis instance
+        :param prefix: Prefix added to every key
+        """
+        self.redis_client = redis_client
+        self.prefix = prefix
+
+    def claim(self, key, ttl):
+        """
+        :return: True if this call claimed the key, False if it was already claimed
+        """
+        return bool(self.redis_client.set(self.prefix + key, "processed", nx=True, ex=ttl))
+
+    def release(self, key):
+        self.redis_client.delete(self.prefix + key)
+
+
+class SqliteDedupStore:
+    """
+    Dedup keys in a local SQLite file, for deployments without Redis that
+    still want dedup to survive a restart.
+    """
+
+    def __init__(self, path="dedup.sqlite3", purge_every=1000):
+        """
+        :param path: SQLite database file
+        :param purge_every: Delete expired keys every N claims
+        """
+        self.path = path
+        self.purge_every = purge_every
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS dedup (key TEXT PRIMARY KEY, expires_at REAL NOT NULL)"
+        )
+        self._lock = threading.Lock()
+        self._claims = 0
+
+    def claim(self, key, ttl):
+        """
+        :return: True if this call claimed the key, False if it was already claimed
+        """
+        now = time.time()
+        with self._lock:
+            # A single statement, so it is atomic even across processes
+            cur = self._conn.execute(
+                "INSERT INTO dedup (key, expires_at) VALUES (?, ?) "
+                "ON CONFLICT(key) DO UPDATE SET expires_at = excluded.expires_at "
+                "WHERE dedup.expires_at <= ?",
+                (key, now + ttl, now),
+            )
+            claimed = cur.rowcount == 1
+
+            self._claims += 1
+            if self._claims % self.purge_every == 0:
+                self._conn.execute("DELETE FROM dedup WHERE expires_at <= ?", (now,))
+        return claimed
+
+    def release(self, key):
+        with self._lock:
+            self._conn.execute("DELETE FROM dedup WHERE key = ?", (key,))
+
+
+class MessageDeduplicator:
+    """
+    Exactly-once claim of Lark messages / events.
+
+    A bounded in-process front cache answers hot retries without a round
+    trip; everything else is claimed atomically in the backing store
+    (Redis, SQLite or memory), so two deliveries racing each other, in this
+    process or another one, can never both win.
+    """
+
+    def __init__(self, store, ttl=43200, front_size=10000):
+        """
+        :param store: Backing store with a claim(key, ttl) method
+        :param ttl: Seconds a key is remembered (Lark retries for up to a few hours)
+        :param front_size: Number of keys kept in the in-process front cache, 0 to disable
+        """
+        self.store = store
+        self.ttl = ttl
+        self.front = MemoryDedupStore(front_size) if front_size else None
+
+        # Counters
+        self.claimed = 0
+        self.duplicates = 0
+        self.duplicates_by_reason = Counter()
+        self.front_hits = 0
+        self.store_errors = 0
+        self._lock = threading.Lock()
+
+    def claim(self, key, reason="message_id"):
+        """
+        Claim a key for processing.
+
+        :param key: message_id / event_id
+        :param reason: Kind of key, used to break the duplicate count down
+        :return: True if the caller should process it, False if it is a duplicate
+        """
+        if not key:
+            return False
+
+        if self.front is not None and not self.front.claim(key, self.ttl):
+            with self._lock:
+                self.front_hits += 1
+                self.duplicates += 1
+                self.duplicates_by_reason[reason] += 1
+            return False
+
+        try:
+            claimed = self.store.claim(key, self.ttl)
+        except Exception as e:
+            # Without the store only the front cache protects us; prefer
+            # answering twice over not answering at all
+            logger.warning("dedup store unavailable: %r", e)
+            with self._lock:
+                self.store_errors += 1
+            claimed = True
+
+        with self._lock:
+            if claimed:
+                self.claimed += 1
+            else:
+                self.duplicates += 1
+                self.duplicates_by_reason[reason] += 1
+        return claimed
+
+    def release(self, key):
+        """
+        Undo a claim whose message could not be accepted after all (e.g. the
+        queue was down), so the sender's retry is not dropped as a duplicate.
+
+        :param key: Key claimed with claim()
+        """
+        if self.front is not None:
+            self.front.release(key)
+        try:
+            self.store.release(key)
+        except Exception as e:
+            # The claim expires after the TTL
+            logger.warning("dedup store unavailable: %r", e)
+            with self._lock:
+                self.store_errors += 1
+
+    def stats(self):
+        """
+        :return: dict of dedup counters
+        """
+        with self._lock:
+            return {
+                "claimed": self.claimed,
+                "duplicates": self.duplicates,
+                "duplicates_by_reason": dict(self.duplicates_by_reason),
+                "front_hits": self.front_hits,
+                "store_errors": self.store_errors,
+            }
+
+
+def create_deduplicator(backend, redis_client=None, sqlite_path="dedup.sqlite3",
+                        ttl=43200, front_size=10000, max_keys=100000):
+    """
+    Build a MessageDeduplicator for a backend name.
+
+    :param backend: "redis", "sqlite" or "memory"
+    :return: MessageDeduplicator
+    """
+    if backend == "redis":
+        store = RedisDedupStore(redis_client)
+    elif backend == "sqlite":
+        store = SqliteDedupStore(sqlite_path)
+    elif backend == "memory":
+        store = MemoryDedupStore(max_keys)
+        # The store is already in-process, a front cache would only double the memory
+        front_size = 0
+    else:
+        raise ValueError(f"unknown dedup backend: {backend}")
+    return MessageDeduplicator(store, ttl=ttl, front_size=front_size)
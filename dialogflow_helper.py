@@ -1,61 +1,125 @@
-import os
+import asyncio
+import threading
+import time
+import uuid
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+import grpc
+from google.api_core import exceptions, gapic_v1
+from google.api_core.retry import Retry, if_exception_type
 from google.cloud import dialogflow_v2 as dialogflow
-from google.protobuf.json_format import MessageToDict
-
-class DialogflowHelper:
+from google.cloud.dialogflow_v2.services.contexts.transports import ContextsGrpcTransport
+
+import channel_pool
+from channel_pool import GLOBAL, ClientPool
+from resilience import CircuitOpenError
+from session_registry import SessionRegistry
+
+# Retry what the service refused to take on (UNAVAILABLE), with a short
+# backoff, until the call's deadline
+DEFAULT_RETRY = Retry(predicate=if_exception_type(exceptions.ServiceUnavailable),
+                      initial=0.1, maximum=1.0, multiplier=2.0)
+
+# Errors that say Dialogflow is slow or down, as opposed to a bad request;
+# they count towards opening the circuit breaker (RetryError: the retries of
+# UNAVAILABLE ran out of time)
+SERVICE_ERRORS = (exceptions.DeadlineExceeded, exceptions.ServiceUnavailable,
+                  exceptions.InternalServerError, exceptions.TooManyRequests,
+                  exceptions.Unknown, exceptions.RetryError)
+
+# One item of a batch: its position in the input, the query, and either the
+# DetectIntentResponse or the exception it raised
+BatchResult = namedtuple("BatchResult", ["index", "text", "response", "error"])
+
+class BaseDialogflowHelper:
     """
-    A helper class to manage Dialogflow ES sessions, send queries, and parse responses.
+    Session paths, per-chat sessions and response parsing, shared by the
+    sync DialogflowHelper and the asyncio AsyncDialogflowHelper.
     """
 
-    def __init__(self, project_id, session_id, language_code="en"):
+    def __init__(self, project_id, session_id, language_code="en",
+                 session_ttl=1200, max_sessions=10000, response_cache=None,
+                 breaker=None, hedge=None, location=GLOBAL):
         """
-        Initialize Dialogflow session.
-
         :param project_id: GCP project ID associated with the Dialogflow agent
-        :param session_id: Unique ID for a given dialog session
+        :param session_id: Default session ID, used when a call doesn't name one
         :param language_code: Language code, e.g. 'en'
+        :param session_ttl: Seconds an idle per-chat session is kept in the registry
+        :param max_sessions: Maximum number of per-chat sessions kept in the registry
+        :param response_cache: Optional IntentResponseCache for context-free intents
+        :param breaker: Optional CircuitBreaker; while it is open, DetectIntent
+                        calls (text and events) raise CircuitOpenError without
+                        calling Dialogflow
+        :param hedge: Optional HedgePolicy; a DetectIntent call slower than its
+                      delay gets a second request, and the first answer wins
+        :param location: Location of the agent, e.g. 'europe-west1'; 'global'
+                         (default) for agents without one
         """
         self.project_id = project_id
         self.session_id = session_id
         self.language_code = language_code
-
-        # Create a Sessions client
-        self.sessions_client = dialogflow.SessionsClient()
+        self.response_cache = response_cache
+        self.breaker = breaker
+        self.hedge = hedge
+        self.location = location
 
         # Generate the session path
-        self.session_path = self.sessions_client.session_path(
-            project=project_id, session=session_id
-        )
+        self.session_path = channel_pool.session_path(project_id, session_id, location)
+
+        # Per-chat / per-user sessions
+        self.sessions = SessionRegistry(self.get_session_path,
+                                        ttl=session_ttl,
+                                        max_sessions=max_sessions)
+
+    def _allow_call(self):
+        """Raise CircuitOpenError if the circuit breaker refuses the call."""
+        if self.breaker is not None and not self.breaker.allow():
+            raise CircuitOpenError("Dialogflow circuit breaker open")
+
+    def _record_call(self, error=None):
+        """Tell the circuit breaker how a call it allowed went."""
+        if self.breaker is None:
+            return
+        if isinstance(error, SERVICE_ERRORS):
+            self.breaker.record_failure()
+        else:
+            # Answered, if only to say the request was bad
+            self.breaker.record_success()
 
-    def detect_intent_texts(self, text_list):
+    def get_session_path(self, session_id=None):
         """
-        Sends a list of text queries to Dialogflow and returns the list of response objects.
+        Session path for a session ID.
 
-        :param text_list: List of user text inputs
-        :return: List of response objects from Dialogflow
+        :param session_id: Session ID, defaults to the helper's session
+        :return: Session path (str)
         """
-        responses = []
-        for text in text_list:
-            response = self._detect_intent_text(text)
-            responses.append(response)
-        return responses
+        if not session_id or session_id == self.session_id:
+            return self.session_path
+        return channel_pool.session_path(self.project_id, session_id, self.location)
 
-    def _detect_intent_text(self, text):
+    def get_context_path(self, session_id, context_name):
         """
-        Internal method to send a single text query to Dialogflow.
+        Context path of a context of a session.
 
-        :param text: User input text
-        :return: Dialogflow DetectIntentResponse object
+        :param session_id: Session ID
+        :param context_name: Context name
+        :return: Context path (str)
         """
-        # Build the text input
-        text_input = dialogflow.TextInput(text=text, language_code=self.language_code)
-        query_input = dialogflow.QueryInput(text=text_input)
+        return channel_pool.context_path(self.project_id, session_id, context_name, self.location)
 
-        # Make API request
-        response = self.sessions_client.detect_intent(
-            request={"session": self.session_path, "query_input": query_input}
-        )
-        return response
+    def session_for(self, chat_id, sender_id=None, chat_type="p2p"):
+        """
+        Dialogflow session ID of a Lark conversation, so every chat (and every
+        user of a group chat) has its own contexts.
+
+        :param chat_id: Lark chat_id
+        :param sender_id: Sender open_id
+        :param chat_type: "p2p" or "group"
+        :return: Session ID (str)
+        """
+        key = SessionRegistry.session_key(chat_id, sender_id, chat_type)
+        return self.sessions.get(key).session_id
 
     def get_fulfillment_text(self, response):
         """
@@ -102,101 +166,64 @@ class DialogflowHelper:
         """
         return response.query_result.output_contexts
 
-    def detect_intent_with_contexts(self, text, context_name, lifespan_count=5, parameters=None):
-        """
-        Detect intent for text with an input context.
-
-        :param text: The user query text
-        :param context_name: The context name to set
-        :param lifespan_count: Number of conversational turns for which the context remains active
-        :param parameters: Parameters for the context
-        :return: Dialogflow DetectIntentResponse object
-        """
-        if context_name:
-            context_path = self.sessions_client.context_path(
-                self.project_id, self.session_id, context_name
-            )
-            context = dialogflow.Context(
-                name=context_path,
-                lifespan_count=lifespan_count,
-                parameters=dialogflow.types.struct_pb2.Struct(fields=parameters) if parameters else None
-            )
-            # Create the context
-            context_client = dialogflow.ContextsClient()
-            context_client.create_context(parent=self.session_path, context=context)
-
-        # Send text
-        response = self._detect_intent_text(text)
-        return response
-
-    def clear_contexts(self):
-        """
-        Clears all active contexts for the current session.
-        """
-        context_client = dialogflow.ContextsClient()
-        context_list = context_client.list_contexts(parent=self.session_path)
-        for ctx in context_list:
-            context_client.delete_context(name=ctx.name)
-
-    def detect_intent_with_event(self, event_name, parameters=None):
-        """
-        Trigger a custom event to Dialogflow rather than sending user text.
-
-        :param event_name: Name of the event
-        :param parameters: Parameters to pass along with the event
-        :return: Dialogflow DetectIntentResponse object
-        """
-        event_input = dialogflow.EventInput(name=event_name, 
-                                            language_code=self.language_code,
-                                            parameters=dialogflow.types.struct_pb2.Struct(
-                                                fields=parameters) if parameters else None)
-        query_input = dialogflow.QueryInput(event=event_input)
-        response = self.sessions_client.detect_intent(
-            request={"session": self.session_path, "query_input": query_input}
-        )
-        return response
-
     def parse_rich_responses(self, response):
         """
-        Convert the entire response.query_result into a dict
-        and then parse text and payload messages.
+        Extract the text and payload messages of a response.
+
+        Walks query_result.fulfillment_messages on the underlying protobuf
+        instead of converting the whole query_result (diagnostic info,
+        parameters, contexts) to a dict; payload Structs are only converted
+        when a payload message is present.
         
         :param response: Dialogflow DetectIntentResponse
         :return: dict -> {"text": [...], "payload": [...]}
         """
-        
-                
-        
-        # Convert the entire query_result to a dictionary
-        query_result_dict = MessageToDict(
-            response.query_result._pb,
-            # including_default_value_fields=True,    # Optional, to include fields with default values
-            # always_print_fields_with_no_presence=True, # Optional, to include fields with no data
-            # preserving_proto_field_name=True        # Optional, keeps the original proto field names
-        )
-
         text_responses = []
         payload_responses = []
 
-        # Safely extract the fulfillment messages from the dict
-        fulfillment_messages = query_result_dict.get("fulfillmentMessages", [])
-
-        for fm in fulfillment_messages:
-            # If there's a text field, it's typically fm["text"]["text"] = [ "some text" ]
-            if "text" in fm:
-                # "text" is an object that may contain {"text": ["Hello world", ...]}
-                text_list = fm["text"].get("text", [])
-                text_responses.extend(text_list)
-
-            # If there's a payload field, it's a dictionary
-            if "payload" in fm:
-                payload_responses.append(fm["payload"])
+        for fm in response.query_result._pb.fulfillment_messages:
+            kind = fm.WhichOneof("message")
+            # A text message is typically {"text": {"text": ["some text", ...]}}
+            if kind == "text":
+                text_responses.extend(fm.text.text)
+            # A payload message is a Struct
+            elif kind == "payload":
+                payload_responses.append(self._struct_to_dict(fm.payload))
 
         return {
             "text": text_responses,
             "payload": payload_responses
         }
 
+    def iter_fulfillment_messages(self, response):
+        """
+        Yield the fulfillment messages of a response in the order the agent
+        defined them, converting each one only when it is reached.
+
+        Only messages for the default platform are returned; messages
+        targeting other integrations (Facebook, Slack, ...) are skipped.
+
+        :param response: Dialogflow DetectIntentResponse
+        :return: Iterator of (kind, value): ("text", [str, ...]), ("payload", dict)
+                 or ("card", {"title", "subtitle", "image_uri", "buttons"})
+        """
+        for fm in response.query_result._pb.fulfillment_messages:
+            if fm.platform != dialogflow.Intent.Message.Platform.PLATFORM_UNSPECIFIED:
+                continue
+            kind = fm.WhichOneof("message")
+            if kind == "text":
+                yield "text", list(fm.text.text)
+            elif kind == "payload":
+                yield "payload", self._struct_to_dict(fm.payload)
+            elif kind == "card":
+                yield "card", {
+                    "title": fm.card.title,
+                    "subtitle": fm.card.subtitle,
+                    "image_uri": fm.card.image_uri,
+                    "buttons": [{"text": b.text, "postback": b.postback}
+                                for b in fm.card.buttons],
+                }
+
     def _struct_to_dict(self, struct_obj):
         """
         Helper method to convert a Struct object to a Python dict.
@@ -204,24 +231,433 @@ class DialogflowHelper:
         :param struct_obj: google.protobuf.struct_pb2.Struct
         :return: dict
         """
-        return {k: self._value_to_python(v) for k, v in struct_obj.fields.items()}
+        result = {}
+        self._convert_values(struct_obj.fields.items(), result)
+        return result
 
     def _value_to_python(self, value_obj):
         """
         Convert a google.protobuf.struct_pb2.Value to a Python object.
         """
-        kind = value_obj.WhichOneof("kind")
-        if kind == "null_value":
-            return None
-        elif kind == "number_value":
-            return value_obj.number_value
-        elif kind == "string_value":
-            return value_obj.string_value
-        elif kind == "bool_value":
-            return value_obj.bool_value
-        elif kind == "struct_value":
-            return self._struct_to_dict(value_obj.struct_value)
-        elif kind == "list_value":
-            return [self._value_to_python(v) for v in value_obj.list_value.values]
+        root = [None]
+        self._convert_values([(0, value_obj)], root)
+        return root[0]
+
+    def _convert_values(self, items, container):
+        """
+        Convert (key, Value) pairs into container[key], iteratively, so deeply
+        nested payloads cannot hit the recursion limit.
+
+        :param items: Iterable of (key, google.protobuf.struct_pb2.Value)
+        :param container: dict or list receiving the converted values
+        """
+        stack = [(items, container)]
+        while stack:
+            items, container = stack.pop()
+            for key, value_obj in items:
+                kind = value_obj.WhichOneof("kind")
+                if kind == "string_value":
+                    container[key] = value_obj.string_value
+                elif kind == "number_value":
+                    container[key] = value_obj.number_value
+                elif kind == "bool_value":
+                    container[key] = value_obj.bool_value
+                elif kind == "struct_value":
+                    child = container[key] = {}
+                    stack.append((value_obj.struct_value.fields.items(), child))
+                elif kind == "list_value":
+                    values = value_obj.list_value.values
+                    child = container[key] = [None] * len(values)
+                    stack.append((enumerate(values), child))
+                else:
+                    container[key] = None
+
+class DialogflowHelper(BaseDialogflowHelper):
+    """
+    A helper class to manage Dialogflow ES sessions, send queries, and parse responses.
+    """
+
+    def __init__(self, project_id, session_id, language_code="en",
+                 session_ttl=1200, max_sessions=10000,
+                 sessions_client=None, async_client_factory=None, response_cache=None,
+                 timeout=10.0, retry=DEFAULT_RETRY, breaker=None, hedge=None,
+                 location=GLOBAL, client_pool=None):
+        """
+        Initialize Dialogflow session.
+
+        :param project_id: GCP project ID associated with the Dialogflow agent
+        :param session_id: Default session ID, used when a call doesn't name one
+        :param language_code: Language code, e.g. 'en'
+        :param session_ttl: Seconds an idle per-chat session is kept in the registry
+        :param max_sessions: Maximum number of per-chat sessions kept in the registry
+        :param sessions_client: Optional pre-built SessionsClient (e.g. on a custom channel)
+        :param async_client_factory: Optional callable returning a SessionsAsyncClient,
+                                     used by the async batch API
+        :param response_cache: Optional IntentResponseCache for context-free intents
+        :param timeout: Deadline of a text query in seconds, retries included
+        :param retry: Retry policy of text queries, None to disable retries
+        :param breaker: Optional CircuitBreaker, see BaseDialogflowHelper
+        :param hedge: Optional HedgePolicy, see BaseDialogflowHelper. Hedged
+                      queries aren't retried: a quick UNAVAILABLE sends the hedge
+                      (on another channel of the pool, if it has several)
+        :param location: Location of the agent, see BaseDialogflowHelper; the
+                         default client talks to its regional endpoint
+        :param client_pool: Optional ClientPool of SessionsClients (see
+                            channel_pool.create_client_pool) calls are spread
+                            over, instead of a single client
+        """
+        super().__init__(project_id, session_id, language_code,
+                         session_ttl=session_ttl,
+                         max_sessions=max_sessions,
+                         response_cache=response_cache,
+                         breaker=breaker,
+                         hedge=hedge,
+                         location=location)
+        self.timeout = timeout
+        self.retry = retry.with_timeout(timeout) if retry is not None else None
+
+        # Sessions clients, one per channel
+        if client_pool is not None:
+            self.set_client_pool(client_pool)
         else:
-            return None
\ No newline at end of file
+            self.sessions_client = sessions_client or channel_pool.create_sessions_client(location)
+
+        # The async client is bound to the event loop it is first used on,
+        # so it is only created by the async batch API
+        self._async_client_factory = async_client_factory or dialogflow.SessionsAsyncClient
+        self._async_sessions_client = None
+
+    @property
+    def sessions_client(self):
+        """The SessionsClient of the pool's first channel."""
+        return self.clients.clients[0]
+
+    @sessions_client.setter
+    def sessions_client(self, client):
+        self.set_client_pool(ClientPool([client]))
+
+    def set_client_pool(self, client_pool):
+        """
+        Spread calls over the clients of a ClientPool from now on.
+
+        :param client_pool: ClientPool of SessionsClients
+        """
+        self.clients = client_pool
+        # Contexts client on the first gRPC channel, so it doesn't pay for
+        # another connection and credential setup
+        self.contexts_client = dialogflow.ContextsClient(
+            transport=ContextsGrpcTransport(channel=client_pool.clients[0].transport.grpc_channel)
+        )
+
+    def detect_intent_texts(self, text_list, session_id=None):
+        """
+        Sends a list of text queries to Dialogflow and returns the list of response objects.
+
+        :param text_list: List of user text inputs
+        :param session_id: Session ID, defaults to the helper's session
+        :return: List of response objects from Dialogflow
+        """
+        responses = []
+        for text in text_list:
+            response = self._detect_intent_text(text, session_id)
+            responses.append(response)
+        return responses
+
+    def detect_intent_batch(self, text_list, max_concurrency=8, session_id=None):
+        """
+        Sends a batch of text queries concurrently.
+
+        Results keep the input order, and a failed query is reported in its
+        BatchResult.error instead of aborting the batch. Unless session_id is
+        given, each query runs in its own throwaway session so concurrent
+        queries can't change each other's contexts.
+
+        :param text_list: List of user text inputs
+        :param max_concurrency: Maximum number of requests in flight
+        :param session_id: Run every query in this session instead
+        :return: List of BatchResult, in input order
+        """
+        results = [None] * len(text_list)
+        for result in self.iter_detect_intent_batch(text_list, max_concurrency,
+                                                    session_id, ordered=False):
+            results[result.index] = result
+        return results
+
+    def iter_detect_intent_batch(self, text_list, max_concurrency=8, session_id=None,
+                                 ordered=True):
+        """
+        Generator variant of detect_intent_batch that yields results as they
+        are ready, so a long regression run can be streamed to disk.
+
+        :param text_list: List of user text inputs
+        :param max_concurrency: Maximum number of requests in flight
+        :param session_id: Run every query in this session instead
+        :param ordered: Yield in input order (True) or in completion order (False)
+        :return: Generator of BatchResult
+        """
+        batch_id = uuid.uuid4().hex[:8]
+        texts = list(text_list)
+
+        def run(index):
+            text = texts[index]
+            try:
+                response = self._detect_intent_text(
+                    text, session_id or f"batch-{batch_id}-{index}")
+                return BatchResult(index, text, response, None)
+            except Exception as e:
+                return BatchResult(index, text, None, e)
+
+        with ThreadPoolExecutor(max_workers=max(1, max_concurrency)) as pool:
+            # Submit lazily so at most max_concurrency items are pending at once
+            # (plus the buffered ones waiting to be yielded in order)
+            pending = {}
+            next_index = 0
+            next_to_yield = 0
+            done = {}
+            while next_index < len(texts) and len(pending) < max_concurrency:
+                pending[pool.submit(run, next_index)] = next_index
+                next_index += 1
+
+            while pending:
+                future = next(as_completed(pending))
+                del pending[future]
+                result = future.result()
+                if next_index < len(texts):
+                    pending[pool.submit(run, next_index)] = next_index
+                    next_index += 1
+
+                if not ordered:
+                    yield result
+                    continue
+                done[result.index] = result
+                while next_to_yield in done:
+                    yield done.pop(next_to_yield)
+                    next_to_yield += 1
+
+    async def detect_intent_batch_async(self, text_list, max_concurrency=8, session_id=None):
+        """
+        asyncio variant of detect_intent_batch built on SessionsAsyncClient:
+        all requests share one channel and no thread is blocked per request.
+
+        :param text_list: List of user text inputs
+        :param max_concurrency: Maximum number of requests in flight
+        :param session_id: Run every query in this session instead
+        :return: List of BatchResult, in input order
+        """
+        if self._async_sessions_client is None:
+            self._async_sessions_client = self._async_client_factory()
+        client = self._async_sessions_client
+        semaphore = asyncio.Semaphore(max(1, max_concurrency))
+        batch_id = uuid.uuid4().hex[:8]
+
+        async def run(index, text):
+            text_input = dialogflow.TextInput(text=text, language_code=self.language_code)
+            query_input = dialogflow.QueryInput(text=text_input)
+            session_path = self.get_session_path(session_id or f"batch-{batch_id}-{index}")
+            async with semaphore:
+                try:
+                    response = await client.detect_intent(
+                        request={"session": session_path, "query_input": query_input}
+                    )
+                    return BatchResult(index, text, response, None)
+                except Exception as e:
+                    return BatchResult(index, text, None, e)
+
+        return await asyncio.gather(*(run(i, text) for i, text in enumerate(text_list)))
+
+    def _detect_intent_text(self, text, session_id=None, query_params=None):
+        """
+        Internal method to send a single text query to Dialogflow.
+
+        :param text: User input text
+        :param session_id: Session ID, defaults to the helper's session
+        :param query_params: Optional QueryParameters (input contexts, reset_contexts, ...)
+        :return: Dialogflow DetectIntentResponse object
+        """
+        session_path = self.get_session_path(session_id)
+
+        # Context-free answers ("hi", "help") can be served from the cache
+        cache = self.response_cache
+        if cache is not None:
+            if query_params is not None and query_params.contexts:
+                cache.track_contexts(session_path, True)
+            elif query_params is None or not query_params.reset_contexts:
+                cached = cache.lookup(session_path, text, self.language_code)
+                if cached is not None:
+                    return cached
+
+        # Build the text input
+        text_input = dialogflow.TextInput(text=text, language_code=self.language_code)
+        query_input = dialogflow.QueryInput(text=text_input)
+
+        # Make API request
+        request = {"session": session_path, "query_input": query_input}
+        if query_params is not None:
+            request["query_params"] = query_params
+        response = self._detect_intent_request(request)
+
+        if cache is not None:
+            cache.store(session_path, text, self.language_code, response)
+        return response
+
+    def _detect_intent_request(self, request):
+        """
+        DetectIntent under the circuit breaker, deadline, retry and hedge policies.
+
+        :param request: DetectIntentRequest fields (dict)
+        :return: Dialogflow DetectIntentResponse object
+        """
+        self._allow_call()
+        try:
+            if self.hedge is None:
+                with self.clients.client() as client:
+                    response = client.detect_intent(request=request, retry=self.retry,
+                                                    timeout=self.timeout)
+            else:
+                response = self._detect_intent_hedged(dialogflow.DetectIntentRequest(request))
+        except Exception as e:
+            self._record_call(e)
+            raise
+        self._record_call()
+        return response
+
+    def _detect_intent_hedged(self, request):
+        """
+        DetectIntent with a hedge: if the first request hasn't answered after
+        the hedge policy's delay (or failed with UNAVAILABLE before), a second
+        one is sent and the first answer wins; the other one is cancelled.
+        Both share the deadline, and each takes its client from the pool.
+
+        :param request: DetectIntentRequest
+        :return: DetectIntentResponse
+        """
+        metadata = (gapic_v1.routing_header.to_grpc_metadata((("session", request.session),)),)
+        started = time.monotonic()
+        deadline = started + self.timeout
+        answered = threading.Event()
+
+        def send(timeout):
+            index, client = self.clients.acquire()
+
+            def done(_):
+                self.clients.release(index)
+                answered.set()
+
+            # The gRPC stub directly: its futures can be waited on and
+            # cancelled without a thread per request
+            try:
+                future = client.transport.detect_intent.future(request, timeout=timeout,
+                                                               metadata=metadata)
+            except Exception:
+                self.clients.release(index)
+                raise
+            future.add_done_callback(done)
+            return future
+
+        attempts = [send(self.timeout)]
+        try:
+            answered.wait(self.hedge.delay())
+            first = attempts[0]
+            if first.done() and first.code() != grpc.StatusCode.UNAVAILABLE:
+                return self._hedge_result(first, started, hedge_won=False)
+
+            remaining = deadline - time.monotonic()
+            if remaining > 0 and self.hedge.should_hedge():
+                attempts.append(send(remaining))
+
+            # The first successful answer, else the last failure
+            while True:
+                answered.clear()
+                pending = []
+                for attempt in attempts:
+                    if not attempt.done():
+                        pending.append(attempt)
+                    elif attempt.code() == grpc.StatusCode.OK:
+                        return self._hedge_result(attempt, started, hedge_won=attempt is not first)
+                if not pending:
+                    return self._hedge_result(attempts[-1], started, hedge_won=False)
+                # gRPC ends the calls at the deadline, the margin is a safety net
+                answered.wait(max(0.0, deadline - time.monotonic()) + 1.0)
+        finally:
+            for attempt in attempts:
+                attempt.cancel()
+
+    def _hedge_result(self, future, started, hedge_won):
+        """:return: The response of a finished attempt, or raise its error as a GoogleAPICallError"""
+        self.hedge.record(time.monotonic() - started, hedge_won)
+        try:
+            return future.result()
+        except grpc.RpcError as e:
+            raise exceptions.from_grpc_error(e) from e
+
+    def detect_intent_with_contexts(self, text, context_name, lifespan_count=5, parameters=None,
+                                    session_id=None):
+        """
+        Detect intent for text with an input context. The context rides along
+        in the detect_intent request (query_params.contexts), so this is a
+        single round trip.
+
+        :param text: The user query text
+        :param context_name: The context name to set
+        :param lifespan_count: Number of conversational turns for which the context remains active
+        :param parameters: Parameters for the context: a dict of plain values or of
+                           google.protobuf.struct_pb2.Value, or a Struct
+        :param session_id: Session ID, defaults to the helper's session
+        :return: Dialogflow DetectIntentResponse object
+        """
+        session_id = session_id or self.session_id
+        query_params = None
+        if context_name:
+            context = dialogflow.Context(
+                name=self.get_context_path(session_id, context_name),
+                lifespan_count=lifespan_count,
+                # Marshalled to a Struct like the event parameters
+                parameters=parameters or {}
+            )
+            query_params = dialogflow.QueryParameters(contexts=[context])
+
+        # Send text
+        response = self._detect_intent_text(text, session_id, query_params)
+        return response
+
+    def detect_intent_with_reset(self, text, session_id=None):
+        """
+        Detect intent for text after dropping every active context of the
+        session, in the same request (query_params.reset_contexts).
+
+        :param text: The user query text
+        :param session_id: Session ID, defaults to the helper's session
+        :return: Dialogflow DetectIntentResponse object
+        """
+        query_params = dialogflow.QueryParameters(reset_contexts=True)
+        return self._detect_intent_text(text, session_id, query_params)
+
+    def clear_contexts(self, session_id=None):
+        """
+        Clears all active contexts for a session with a single
+        DeleteAllContexts call instead of one delete per context.
+
+        :param session_id: Session ID, defaults to the helper's session
+        """
+        session_path = self.get_session_path(session_id)
+        self.contexts_client.delete_all_contexts(parent=session_path)
+        if self.response_cache is not None:
+            self.response_cache.track_contexts(session_path, False)
+
+    def detect_intent_with_event(self, event_name, parameters=None, session_id=None):
+        """
+        Trigger a custom event to Dialogflow rather than sending user text.
+
+        :param event_name: Name of the event
+        :param parameters: Parameters to pass along with the event: a dict of plain
+                           values or of google.protobuf.struct_pb2.Value, or a Struct
+        :param session_id: Session ID, defaults to the helper's session
+        :return: Dialogflow DetectIntentResponse object
+        """
+        event_input = dialogflow.EventInput(name=event_name,
+                                            language_code=self.language_code,
+                                            # Values of any of those forms are marshalled to a Struct
+                                            parameters=parameters or {})
+        query_input = dialogflow.QueryInput(event=event_input)
+        return self._detect_intent_request({"session": self.get_session_path(session_id),
+                                            "query_input": query_input})
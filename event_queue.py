@@ -0,0 +1,517 @@
+#!/usr/bin/env python
+# --coding:utf-8--
+
+import json
+import logging
+import os
+import socket
+import sqlite3
+import threading
+import time
+import zlib
+from collections import deque
+
+logger = logging.getLogger(__name__)
+
+
+def process_start(pid):
+    """:return: Start time of a process in clock ticks since boot (Linux /proc), None if unknown"""
+    try:
+        with open(f"/proc/{pid}/stat", "rb") as f:
+            stat = f.read()
+    except OSError:
+        return None
+    # Fields are counted after the command name, which may contain spaces
+    return stat.rpartition(b")")[2].split()[19].decode()
+
+
+def consumer_name():
+    """
+    Name of this process as a queue consumer: host:pid:start time, so a
+    later process given the same pid doesn't pass for this one.
+    """
+    pid = os.getpid()
+    start = process_start(pid)
+    return f"{socket.gethostname()}:{pid}" + (f":{start}" if start else "")
+
+
+def partition_of(message, partitions):
+    """
+    Partition of a message: a stable hash of its chat_id, so every message
+    of a chat lands in the same partition (and is handled by one process).
+    """
+    if partitions <= 1:
+        return 0
+    return zlib.crc32(message.get("chat_id", "").encode("utf-8")) % partitions
+
+
+class RedisStreamQueue:
+    """
+    Durable event queue on a Redis Stream with a consumer group.
+
+    put() is a single XADD; consumers read new entries with XREADGROUP and
+    XACK + XDEL them once handled. Entries a consumer claimed but did not
+    ack within `visibility` seconds (it crashed or was killed) are taken
+    over with XAUTOCLAIM by the next consumer that asks for work.
+
+    With `partitions` > 1 every partition is its own stream
+    ("<stream>:<n>"), and a consumer given a `partition` only reads that
+    one, which keeps a chat's messages on one process.
+    """
+
+    def __init__(self, redis_client, stream="lark:events", group="bot", consumer=None,
+                 visibility=120, partitions=1, partition=None):
+        """
+        :param redis_client: redis.Redis instance
+        :param stream: Stream key
+        :param group: Consumer group shared by every process of the bot
+        :param consumer: Name of this consumer, defaults to consumer_name()
+        :param visibility: Seconds after which an unacked entry is redelivered
+        :param partitions: Number of partitions messages are spread over by chat
+        :param partition: Partition this consumer reads, None for all of them
+        """
+        import redis
+
+        self.redis_client = redis_client
+        self.stream = stream
+        self.group = group
+        self.consumer = consumer or consumer_name()
+        self.visibility = visibility
+        self.partitions = partitions
+        self._next_reclaim = 0.0
+
+        if partitions > 1:
+            self.streams = [f"{stream}:{n}" for n in range(partitions)]
+        else:
+            self.streams = [stream]
+        self._read = self.streams if partition is None else [self.streams[partition]]
+
+        for name in self.streams:
+            try:
+                redis_client.xgroup_create(name, group, id="0", mkstream=True)
+            except redis.ResponseError as e:
+                if "BUSYGROUP" not in str(e):
+                    raise
+
+    def put(self, message):
+        """
+        Append a message.
+
+        :return: Entry ID, "<stream>/<id>"
+        """
+        name = self.streams[partition_of(message, self.partitions)]
+        entry_id = self.redis_client.xadd(name, {"message": json.dumps(message)})
+        return self._entry(name, entry_id)
+
+    def get(self, count=100, timeout=1.0):
+        """
+        Claim up to `count` entries for this consumer, waiting up to `timeout`
+        seconds for new ones. Stale entries of other consumers come first.
+
+        :return: list of (entry ID, message, redelivered)
+        """
+        entries = []
+        now = time.monotonic()
+        if now >= self._next_reclaim:
+            self._next_reclaim = now + self.visibility / 4
+            for name in self._read:
+                reply = self.redis_client.xautoclaim(name, self.group, self.consumer,
+                                                     min_idle_time=int(self.visibility * 1000),
+                                                     start_id="0-0", count=count)
+                entries.extend((name, entry_id, fields, True)
+                               for entry_id, fields in reply[1] if fields)
+
+        if not entries:
+            reply = self.redis_client.xreadgroup(self.group, self.consumer,
+                                                 {name: ">" for name in self._read},
+                                                 count=count, block=int(timeout * 1000))
+            for name, items in reply or []:
+                entries.extend((name, entry_id, fields, False) for entry_id, fields in items)
+
+        result = []
+        for name, entry_id, fields, redelivered in entries:
+            raw = fields.get("message") or fields.get(b"message")
+            result.append((self._entry(name, entry_id), json.loads(raw), redelivered))
+        return result
+
+    def ack(self, entry_id):
+        name, _, entry_id = entry_id.rpartition("/")
+        pipe = self.redis_client.pipeline(transaction=False)
+        pipe.xack(name, self.group, entry_id)
+        pipe.xdel(name, entry_id)
+        pipe.execute()
+
+    def touch(self, entry_ids):
+        """Renew this consumer's claims of entries it still holds (XCLAIM resets their idle time)."""
+        by_stream = {}
+        for entry in entry_ids:
+            name, _, entry_id = entry.rpartition("/")
+            by_stream.setdefault(name, []).append(entry_id)
+        pipe = self.redis_client.pipeline(transaction=False)
+        for name, ids in by_stream.items():
+            pipe.xclaim(name, self.group, self.consumer, 0, ids, justid=True)
+        pipe.execute()
+
+    def pending(self):
+        """Number of entries not acked yet (in the partitions this consumer reads)."""
+        return sum(self.redis_client.xlen(name) for name in self._read)
+
+    @staticmethod
+    def _entry(name, entry_id):
+        if isinstance(name, bytes):
+            name = name.decode()
+        if isinstance(entry_id, bytes):
+            entry_id = entry_id.decode()
+        return f"{name}/{entry_id}"
+
+
+class SqliteEventQueue:
+    """
+    Durable event queue in a local SQLite file (WAL), for deployments
+    without Redis.
+
+    Entries are claimed with a single UPDATE ... RETURNING, so several
+    processes can consume the same file. A claim that is not acked within
+    `visibility` seconds is handed out again; claims held by a process of
+    this host that no longer exists are released as soon as the queue is
+    opened, so a restart picks up its in-flight messages right away.
+
+    With `partitions` > 1 every entry records the partition of its chat,
+    and a consumer given a `partition` only claims entries of that one.
+    """
+
+    def __init__(self, path="events.sqlite3", consumer=None, visibility=120,
+                 partitions=1, partition=None):
+        """
+        :param path: SQLite database file
+        :param consumer: Name of this consumer, defaults to consumer_name()
+        :param visibility: Seconds after which an unacked entry is redelivered
+        :param partitions: Number of partitions messages are spread over by chat
+        :param partition: Partition this consumer claims from, None for all of them
+        """
+        self.path = path
+        self.consumer = consumer or consumer_name()
+        self.visibility = visibility
+        self.partitions = partitions
+        self.partition = partition
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None,
+                                     timeout=30)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        # A committed put survives a crash of the process (not of the machine)
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS events ("
+            "id INTEGER PRIMARY KEY AUTOINCREMENT, body TEXT NOT NULL, "
+            "owner TEXT, claimed_at REAL, deliveries INTEGER NOT NULL DEFAULT 0, "
+            "part INTEGER NOT NULL DEFAULT 0)"
+        )
+        columns = [row[1] for row in self._conn.execute("PRAGMA table_info(events)")]
+        if "part" not in columns:
+            # Queue files created before partitioning
+            self._conn.execute("ALTER TABLE events ADD COLUMN part INTEGER NOT NULL DEFAULT 0")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS events_part ON events (part, id)")
+        self._lock = threading.Lock()
+        # Wakes a waiting get() of this process as soon as put() adds an entry
+        self._added = threading.Event()
+        self._release_dead_owners()
+
+    def put(self, message):
+        """
+        Append a message.
+
+        :return: Entry ID
+        """
+        body = json.dumps(message)
+        part = partition_of(message, self.partitions)
+        with self._lock:
+            entry_id = self._conn.execute("INSERT INTO events (body, part) VALUES (?, ?)",
+                                          (body, part)).lastrowid
+        self._added.set()
+        return entry_id
+
+    def get(self, count=100, timeout=1.0):
+        """
+        Claim up to `count` entries for this consumer, oldest first, waiting
+        up to `timeout` seconds if there are none.
+
+        :return: list of (entry ID, message, redelivered)
+        """
+        deadline = time.monotonic() + timeout
+        while True:
+            self._added.clear()
+            now = time.time()
+            with self._lock:
+                rows = self._conn.execute(
+                    "UPDATE events SET owner = ?, claimed_at = ?, deliveries = deliveries + 1 "
+                    "WHERE id IN (SELECT id FROM events WHERE (owner IS NULL OR claimed_at < ?) "
+                    + ("AND part = ? " if self.partition is not None else "")
+                    + "ORDER BY id LIMIT ?) RETURNING id, body, deliveries",
+                    (self.consumer, now, now - self.visibility)
+                    + ((self.partition,) if self.partition is not None else ())
+                    + (count,),
+                ).fetchall()
+            if rows:
+                rows.sort()
+                return [(entry_id, json.loads(body), deliveries > 1)
+                        for entry_id, body, deliveries in rows]
+
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return []
+            # Other processes' puts are only seen by polling
+            self._added.wait(min(remaining, 0.05))
+
+    def ack(self, entry_id):
+        with self._lock:
+            self._conn.execute("DELETE FROM events WHERE id = ?", (entry_id,))
+
+    def touch(self, entry_ids):
+        """Renew this consumer's claims of entries it still holds."""
+        entry_ids = list(entry_ids)
+        now = time.time()
+        with self._lock:
+            # Within SQLite's limit of bound parameters
+            for i in range(0, len(entry_ids), 500):
+                chunk = entry_ids[i:i + 500]
+                self._conn.execute(
+                    "UPDATE events SET claimed_at = ? WHERE owner = ? AND id IN ("
+                    + ",".join("?" * len(chunk)) + ")",
+                    (now, self.consumer, *chunk),
+                )
+
+    def pending(self):
+        """Number of entries not acked yet (in the partition this consumer claims from)."""
+        with self._lock:
+            if self.partition is None:
+                return self._conn.execute("SELECT COUNT(*) FROM events").fetchone()[0]
+            return self._conn.execute("SELECT COUNT(*) FROM events WHERE part = ?",
+                                      (self.partition,)).fetchone()[0]
+
+    def _release_dead_owners(self):
+        host = socket.gethostname()
+        with self._lock:
+            owners = [row[0] for row in self._conn.execute(
+                "SELECT DISTINCT owner FROM events WHERE owner IS NOT NULL")]
+        for owner in owners:
+            # host:pid:start, or host:pid in queue files of older versions
+            owner_host, pid, start = (owner.split(":") + [None])[:3]
+            if owner_host != host or not (pid or "").isdigit():
+                continue
+            try:
+                os.kill(int(pid), 0)
+                alive = True
+            except ProcessLookupError:
+                alive = False
+            except PermissionError:
+                # Owned by another user
+                alive = True
+            # A live pid may belong to a later process that reused it
+            if alive and (start is None or process_start(pid) in (None, start)):
+                continue
+            with self._lock:
+                self._conn.execute("UPDATE events SET owner = NULL WHERE owner = ?", (owner,))
+
+
+class EventConsumer:
+    """
+    Drains a durable event queue into the message pipeline.
+
+    One thread claims entries in queue order and hands them to `submit`
+    (e.g. WorkerPool.offer), never holding more than `max_inflight`
+    unacked messages, so the pipeline's own queue cannot overflow. A
+    message `submit` refuses is offered again, before any later entry, so
+    a full pipeline can't reorder a chat. The handler calls done(message)
+    when it finished with a message, which acks its entry, or
+    release(message) when the pipeline gave up on it without handling it;
+    a released message, or one whose process dies before done(), is
+    delivered again (at-least-once).
+
+    The claims of the entries it holds are renewed every third of the
+    queue's visibility timeout, so neither this consumer nor another one
+    takes back a message that is still waiting in the pipeline.
+    """
+
+    def __init__(self, event_queue, submit, max_inflight=1000, batch=100, name="consumer"):
+        """
+        :param event_queue: RedisStreamQueue or SqliteEventQueue
+        :param submit: Callable taking a message; returns False if it was not accepted
+        :param max_inflight: Maximum number of claimed, unacked messages; keep it
+                             well under what the pipeline handles within the
+                             queue's visibility timeout
+        :param batch: Maximum number of entries claimed at once
+        :param name: Thread name
+        """
+        self.event_queue = event_queue
+        self.submit = submit
+        self.max_inflight = max_inflight
+        self.batch = batch
+
+        # Entry IDs claimed and not acked or released yet
+        self._claimed = set()
+        self._touch_every = getattr(event_queue, "visibility", 120) / 3
+        self._touch_at = time.monotonic() + self._touch_every
+        # Claimed messages submit refused, oldest first
+        self._held = deque()
+        self._cond = threading.Condition()
+        self._stopping = False
+
+        # Counters
+        self.consumed = 0
+        self.redelivered = 0
+        self.acked = 0
+        self.released = 0
+        self.refused = 0
+        self.errors = 0
+
+        self._thread = threading.Thread(target=self._run, name=name, daemon=True)
+        self._thread.start()
+
+    def done(self, message):
+        """
+        Ack a handled message. Call it once per message, also when handling failed.
+        """
+        entry_id = message.get("queue_id")
+        if entry_id is None:
+            return
+        try:
+            self.event_queue.ack(entry_id)
+        except Exception as e:
+            # The entry is redelivered after the visibility timeout
+            logger.warning("event queue ack failed: %r", e)
+            with self._cond:
+                self.errors += 1
+        with self._cond:
+            self.acked += 1
+            self._claimed.discard(entry_id)
+            self._cond.notify_all()
+
+    def release(self, message):
+        """
+        Give a claimed message back without acking it, e.g. when it was
+        refused after submit accepted it. Its entry is delivered again
+        after the visibility timeout. Call it instead of done(), not as well.
+        """
+        entry_id = message.get("queue_id")
+        if entry_id is None:
+            return
+        with self._cond:
+            self.released += 1
+            # No longer renewed, so it times out
+            self._claimed.discard(entry_id)
+            self._cond.notify_all()
+
+    def stop(self, drain=True, timeout=30.0):
+        """
+        Stop consuming. With `drain`, first keep going until the queue is
+        empty and every claimed message was acked, or `timeout` seconds passed.
+        """
+        deadline = time.monotonic() + timeout
+        if drain:
+            with self._cond:
+                while time.monotonic() < deadline:
+                    if not self._claimed and self._queue_empty():
+                        break
+                    self._cond.wait(0.1)
+        with self._cond:
+            self._stopping = True
+            self._cond.notify_all()
+        self._thread.join(max(0.0, deadline - time.monotonic()) + 2.0)
+
+    def stats(self):
+        """
+        :return: dict of consumer counters
+        """
+        with self._cond:
+            stats = {
+                "consumed": self.consumed,
+                "redelivered": self.redelivered,
+                "acked": self.acked,
+                "released": self.released,
+                "refused": self.refused,
+                "inflight": len(self._claimed),
+                "errors": self.errors,
+            }
+        try:
+            stats["pending"] = self.event_queue.pending()
+        except Exception:
+            stats["pending"] = None
+        return stats
+
+    def _queue_empty(self):
+        try:
+            return self.event_queue.pending() <= len(self._claimed)
+        except Exception:
+            return True
+
+    def _hand_over(self):
+        """
+        Submit the held messages in order, stopping at the first one refused.
+
+        :return: True if none are left
+        """
+        while self._held:
+            if not self.submit(self._held[0]):
+                with self._cond:
+                    self.refused += 1
+                return False
+            self._held.popleft()
+        return True
+
+    def _renew_claims(self):
+        """Renew the claims of the held and in-flight entries when they are due."""
+        now = time.monotonic()
+        if now < self._touch_at:
+            return
+        self._touch_at = now + self._touch_every
+        with self._cond:
+            entry_ids = list(self._claimed)
+        if not entry_ids:
+            return
+        try:
+            self.event_queue.touch(entry_ids)
+        except Exception as e:
+            # They may be handed out again after the visibility timeout
+            logger.warning("event queue claim renewal failed: %r", e)
+            with self._cond:
+                self.errors += 1
+
+    def _run(self):
+        while True:
+            self._renew_claims()
+            if not self._hand_over():
+                # The pipeline is full; later entries must not overtake the held ones
+                with self._cond:
+                    if self._stopping:
+                        return
+                    self._cond.wait(0.05)
+                continue
+
+            with self._cond:
+                if not self._stopping and len(self._claimed) >= self.max_inflight:
+                    self._cond.wait(max(0.0, self._touch_at - time.monotonic()))
+                    continue
+                if self._stopping:
+                    return
+                room = min(self.batch, self.max_inflight - len(self._claimed))
+
+            try:
+                entries = self.event_queue.get(count=room, timeout=1.0)
+            except Exception as e:
+                logger.warning("event queue read failed: %r", e)
+                with self._cond:
+                    self.errors += 1
+                time.sleep(1.0)
+                continue
+
+            for entry_id, message, redelivered in entries:
+                with self._cond:
+                    if entry_id in self._claimed:
+                        # Our own claim timed out (e.g. a renewal failed); the
+                        # message is still in the pipeline
+                        continue
+                    self._claimed.add(entry_id)
+                    self.consumed += 1
+                    if redelivered:
+                        self.redelivered += 1
+                message["queue_id"] = entry_id
+                self._held.append(message)
@@ -0,0 +1,381 @@
+#!/usr/bin/env python
+# --coding:utf-8--
+
+import json
+import logging
+import math
+import os
+import random
+import re
+import threading
+import zipfile
+from collections import defaultdict, namedtuple
+
+from response_cache import ContextTracker, IntentResponseCache
+
+logger = logging.getLogger(__name__)
+
+# A local answer: the intent, how sure the matcher is (1.0 for an exact
+# training phrase), "exact" or "fuzzy", and the fulfillment messages as
+# (kind, value) pairs, see DialogflowHelper.iter_fulfillment_messages()
+IntentMatch = namedtuple("IntentMatch", ["intent", "confidence", "method", "messages"])
+
+_WORD = re.compile(r"[^\W_]+")
+# CJK text has no spaces between words, it is indexed as character bigrams
+_CJK = re.compile("[\u3040-\u30ff\u3400-\u4dbf\u4e00-\u9fff\uac00-\ud7af]+")
+
+# Message types of an exported intent response
+_TEXT, _CARD, _PAYLOAD = 0, 1, 4
+
+
+def tokenize(text):
+    """
+    :return: List of tokens of a normalized text (words, CJK character bigrams)
+    """
+    tokens = []
+    for word in _WORD.findall(text):
+        start = 0
+        for run in _CJK.finditer(word):
+            if run.start() > start:
+                tokens.append(word[start:run.start()])
+            chars = run.group()
+            if len(chars) == 1:
+                tokens.append(chars)
+            else:
+                tokens.extend(chars[i:i + 2] for i in range(len(chars) - 1))
+            start = run.end()
+        if start < len(word):
+            tokens.append(word[start:])
+    return tokens
+
+
+class _Intent:
+    """An intent of the export: its name, whether it may be answered locally, its responses."""
+
+    __slots__ = ("name", "static", "messages")
+
+    def __init__(self, name, static, messages):
+        self.name = name
+        self.static = static
+        self.messages = messages
+
+
+class IntentIndex:
+    """
+    Training phrases of an exported agent, indexed for matching: a dict of
+    normalized phrase -> intent for exact matches, and a TF-IDF inverted
+    index of tokens for fuzzy ones. Immutable once built.
+    """
+
+    def __init__(self, intents, phrases):
+        """
+        :param intents: List of _Intent
+        :param phrases: List of (normalized phrase, index of its intent)
+        """
+        self.intents = intents
+        self.exact = {}
+        ambiguous = set()
+        for phrase, intent in phrases:
+            if self.exact.setdefault(phrase, intent) != intent:
+                ambiguous.add(phrase)
+        # A phrase trained on two intents is Dialogflow's call to make
+        for phrase in ambiguous:
+            self.exact[phrase] = None
+
+        counts = []
+        document_frequency = defaultdict(int)
+        for phrase, _ in phrases:
+            tf = defaultdict(int)
+            for token in tokenize(phrase):
+                tf[token] += 1
+            counts.append(tf)
+            for token in tf:
+                document_frequency[token] += 1
+
+        total = len(phrases)
+        self.idf = {token: math.log((1 + total) / (1 + df)) + 1.0
+                    for token, df in document_frequency.items()}
+        # Tokens never seen in training count as rare ones
+        self.unknown_idf = math.log(1 + total) + 1.0
+        self.postings = defaultdict(list)
+        self.phrase_intents = []
+        for phrase_id, ((_, intent), tf) in enumerate(zip(phrases, counts)):
+            weights = {token: count * self.idf[token] for token, count in tf.items()}
+            norm = math.sqrt(sum(w * w for w in weights.values())) or 1.0
+            for token, weight in weights.items():
+                self.postings[token].append((phrase_id, weight / norm))
+            self.phrase_intents.append(intent)
+
+    def best(self, normalized):
+        """
+        :return: (intent index or None, confidence, method, confidence of the
+                 closest other intent) of the closest phrase
+        """
+        if normalized in self.exact:
+            return self.exact[normalized], 1.0, "exact", 0.0
+
+        tf = defaultdict(int)
+        for token in tokenize(normalized):
+            tf[token] += 1
+        if not tf:
+            return None, 0.0, "fuzzy", 0.0
+        weights = {token: count * self.idf.get(token, self.unknown_idf) for token, count in tf.items()}
+        norm = math.sqrt(sum(w * w for w in weights.values()))
+
+        scores = defaultdict(float)
+        for token, weight in weights.items():
+            for phrase_id, phrase_weight in self.postings.get(token, ()):
+                scores[phrase_id] += weight * phrase_weight
+        # Cosine similarity of the closest phrase of every intent
+        by_intent = {}
+        for phrase_id, score in scores.items():
+            intent = self.phrase_intents[phrase_id]
+            if score > by_intent.get(intent, 0.0):
+                by_intent[intent] = score
+        if not by_intent:
+            return None, 0.0, "fuzzy", 0.0
+        ranked = sorted(by_intent.items(), key=lambda item: item[1], reverse=True)
+        runner_up = ranked[1][1] / norm if len(ranked) > 1 else 0.0
+        return ranked[0][0], ranked[0][1] / norm, "fuzzy", runner_up
+
+
+def load_agent(path, language_code="en"):
+    """
+    Build an IntentIndex from a Dialogflow ES agent export (the zip file
+    from the console, or its extracted directory).
+
+    Intents with input contexts can't match a fresh session and are left
+    out. The others are indexed, but only static ones are answered
+    locally: no webhook, no parameters, no output or reset contexts, not a
+    fallback, and a text, card or payload response in the language. The
+    phrases of the rest (fallback negative examples included) still match,
+    and then defer to Dialogflow.
+
+    :param path: Export zip file or directory
+    :param language_code: Language of the training phrases and responses
+    :return: IntentIndex
+    """
+    files = _read_export(path)
+    intents = []
+    phrases = []
+    for name in sorted(files):
+        if not name.startswith("intents/") or "_usersays_" in name or not name.endswith(".json"):
+            continue
+        intent = json.loads(files[name])
+        if intent.get("contexts"):
+            continue
+        messages = _static_messages(intent, language_code)
+        intents.append(_Intent(intent.get("name", ""), messages is not None, messages or []))
+
+        usersays = files.get(f"{name[:-len('.json')]}_usersays_{language_code}.json")
+        for example in json.loads(usersays) if usersays else []:
+            data = example.get("data", [])
+            if example.get("isTemplate") or not data:
+                continue
+            text = IntentResponseCache.normalize("".join(part.get("text", "") for part in data))
+            if text:
+                phrases.append((text, len(intents) - 1))
+    return IntentIndex(intents, phrases)
+
+
+def _read_export(path):
+    """:return: dict of relative file name -> bytes of the export's JSON files"""
+    files = {}
+    if zipfile.is_zipfile(path):
+        with zipfile.ZipFile(path) as archive:
+            for name in archive.namelist():
+                if name.endswith(".json"):
+                    files[name] = archive.read(name)
+        return files
+    for root, _, names in os.walk(path):
+        for name in names:
+            if name.endswith(".json"):
+                full = os.path.join(root, name)
+                with open(full, "rb") as f:
+                    files[os.path.relpath(full, path).replace(os.sep, "/")] = f.read()
+    return files
+
+
+def _static_messages(intent, language_code):
+    """
+    :return: The response messages of a static intent, as (kind, variants),
+             or None if the intent can't be answered locally
+    """
+    if intent.get("fallbackIntent") or intent.get("webhookUsed") or not intent.get("responses"):
+        return None
+    response = intent["responses"][0]
+    if response.get("affectedContexts") or response.get("parameters") or response.get("resetContexts"):
+        return None
+
+    messages = []
+    for message in response.get("messages", []):
+        if message.get("lang", language_code) != language_code or message.get("platform"):
+            continue
+        if message.get("condition"):
+            return None
+        kind = int(message.get("type", _TEXT))
+        if kind == _TEXT:
+            speech = message.get("speech", [])
+            messages.append(("text", [speech] if isinstance(speech, str) else list(speech)))
+        elif kind == _CARD:
+            messages.append(("card", {
+                "title": message.get("title", ""),
+                "subtitle": message.get("subtitle", ""),
+                "image_uri": message.get("imageUrl", ""),
+                "buttons": [{"text": b.get("text", ""), "postback": b.get("postback", "")}
+                            for b in message.get("buttons", [])],
+            }))
+        elif kind == _PAYLOAD:
+            messages.append(("payload", message.get("payload", {})))
+        else:
+            # Quick replies, images, ...: not mapped locally
+            return None
+    return messages or None
+
+
+class IntentMatcher:
+    """
+    Answers queries that match a static intent of an exported Dialogflow ES
+    agent in-process, so they don't need a detect_intent call.
+
+    A query is answered when its normalized text is a training phrase of a
+    static intent (confidence 1.0), or when its TF-IDF cosine similarity to
+    the closest training phrase reaches `threshold` and beats the closest
+    phrase of any other intent by `margin` ("cancel my" is as close to
+    "cancel my order" as to "cancel my plan"). Anything else, and
+    every query of a session with active contexts (tell the matcher about
+    Dialogflow's answers with observe()), is left to Dialogflow.
+
+    With `reload_interval`, the export is checked for changes in the
+    background and the index swapped when it was updated; a broken export
+    keeps the previous index.
+    """
+
+    def __init__(self, path, language_code="en", threshold=0.85, margin=0.1, reload_interval=0,
+                 max_sessions=10000):
+        """
+        :param path: Agent export zip file or directory
+        :param language_code: Language of the queries
+        :param threshold: Minimum confidence of a local answer, in (0, 1]
+        :param margin: Minimum lead of a fuzzy match over the next intent
+        :param reload_interval: Seconds between checks for a new export, 0 to disable
+        :param max_sessions: Maximum number of sessions with contexts tracked
+        """
+        self.path = path
+        self.language_code = language_code
+        self.threshold = threshold
+        self.margin = margin
+        self.reload_interval = reload_interval
+        self.contexts = ContextTracker(max_sessions=max_sessions)
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+
+        # Counters
+        self.exact = 0
+        self.fuzzy = 0
+        self.misses = 0
+        self.bypasses = 0
+        self.reloads = 0
+
+        self._version = self._export_version()
+        self.index = load_agent(path, language_code)
+        logger.info("intent matcher loaded", extra={"path": path, "intents": len(self.index.intents),
+                                                    "phrases": len(self.index.phrase_intents)})
+        if reload_interval:
+            threading.Thread(target=self._watch, name="intent-matcher-reload", daemon=True).start()
+
+    def match(self, text, session=None):
+        """
+        :param text: User query
+        :param session: Session the query belongs to (any unique key)
+        :return: IntentMatch, or None to ask Dialogflow
+        """
+        if session is not None and self.contexts.active(session):
+            self._count("bypasses")
+            return None
+        index = self.index
+        intent_id, confidence, method, runner_up = index.best(IntentResponseCache.normalize(text))
+        intent = index.intents[intent_id] if intent_id is not None else None
+        if (intent is None or not intent.static or confidence < self.threshold
+                or confidence - runner_up < self.margin):
+            self._count("misses")
+            return None
+        self._count(method)
+        # Dialogflow picks one of the text variants at random too
+        messages = [("text", [random.choice(value)]) if kind == "text" and value else (kind, value)
+                    for kind, value in intent.messages]
+        return IntentMatch(intent.name, confidence, method, messages)
+
+    def observe(self, session, response):
+        """
+        Record whether a Dialogflow answer left contexts active in the session.
+
+        :param response: DetectIntentResponse
+        """
+        self.contexts.track(session, bool(response.query_result.output_contexts))
+
+    def reload(self):
+        """
+        Rebuild the index from the export now.
+
+        :return: True if the new index is in use
+        """
+        version = self._export_version()
+        try:
+            index = load_agent(self.path, self.language_code)
+        except Exception as e:
+            # Not retried until the export changes again
+            self._version = version
+            logger.error("intent matcher reload failed, keeping the previous index: %r", e)
+            return False
+        # Swapped in one assignment, matches in flight keep the old one
+        self.index = index
+        self._version = version
+        self._count("reloads")
+        logger.info("intent matcher reloaded", extra={"intents": len(index.intents),
+                                                      "phrases": len(index.phrase_intents)})
+        return True
+
+    def stop(self):
+        self._stop.set()
+
+    def stats(self):
+        """
+        :return: dict of matcher counters
+        """
+        with self._lock:
+            queries = self.exact + self.fuzzy + self.misses + self.bypasses
+            return {
+                "intents": len(self.index.intents),
+                "phrases": len(self.index.phrase_intents),
+                "exact": self.exact,
+                "fuzzy": self.fuzzy,
+                "misses": self.misses,
+                "bypasses": self.bypasses,
+                "hit_rate": round((self.exact + self.fuzzy) / queries, 4) if queries else 0.0,
+                "reloads": self.reloads,
+            }
+
+    def _count(self, name):
+        with self._lock:
+            setattr(self, name, getattr(self, name) + 1)
+
+    def _export_version(self):
+        """:return: Latest modification time of the export's files"""
+        if not os.path.isdir(self.path):
+            return os.stat(self.path).st_mtime_ns
+        latest = 0
+        for root, _, names in os.walk(self.path):
+            for name in names:
+                latest = max(latest, os.stat(os.path.join(root, name)).st_mtime_ns)
+        return latest
+
+    def _watch(self):
+        while not self._stop.wait(self.reload_interval):
+            try:
+                changed = self._export_version() != self._version
+            except OSError as e:
+                logger.warning("intent matcher export unreadable: %r", e)
+                continue
+            if changed:
+                self.reload()
@@ -0,0 +1,191 @@
+#!/usr/bin/env python
+# --coding:utf-8--
+
+import asyncio
+import json
+import random
+import time
+
+import urllib3
+
+LARK_API_BASE = "https://open.feishu.cn"
+
+# HTTP statuses worth retrying: rate limited or a transient server error
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+# Open API "request too frequent" error code
+RATE_LIMIT_CODES = {99991400}
+
+
+def is_rate_limited(status, rsp_dict):
+    """
+    Whether an Open API response means the call was throttled.
+
+    :param status: HTTP status code
+    :param rsp_dict: Decoded response body
+    :return: bool
+    """
+    return status == 429 or rsp_dict.get("code") in RATE_LIMIT_CODES
+
+
+class LarkClient:
+    """
+    Shared HTTP client for the Lark Open API.
+
+    Keeps a pool of keep-alive connections (urllib3.PoolManager) so replies
+    don't pay a new TCP + TLS handshake each, bounds every call with connect
+    and read timeouts, and retries 5xx / rate-limited responses with
+    exponential backoff and full jitter. A call that got no response is only
+    retried if it never reached Lark (the connection failed) or is safe to
+    repeat: a send that timed out may have been delivered, and retrying it
+    would post the reply twice. The pool is thread-safe; async callers use
+    the `a*` coroutines, which run the call in a worker thread.
+    """
+
+    def __init__(self, base_url=LARK_API_BASE, pool_size=10, connect_timeout=3.0,
+                 read_timeout=10.0, max_retries=3, backoff_base=0.2, backoff_max=5.0,
+                 retry_throttled=True):
+        """
+        :param base_url: Open API origin, e.g. https://open.feishu.cn
+        :param pool_size: Maximum number of keep-alive connections kept per host
+        :param connect_timeout: Seconds allowed to establish a connection
+        :param read_timeout: Seconds allowed between bytes of the response
+        :param max_retries: Retries after the first attempt
+        :param backoff_base: Base delay in seconds, doubled on every retry
+        :param backoff_max: Upper bound of a single backoff delay in seconds
+        :param retry_throttled: Retry rate-limited calls here; turn it off when
+                                the caller queues and retries them itself
+                                (OutboundLimiter), so the backoff doesn't block
+                                its sender thread
+        """
+        self.base_url = base_url.rstrip("/")
+        self.max_retries = max_retries
+        self.retry_throttled = retry_throttled
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.timeout = urllib3.Timeout(connect=connect_timeout, read=read_timeout)
+        self.pool = urllib3.PoolManager(num_pools=4, maxsize=pool_size, block=False,
+                                        timeout=self.timeout, retries=False)
+
+        # Counters
+        self.requests = 0
+        self.retries = 0
+        self.errors = 0
+
+    def post_json(self, path, body, token=None, idempotent=False, retry_throttled=None):
+        """
+        POST a JSON body to the Open API.
+
+        :param path: API path, e.g. /open-apis/message/v4/send/
+        :param body: JSON-serializable request body
+        :param token: Optional tenant_access_token for the Authorization header
+        :param idempotent: The call may be repeated after a read timeout or a
+                           dropped connection (e.g. a token fetch); otherwise
+                           only calls that failed to connect are retried
+        :param retry_throttled: Retry rate-limited responses, defaults to the client's setting
+        :return: (HTTP status, decoded JSON body as dict); status 0 if no response was received
+        """
+        headers = {"Content-Type": "application/json"}
+        if token:
+            headers["Authorization"] = "Bearer " + token
+        data = json.dumps(body).encode("utf-8")
+        url = self.base_url + path
+        if retry_throttled is None:
+            retry_throttled = self.retry_throttled
+
+        attempt = 0
+        while True:
+            self.requests += 1
+            retry_after = None
+            unsent = False
+            try:
+                rsp = self.pool.request("POST", url, body=data, headers=headers)
+                status = rsp.status
+                rsp_dict = self._decode(rsp.data)
+                retry_after = rsp.headers.get("Retry-After")
+            except urllib3.exceptions.HTTPError as e:
+                status, rsp_dict = 0, {"code": -1, "msg": repr(e)}
+                # Includes NewConnectionError: the request never left
+                unsent = isinstance(e, urllib3.exceptions.ConnectTimeoutError)
+
+            if status == 0:
+                retryable = unsent or idempotent
+            elif is_rate_limited(status, rsp_dict):
+                retryable = retry_throttled
+            else:
+                retryable = status in RETRY_STATUSES
+            if not retryable or attempt >= self.max_retries:
+                if retryable:
+                    self.errors += 1
+                return status, rsp_dict
+
+            attempt += 1
+            self.retries += 1
+            time.sleep(self._backoff(attempt, retry_after))
+
+    async def apost_json(self, path, body, token=None):
+        """Async variant of post_json for callers running on an event loop."""
+        return await asyncio.to_thread(self.post_json, path, body, token)
+
+    def tenant_access_token(self, app_id, app_secret):
+        """
+        Request a tenant_access_token for an internal app.
+
+        :return: (HTTP status, response dict)
+        """
+        return self.post_json("/open-apis/auth/v3/tenant_access_token/internal/",
+                              {"app_id": app_id, "app_secret": app_secret},
+                              idempotent=True, retry_throttled=True)
+
+    def send_message(self, token, chat_id, text):
+        """
+        Send a text message to a chat.
+
+        :return: (HTTP status, response dict)
+        """
+        return self.send(token, chat_id, "text", {"text": text})
+
+    def send(self, token, chat_id, msg_type, content):
+        """
+        Send a message of any type to a chat.
+
+        :param msg_type: "text", "post", "image", "share_chat" or "interactive"
+        :param content: The message content; for "interactive" this is the card
+        :return: (HTTP status, response dict)
+        """
+        req_body = {
+            "chat_id": chat_id,
+            "msg_type": msg_type,
+        }
+        # Cards go in a top-level "card" field, everything else in "content"
+        if msg_type == "interactive":
+            req_body["card"] = content
+        else:
+            req_body["content"] = content
+        return self.post_json("/open-apis/message/v4/send/", req_body, token)
+
+    async def asend_message(self, token, chat_id, text):
+        """Async variant of send_message."""
+        return await asyncio.to_thread(self.send_message, token, chat_id, text)
+
+    def close(self):
+        """Close every pooled connection."""
+        self.pool.clear()
+
+    def _backoff(self, attempt, retry_after=None):
+        """Exponential backoff with full jitter, honouring a Retry-After header."""
+        if retry_after:
+            try:
+                return min(float(retry_after), self.backoff_max)
+            except ValueError:
+                pass
+        ceiling = min(self.backoff_max, self.backoff_base * (2 ** (attempt - 1)))
+        return random.uniform(0, ceiling)
+
+    @staticmethod
+    def _decode(raw):
+        try:
+            rsp_dict = json.loads(raw)
+        except ValueError:
+            return {"code": -1, "msg": raw[:200].decode("utf-8", "replace")}
+        return rsp_dict if isinstance(rsp_dict, dict) else {"code": -1, "msg": str(rsp_dict)}
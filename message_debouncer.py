@@ -0,0 +1,277 @@
+#!/usr/bin/env python
+# --coding:utf-8--
+
+import heapq
+import itertools
+import json
+import logging
+import threading
+import time
+from collections import Counter, deque
+
+logger = logging.getLogger(__name__)
+
+
+class PendingBurst:
+    """Text messages of one sender waiting to be merged."""
+
+    __slots__ = ("messages", "texts", "chars", "first_at", "last_at", "arrived")
+
+    def __init__(self, now):
+        self.messages = []
+        self.texts = []
+        self.chars = 0
+        self.first_at = now
+        self.last_at = now
+        # Arrival time of every message, for the added delay
+        self.arrived = []
+
+
+class MessageDebouncer:
+    """
+    Per-sender debounce window in front of the message pipeline.
+
+    Users often split one request over several messages ("hi" / "I need" /
+    "help with my order"). Consecutive text messages with the same key
+    (chat and sender) are held until the sender has been quiet for `window`
+    seconds, then handed to `downstream` as one message whose text is the
+    texts joined with spaces, so they cost one detect_intent call and one
+    reply. The added latency is capped: a burst is flushed at the latest
+    `max_delay` seconds after its first message, or as soon as it holds
+    `max_messages` messages or its text would exceed `max_chars`.
+
+    The merged message is a copy of the last one, with the earlier
+    originals under "merged" (e.g. to ack their durable queue entries).
+    Other message types flush the sender's burst and pass through, so the
+    order of a sender's messages is kept.
+    """
+
+    def __init__(self, downstream, window=1.0, max_delay=3.0, max_messages=5, max_chars=256,
+                 key=None, on_flush=None, on_reject=None, samples=1000):
+        """
+        :param downstream: Callable taking a message; returns False if it was not accepted
+        :param window: Seconds of silence after which a burst is flushed
+        :param max_delay: Seconds after its first message a burst is flushed at the latest
+        :param max_messages: Number of messages flushing a burst right away
+        :param max_chars: Longest merged text (Dialogflow takes 256 characters)
+        :param key: Callable returning a message's debounce key, defaults to
+                    (chat_id, sender open_id)
+        :param on_flush: Optional callable taking the number of messages of a
+                         flushed burst and the delay (seconds) added to each
+        :param on_reject: Optional callable taking every message of a burst
+                          downstream refused, e.g. to give its durable queue
+                          entry back for redelivery
+        :param samples: Number of recent added delay samples kept
+        """
+        self.downstream = downstream
+        self.window = window
+        self.max_delay = max(window, max_delay)
+        self.max_messages = max(1, max_messages)
+        self.max_chars = max_chars
+        self.key = key or sender_key
+        self.on_flush = on_flush
+        self.on_reject = on_reject
+
+        # key -> PendingBurst
+        self._bursts = {}
+        # (due time, seq, key, burst); stale entries are skipped when popped
+        self._schedule = []
+        self._seq = itertools.count()
+        self._cond = threading.Condition()
+        # Held from the pop of a burst to the end of its downstream call, so
+        # bursts of a key reach downstream in order
+        self._flush_lock = threading.Lock()
+        self._delays = deque(maxlen=samples)
+        self._stopping = False
+
+        # Counters
+        self.messages = 0
+        self.batches = 0
+        self.flushed = 0
+        self.passed_through = 0
+        self.rejected = 0
+        self.flushed_by = Counter()
+
+        self._thread = threading.Thread(target=self._run, name="debounce", daemon=True)
+        self._thread.start()
+
+    def submit(self, message):
+        """
+        Hold a text message for its sender's burst, or pass another type through.
+
+        :param message: Lark message dict
+        :return: True, or what downstream returned for a message passed through
+                 (a flushed burst that downstream refuses goes to on_reject)
+        """
+        text = message_text(message)
+        key = self.key(message)
+        flushed = []
+        with self._cond:
+            if text is None or self._stopping:
+                if text is None:
+                    self.passed_through += 1
+                flushed.append(self._take_locked(key, "passthrough"))
+                self._flush_lock.acquire()
+            else:
+                now = time.monotonic()
+                burst = self._bursts.get(key)
+                if burst is not None and burst.chars + 1 + len(text) > self.max_chars:
+                    # Too long to merge: the burst goes first, this one starts the next
+                    flushed.append(self._take_locked(key, "max_chars"))
+                    burst = None
+                if burst is None:
+                    burst = self._bursts[key] = PendingBurst(now)
+                    heapq.heappush(self._schedule, (now + self.window, next(self._seq), key, burst))
+                    self._cond.notify()
+                burst.messages.append(message)
+                burst.texts.append(text)
+                burst.chars += len(text) + (1 if burst.chars else 0)
+                burst.last_at = now
+                burst.arrived.append(now)
+                self.messages += 1
+                if len(burst.messages) >= self.max_messages:
+                    flushed.append(self._take_locked(key, "max_messages"))
+                if not flushed:
+                    return True
+                message = None
+                # Taken before the condition is released, see __init__
+                self._flush_lock.acquire()
+        try:
+            self._deliver(flushed)
+            return self.downstream(message) if message is not None else True
+        finally:
+            self._flush_lock.release()
+
+    def stats(self):
+        """
+        :return: dict of debouncer counters, the coalescing ratio (messages
+                 per detect_intent call) and added delay percentiles (ms)
+        """
+        with self._cond:
+            delays = sorted(self._delays)
+            stats = {
+                "messages": self.messages,
+                "batches": self.batches,
+                "coalescing_ratio": round(self._ratio_locked(), 3),
+                "passed_through": self.passed_through,
+                "rejected": self.rejected,
+                "flushed_by": dict(self.flushed_by),
+                "pending": sum(len(b.messages) for b in self._bursts.values()),
+                "senders_pending": len(self._bursts),
+            }
+        for pct in (50, 99):
+            index = min(len(delays) - 1, int(len(delays) * pct / 100))
+            stats[f"delay_p{pct}_ms"] = round(delays[index] * 1000, 1) if delays else 0.0
+        stats["delay_max_ms"] = round(delays[-1] * 1000, 1) if delays else 0.0
+        return stats
+
+    def coalescing_ratio(self):
+        """:return: Text messages per merged message handed downstream (1.0 before any)"""
+        with self._cond:
+            return self._ratio_locked()
+
+    def shutdown(self):
+        """Flush every burst now and stop the background thread; later messages pass through."""
+        with self._cond:
+            self._stopping = True
+            self._cond.notify_all()
+        self._thread.join()
+        with self._cond:
+            flushed = [self._take_locked(key, "shutdown") for key in list(self._bursts)]
+            self._flush_lock.acquire()
+        try:
+            self._deliver(flushed)
+        finally:
+            self._flush_lock.release()
+
+    def _take_locked(self, key, reason):
+        """:return: The key's burst, removed and counted as flushed, or None"""
+        burst = self._bursts.pop(key, None)
+        if burst is not None:
+            now = time.monotonic()
+            self.batches += 1
+            self.flushed += len(burst.messages)
+            self.flushed_by[reason] += 1
+            delays = [now - arrived for arrived in burst.arrived]
+            self._delays.extend(delays)
+            if self.on_flush is not None:
+                self.on_flush(len(burst.messages), delays)
+        return burst
+
+    def _ratio_locked(self):
+        return self.flushed / self.batches if self.batches else 1.0
+
+    def _deliver(self, bursts):
+        """Hand bursts downstream, with the flush lock held."""
+        for burst in bursts:
+            if burst is None or self.downstream(merge(burst)):
+                continue
+            # Under the flush lock; taking the condition here could deadlock
+            self.rejected += len(burst.messages)
+            logger.warning("debounced messages not accepted downstream",
+                           extra={"chat_id": burst.messages[-1].get("chat_id", ""),
+                                  "messages": len(burst.messages)})
+            if self.on_reject is not None:
+                for message in burst.messages:
+                    try:
+                        self.on_reject(message)
+                    except Exception as e:
+                        logger.warning("on_reject failed: %r", e)
+
+    def _run(self):
+        while True:
+            with self._cond:
+                if self._stopping:
+                    return
+                now = time.monotonic()
+                if not self._schedule:
+                    self._cond.wait()
+                    continue
+                due, _, key, burst = self._schedule[0]
+                if due > now:
+                    self._cond.wait(due - now)
+                    continue
+                heapq.heappop(self._schedule)
+                if self._bursts.get(key) is not burst:
+                    # Already flushed
+                    continue
+                cap = burst.first_at + self.max_delay
+                due = min(burst.last_at + self.window, cap)
+                if due > now:
+                    # More messages came in: wait for the sender to go quiet
+                    heapq.heappush(self._schedule, (due, next(self._seq), key, burst))
+                    continue
+                burst = self._take_locked(key, "max_delay" if due >= cap else "idle")
+                self._flush_lock.acquire()
+            try:
+                self._deliver([burst])
+            finally:
+                self._flush_lock.release()
+
+
+def sender_key(message):
+    """Debounce key of a message: its chat and sender."""
+    sender = message.get("sender", {}).get("sender_id", {}).get("open_id", "")
+    return message.get("chat_id", ""), sender
+
+
+def message_text(message):
+    """:return: Text of a Lark text message, None for other types"""
+    if message.get("message_type", "") != "text":
+        return None
+    try:
+        content = json.loads(message.get("content", "{}"))
+    except ValueError:
+        return None
+    text = content.get("text") if isinstance(content, dict) else None
+    return text if isinstance(text, str) else None
+
+
+def merge(burst):
+    """:return: The message a burst is handed downstream as"""
+    if len(burst.messages) == 1:
+        return burst.messages[0]
+    merged = dict(burst.messages[-1])
+    merged["content"] = json.dumps({"text": " ".join(burst.texts)}, ensure_ascii=False)
+    merged["merged"] = burst.messages[:-1]
+    return merged
@@ -0,0 +1,251 @@
+#!/usr/bin/env python
+# --coding:utf-8--
+
+"""
+In-process metrics in the Prometheus text exposition format.
+
+Counters, gauges and histograms are registered on a Registry (REGISTRY by
+default) and rendered by Registry.render() for a GET /metrics route. An
+update is a dict lookup and an addition under a lock, so they can stay on
+in the hot path; gauges built with a callback cost nothing until scraped.
+"""
+
+import bisect
+import math
+import threading
+import time
+
+# Seconds, from a cache hit to a slow Open API / Dialogflow call
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1,
+                   0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+class Registry:
+    """A set of metrics rendered together."""
+
+    def __init__(self):
+        self._metrics = []
+        self._lock = threading.Lock()
+
+    def register(self, metric):
+        with self._lock:
+            self._metrics.append(metric)
+        return metric
+
+    def render(self):
+        """
+        :return: Every metric in the Prometheus text format (version 0.0.4)
+        """
+        with self._lock:
+            metrics = list(self._metrics)
+        lines = []
+        for metric in metrics:
+            lines.append(f"# HELP {metric.name} {metric.help}")
+            lines.append(f"# TYPE {metric.name} {metric.type}")
+            lines.extend(metric.samples())
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+def _format_labels(names, values, extra=()):
+    pairs = [f'{n}="{_escape(v)}"' for n, v in zip(names, values)]
+    pairs.extend(f'{n}="{v}"' for n, v in extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_value(value):
+    return "+Inf" if value == math.inf else repr(value)
+
+
+class _Metric:
+    type = "untyped"
+
+    def __init__(self, name, help, labelnames=(), registry=REGISTRY):
+        """
+        :param name: Metric name, e.g. bot_events_total
+        :param help: One-line description
+        :param labelnames: Names of the labels; values are given to labels()
+        :param registry: Registry to render it with, None to keep it unregistered
+        """
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+        self._children = {}
+        if registry is not None:
+            registry.register(self)
+
+    def labels(self, *values):
+        """
+        :return: The child metric for these label values (created on first use)
+        """
+        child = self._children.get(values)
+        if child is None:
+            with self._lock:
+                child = self._children.setdefault(values, self._new_child())
+        return child
+
+    def samples(self):
+        with self._lock:
+            children = list(self._children.items())
+        lines = []
+        for values, child in children:
+            lines.extend(child.samples(self.name, self.labelnames, values))
+        return lines
+
+    def _new_child(self):
+        raise NotImplementedError
+
+
+class _Value:
+    def __init__(self):
+        self.value = 0.0
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1.0):
+        with self._lock:
+            self.value += amount
+
+    def dec(self, amount=1.0):
+        with self._lock:
+            self.value -= amount
+
+    def set(self, value):
+        self.value = value
+
+    def samples(self, name, labelnames, values):
+        return [f"{name}{_format_labels(labelnames, values)} {_format_value(self.value)}"]
+
+
+class Counter(_Metric):
+    """A value that only goes up, e.g. events received."""
+
+    type = "counter"
+
+    def __init__(self, name, help, labelnames=(), registry=REGISTRY):
+        super().__init__(name, help, labelnames, registry)
+        if not self.labelnames:
+            self._default = self.labels()
+
+    def inc(self, amount=1.0):
+        self._default.inc(amount)
+
+    def _new_child(self):
+        return _Value()
+
+
+class Gauge(_Metric):
+    """
+    A value that goes up and down, e.g. messages in flight. With `fn`, the
+    value is read from it when the metrics are rendered.
+    """
+
+    type = "gauge"
+
+    def __init__(self, name, help, labelnames=(), registry=REGISTRY, fn=None):
+        """
+        :param fn: Optional callable returning the current value (unlabelled gauges only)
+        """
+        super().__init__(name, help, labelnames, registry)
+        self.fn = fn
+        if not self.labelnames:
+            self._default = self.labels()
+
+    def inc(self, amount=1.0):
+        self._default.inc(amount)
+
+    def dec(self, amount=1.0):
+        self._default.dec(amount)
+
+    def set(self, value):
+        self._default.set(value)
+
+    def samples(self):
+        if self.fn is not None:
+            try:
+                value = self.fn()
+            except Exception:
+                # A failing source is left out of the scrape rather than failing it
+                return []
+            return [f"{self.name} {_format_value(value)}"]
+        return super().samples()
+
+    def _new_child(self):
+        return _Value()
+
+
+class _HistogramValue:
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self._lock = threading.Lock()
+
+    def observe(self, value):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            self.counts[index] += 1
+            self.sum += value
+
+    def samples(self, name, labelnames, values):
+        with self._lock:
+            counts = list(self.counts)
+            total = self.sum
+        lines = []
+        cumulative = 0
+        for bound, count in zip(self.buckets + (math.inf,), counts):
+            cumulative += count
+            labels = _format_labels(labelnames, values, (("le", _format_value(bound)),))
+            lines.append(f"{name}_bucket{labels} {cumulative}")
+        labels = _format_labels(labelnames, values)
+        lines.append(f"{name}_sum{labels} {total!r}")
+        lines.append(f"{name}_count{labels} {cumulative}")
+        return lines
+
+
+class _Timer:
+    # A class rather than @contextmanager: it is on every request
+    __slots__ = ("value", "start")
+
+    def __init__(self, value):
+        self.value = value
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.value.observe(time.perf_counter() - self.start)
+        return False
+
+
+class Histogram(_Metric):
+    """Distribution of durations (or sizes) in fixed buckets."""
+
+    type = "histogram"
+
+    def __init__(self, name, help, labelnames=(), registry=REGISTRY, buckets=DEFAULT_BUCKETS):
+        """
+        :param buckets: Increasing upper bounds; +Inf is added
+        """
+        self.buckets = tuple(sorted(buckets))
+        super().__init__(name, help, labelnames, registry)
+        if not self.labelnames:
+            self._default = self.labels()
+
+    def observe(self, value):
+        self._default.observe(value)
+
+    def time(self):
+        """Observe the duration of the with block, in seconds."""
+        return _Timer(self._default)
+
+    def _new_child(self):
+        return _HistogramValue(self.buckets)
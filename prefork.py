@@ -0,0 +1,183 @@
+#!/usr/bin/env python
+# --coding:utf-8--
+
+"""
+Multi-process serving: runs N copies of the bot that share the webhook port.
+
+Every worker binds the port with SO_REUSEPORT, so the kernel spreads the
+incoming connections over them and JSON decoding and handler work use as
+many cores as there are workers. State the workers must agree on lives
+outside of them: the tenant_access_token (TOKEN_SHARED_REDIS), the dedup
+(Redis or SQLite) and the durable event queue, which is partitioned by
+chat so all messages of a chat are handled by one worker, in order.
+
+A worker that exits (crashed, or retired after WORKER_MAX_REQUESTS
+requests or above WORKER_MAX_RSS_MB of memory) is started again.
+
+Usage: python prefork.py [--workers N] [-- command ...]   (default: python bot_v2.py)
+"""
+
+import argparse
+import logging
+import os
+import random
+import resource
+import signal
+import subprocess
+import sys
+import time
+
+from structured_log import setup_logging
+
+logger = logging.getLogger(__name__)
+
+
+def rss_mb():
+    """Resident memory of this process in MiB."""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / (1024 * 1024)
+    except (OSError, ValueError):
+        # Peak instead of current, in KiB on Linux and bytes on macOS
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak / (1024 * 1024) if sys.platform == "darwin" else peak / 1024
+
+
+class WorkerLifetime:
+    """
+    Decides when a worker should retire: after `max_requests` requests
+    (spread by a random jitter so workers don't all restart together) or
+    once its memory grows above `max_rss_mb`.
+    """
+
+    def __init__(self, max_requests=0, max_rss_mb=0, jitter=0.1, check_every=100):
+        """
+        :param max_requests: Requests after which to retire, 0 for no limit
+        :param max_rss_mb: Resident memory in MiB above which to retire, 0 for no limit
+        :param jitter: Fraction of max_requests added at random
+        :param check_every: Check the memory every N requests
+        """
+        self.max_requests = max_requests + int(max_requests * jitter * random.random())
+        self.max_rss_mb = max_rss_mb
+        self.check_every = check_every
+        self.requests = 0
+        self.retiring = False
+
+    def tick(self):
+        """
+        Count a request.
+
+        :return: True once, when the worker should retire
+        """
+        self.requests += 1
+        if self.retiring:
+            return False
+        if self.max_requests and self.requests >= self.max_requests:
+            logger.info("retiring after %d requests", self.requests, extra={"pid": os.getpid()})
+            self.retiring = True
+        elif self.max_rss_mb and self.requests % self.check_every == 0:
+            rss = rss_mb()
+            if rss > self.max_rss_mb:
+                logger.info("retiring at %.0f MiB", rss, extra={"pid": os.getpid()})
+                self.retiring = True
+        return self.retiring
+
+
+class PreforkSupervisor:
+    """
+    Starts `workers` copies of a command and keeps them running.
+
+    Each copy gets WORKER_INDEX (0..N-1) and SERVER_WORKERS in its
+    environment; a copy that exits is started again with the same index.
+    """
+
+    def __init__(self, command, workers, env=None, restart_delay=1.0, stop_timeout=35.0):
+        """
+        :param command: argv of one worker
+        :param workers: Number of workers
+        :param env: Extra environment variables for the workers
+        :param restart_delay: Seconds to wait before restarting a worker that died within a second
+        :param stop_timeout: Seconds a worker gets to drain on stop before it is killed
+        """
+        self.command = command
+        self.workers = workers
+        self.env = env or {}
+        self.restart_delay = restart_delay
+        self.stop_timeout = stop_timeout
+        self.procs = [None] * workers
+        self._started_at = [0.0] * workers
+        self._stopping = False
+
+        # Counters
+        self.restarts = 0
+
+    def start(self):
+        for index in range(self.workers):
+            self._spawn(index)
+
+    def monitor(self):
+        """Restart workers as they exit, until stop() is called."""
+        while not self._stopping:
+            for index, proc in enumerate(self.procs):
+                if self._stopping or proc is None or proc.poll() is None:
+                    continue
+                logger.warning("worker exited with %s, restarting", proc.returncode,
+                               extra={"worker": index, "pid": proc.pid})
+                if time.monotonic() - self._started_at[index] < 1.0:
+                    # Crash loop: don't spin
+                    time.sleep(self.restart_delay)
+                self.restarts += 1
+                self._spawn(index)
+            time.sleep(0.2)
+
+    def stop(self):
+        """Ask every worker to drain and exit; kill the ones that don't in time."""
+        self._stopping = True
+        for proc in self.procs:
+            if proc is not None and proc.poll() is None:
+                proc.send_signal(signal.SIGTERM)
+        deadline = time.monotonic() + self.stop_timeout
+        for proc in self.procs:
+            if proc is None:
+                continue
+            try:
+                proc.wait(max(0.0, deadline - time.monotonic()))
+            except subprocess.TimeoutExpired:
+                proc.kill()
+                proc.wait()
+
+    def run(self):
+        """Start the workers and supervise them until SIGTERM / Ctrl+C."""
+        signal.signal(signal.SIGTERM, signal.default_int_handler)
+        self.start()
+        logger.info("start (%d workers).....", self.workers)
+        try:
+            self.monitor()
+        except KeyboardInterrupt:
+            pass
+        self.stop()
+
+    def _spawn(self, index):
+        env = dict(os.environ, **self.env)
+        env["WORKER_INDEX"] = str(index)
+        env["SERVER_WORKERS"] = str(self.workers)
+        self.procs[index] = subprocess.Popen(self.command, env=env)
+        self._started_at[index] = time.monotonic()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run several bot workers on one port.")
+    parser.add_argument("--workers", type=int,
+                        default=int(os.environ.get("SERVER_WORKERS", "0")) or os.cpu_count())
+    parser.add_argument("command", nargs=argparse.REMAINDER,
+                        help="Worker command (default: python bot_v2.py)")
+    args = parser.parse_args()
+    setup_logging(os.environ.get("LOG_LEVEL", "INFO"), os.environ.get("LOG_FORMAT", "json"))
+
+    command = args.command[1:] if args.command[:1] == ["--"] else args.command
+    command = command or [sys.executable, "bot_v2.py"]
+    PreforkSupervisor(command, args.workers).run()
+
+
+if __name__ == "__main__":
+    main()
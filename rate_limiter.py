@@ -0,0 +1,318 @@
+#!/usr/bin/env python
+# --coding:utf-8--
+
+import heapq
+import itertools
+import logging
+import random
+import threading
+import time
+from collections import OrderedDict, deque
+
+from lark_client import is_rate_limited
+
+logger = logging.getLogger(__name__)
+
+
+class TokenBucket:
+    """
+    Token bucket: `rate` tokens per second, holding at most `burst`.
+    Not thread-safe on its own; OutboundLimiter guards it with its lock.
+    """
+
+    __slots__ = ("rate", "burst", "tokens", "updated")
+
+    def __init__(self, rate, burst=None):
+        """
+        :param rate: Tokens added per second
+        :param burst: Bucket capacity, defaults to one second worth of tokens
+        """
+        self.rate = rate
+        self.burst = burst if burst is not None else max(1.0, rate)
+        self.tokens = self.burst
+        self.updated = time.monotonic()
+
+    def wait_time(self, now):
+        """
+        Seconds until a token is available (0 if one is available now).
+        """
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= 1:
+            return 0.0
+        return (1 - self.tokens) / self.rate
+
+    def take(self):
+        self.tokens -= 1
+
+
+class PendingSend:
+    """A queued outbound message."""
+
+    __slots__ = ("msg_type", "content", "queued_at", "attempts", "merged")
+
+    def __init__(self, msg_type, content):
+        self.msg_type = msg_type
+        self.content = content
+        self.queued_at = time.monotonic()
+        self.attempts = 0
+        self.merged = 1
+
+
+class OutboundLimiter:
+    """
+    Rate limiter and retry queue in front of the Open API send endpoint.
+
+    Every send takes a token from a global (per-app) bucket and from the
+    bucket of its chat. When either is empty, or Lark answers "too many
+    requests", the message is queued instead of lost and sent later by a
+    few background threads, with jittered backoff after a throttled attempt
+    (a scheduled time, not a sleep, so other chats keep being served).
+    Once a chat has queued messages its later messages queue behind them,
+    and only one of them is in flight at a time, so a chat still sees its
+    messages in order.
+
+    With `coalesce`, a text message for a chat that is over its limit is
+    merged into the chat's last queued text message instead of waiting for
+    its own token.
+    """
+
+    def __init__(self, send, rate=50.0, chat_rate=5.0, burst=None, chat_burst=None,
+                 coalesce=False, max_pending=10000, max_attempts=5, backoff_base=0.5,
+                 backoff_max=10.0, max_chats=10000, max_merged_chars=4000, samples=1000,
+                 workers=4):
+        """
+        :param send: Callable (chat_id, msg_type, content) -> (HTTP status, response dict)
+        :param rate: Sends per second for the whole app
+        :param chat_rate: Sends per second to one chat
+        :param burst: Global bucket capacity, defaults to `rate`
+        :param chat_burst: Per-chat bucket capacity, defaults to `chat_rate`
+        :param coalesce: Merge queued text replies to the same chat into one message
+        :param max_pending: Maximum number of queued messages; new ones are dropped beyond it
+        :param max_attempts: Throttled attempts after which a message is dropped
+        :param backoff_base: Base delay in seconds after a throttled attempt, doubled every time
+        :param backoff_max: Upper bound of that delay in seconds
+        :param max_chats: Number of per-chat buckets kept (least recently used evicted)
+        :param max_merged_chars: Longest text a merged message may grow to
+        :param samples: Number of recent queueing delay samples kept
+        :param workers: Background threads sending queued messages, so a slow
+                        send doesn't stall the queues of other chats
+        """
+        self.send_fn = send
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.coalesce = coalesce
+        self.max_pending = max_pending
+        self.max_attempts = max_attempts
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.max_chats = max_chats
+        self.max_merged_chars = max_merged_chars
+
+        self._global = TokenBucket(rate, burst)
+        self._chat_buckets = OrderedDict()
+        # chat_id -> deque of PendingSend; a chat is in here while it has queued
+        # messages or one of them is being sent by the background thread
+        self._queued = {}
+        self._pending = 0
+        # (due time, seq, chat_id); at most one entry per chat, none while in flight
+        self._schedule = []
+        self._seq = itertools.count()
+        self._cond = threading.Condition()
+        self._delays = deque(maxlen=samples)
+        self._stopping = False
+
+        # Counters
+        self.sent = 0
+        self.failed = 0
+        self.dropped = 0
+        self.queued = 0
+        self.coalesced = 0
+        self.throttled_local = 0
+        self.throttled_remote = 0
+        self.retried = 0
+
+        self._threads = [threading.Thread(target=self._run, name=f"outbound-{i}", daemon=True)
+                         for i in range(max(1, workers))]
+        for thread in self._threads:
+            thread.start()
+
+    def send(self, chat_id, msg_type, content):
+        """
+        Send a message now if the limits allow it, else queue it.
+
+        :return: True if it was sent or queued, False if it failed or was dropped
+        """
+        with self._cond:
+            queued = self._queued.get(chat_id)
+            if queued is not None:
+                # Keep the chat's order: behind what is already waiting
+                return self._enqueue_locked(chat_id, PendingSend(msg_type, content))
+
+            wait = self._acquire_locked(chat_id, time.monotonic())
+            if wait:
+                self.throttled_local += 1
+                return self._enqueue_locked(chat_id, PendingSend(msg_type, content), wait)
+
+        pending = PendingSend(msg_type, content)
+        sent, retry_delay = self._deliver(chat_id, pending)
+        if retry_delay is None:
+            return sent
+        with self._cond:
+            return self._enqueue_locked(chat_id, pending, retry_delay, front=True)
+
+    def stats(self):
+        """
+        :return: dict of limiter counters and queueing delay percentiles (ms)
+        """
+        with self._cond:
+            delays = sorted(self._delays)
+            stats = {
+                "sent": self.sent,
+                "failed": self.failed,
+                "dropped": self.dropped,
+                "queued": self.queued,
+                "coalesced": self.coalesced,
+                "throttled_local": self.throttled_local,
+                "throttled_remote": self.throttled_remote,
+                "retried": self.retried,
+                "pending": self._pending,
+                "chats_queued": len(self._queued),
+            }
+        for pct in (50, 99):
+            index = min(len(delays) - 1, int(len(delays) * pct / 100))
+            stats[f"queue_delay_p{pct}_ms"] = round(delays[index] * 1000, 1) if delays else 0.0
+        return stats
+
+    def shutdown(self, wait=True, timeout=10.0):
+        """
+        Stop the background sender, by default after flushing the queue
+        (bounded by `timeout` seconds).
+        """
+        if wait:
+            deadline = time.monotonic() + timeout
+            with self._cond:
+                while self._pending and time.monotonic() < deadline:
+                    self._cond.wait(0.05)
+        with self._cond:
+            self._stopping = True
+            self._cond.notify_all()
+        for thread in self._threads:
+            thread.join()
+
+    def _acquire_locked(self, chat_id, now):
+        """
+        Take a token from both buckets, or return the seconds to wait.
+        """
+        bucket = self._chat_buckets.get(chat_id)
+        if bucket is None:
+            bucket = self._chat_buckets[chat_id] = TokenBucket(self.chat_rate, self.chat_burst)
+            # The least recently used buckets have long refilled; a new one behaves the same
+            while len(self._chat_buckets) > self.max_chats:
+                self._chat_buckets.popitem(last=False)
+        else:
+            self._chat_buckets.move_to_end(chat_id)
+
+        wait = max(self._global.wait_time(now), bucket.wait_time(now))
+        if wait:
+            return wait
+        self._global.take()
+        bucket.take()
+        return 0.0
+
+    def _enqueue_locked(self, chat_id, pending, wait=0.0, front=False):
+        queued = self._queued.get(chat_id)
+        if (self.coalesce and not front and queued and pending.msg_type == "text"
+                and queued[-1].msg_type == "text" and queued[-1].attempts == 0):
+            last = queued[-1]
+            merged = last.content.get("text", "") + "\n\n" + pending.content.get("text", "")
+            if len(merged) <= self.max_merged_chars:
+                last.content = {"text": merged}
+                last.merged += 1
+                self.coalesced += 1
+                return True
+
+        if not front and self._pending >= self.max_pending:
+            self.dropped += 1
+            logger.warning("outbound queue full, message dropped", extra={"chat_id": chat_id})
+            return False
+
+        if queued is None:
+            queued = self._queued[chat_id] = deque()
+            heapq.heappush(self._schedule, (time.monotonic() + wait, next(self._seq), chat_id))
+            self._cond.notify()
+        if front:
+            queued.appendleft(pending)
+        else:
+            queued.append(pending)
+            self.queued += 1
+        self._pending += 1
+        return True
+
+    def _deliver(self, chat_id, pending):
+        """
+        Send one message.
+
+        :return: (sent, retry delay in seconds or None)
+        """
+        try:
+            status, rsp_dict = self.send_fn(chat_id, pending.msg_type, pending.content)
+        except Exception as e:
+            logger.warning("outbound send failed: %r", e, extra={"chat_id": chat_id})
+            status, rsp_dict = 0, {"code": -1, "msg": repr(e)}
+
+        with self._cond:
+            if status == 200 and rsp_dict.get("code", -1) == 0:
+                self.sent += pending.merged
+                return True, None
+
+            if not is_rate_limited(status, rsp_dict):
+                self.failed += pending.merged
+                return False, None
+
+            self.throttled_remote += 1
+            pending.attempts += 1
+            if pending.attempts >= self.max_attempts:
+                self.failed += pending.merged
+                logger.warning("throttled, giving up after %d attempts", pending.attempts,
+                               extra={"chat_id": chat_id})
+                return False, None
+            self.retried += 1
+            ceiling = min(self.backoff_max, self.backoff_base * (2 ** (pending.attempts - 1)))
+            return False, random.uniform(ceiling / 2, ceiling)
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._stopping:
+                    now = time.monotonic()
+                    if self._schedule and self._schedule[0][0] <= now:
+                        break
+                    self._cond.wait(self._schedule[0][0] - now if self._schedule else None)
+                if self._stopping:
+                    return
+
+                _, _, chat_id = heapq.heappop(self._schedule)
+                queued = self._queued[chat_id]
+                wait = self._acquire_locked(chat_id, now)
+                if wait:
+                    heapq.heappush(self._schedule, (now + wait, next(self._seq), chat_id))
+                    continue
+                # The chat stays in _queued while in flight, so new sends queue behind it
+                pending = queued.popleft()
+                self._pending -= 1
+                self._delays.append(now - pending.queued_at)
+
+            _, retry_delay = self._deliver(chat_id, pending)
+
+            with self._cond:
+                now = time.monotonic()
+                if retry_delay is not None:
+                    queued.appendleft(pending)
+                    self._pending += 1
+                    heapq.heappush(self._schedule, (now + retry_delay, next(self._seq), chat_id))
+                elif queued:
+                    heapq.heappush(self._schedule, (now, next(self._seq), chat_id))
+                else:
+                    del self._queued[chat_id]
+                self._cond.notify_all()
@@ -0,0 +1,197 @@
+#!/usr/bin/env python
+# --coding:utf-8--
+
+import logging
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+logger = logging.getLogger(__name__)
+
+FALLBACK_TEXT = "Sorry, I don't understand."
+
+
+def build_replies(messages, fallback_text=FALLBACK_TEXT):
+    """
+    Map Dialogflow fulfillment messages to Lark messages, lazily, so the
+    first reply can be sent before the rest are converted.
+
+      - text:    a "text" message, variants joined by newlines
+      - card:    an "interactive" card with a header, the subtitle and
+                 one button per card button
+      - payload: {"lark": {"msg_type": ..., "content": {...}}}, or
+                 {"lark": {"msg_type": "interactive", "card": {...}}},
+                 sent as is; payloads for other platforms are skipped
+
+    :param messages: Iterator of (kind, value), see
+                     DialogflowHelper.iter_fulfillment_messages()
+    :param fallback_text: Text sent when nothing could be mapped
+    :return: Iterator of (msg_type, content)
+    """
+    sent_any = False
+    for kind, value in messages:
+        reply = None
+        if kind == "text":
+            text = "\n".join(t for t in value if t)
+            if text:
+                reply = ("text", {"text": text})
+        elif kind == "card":
+            reply = ("interactive", card_to_lark(value))
+        elif kind == "payload":
+            lark = value.get("lark")
+            if isinstance(lark, dict) and lark.get("msg_type"):
+                msg_type = lark["msg_type"]
+                reply = (msg_type, lark.get("card" if msg_type == "interactive" else "content", {}))
+            else:
+                logger.info("skip payload without a lark message", extra={"keys": list(value)})
+
+        if reply is not None:
+            sent_any = True
+            yield reply
+
+    if not sent_any:
+        yield "text", {"text": fallback_text}
+
+
+def card_to_lark(card):
+    """
+    Build a Lark interactive card from a Dialogflow basic card.
+
+    :param card: dict with title, subtitle, image_uri and buttons
+    :return: Lark card dict
+    """
+    elements = []
+    if card.get("subtitle"):
+        elements.append({"tag": "div", "text": {"tag": "lark_md", "content": card["subtitle"]}})
+
+    actions = []
+    for button in card.get("buttons", []):
+        action = {
+            "tag": "button",
+            "text": {"tag": "plain_text", "content": button.get("text", "")},
+            "type": "default",
+        }
+        postback = button.get("postback", "")
+        if postback.startswith(("http://", "https://")):
+            action["url"] = postback
+        else:
+            action["value"] = {"postback": postback}
+        actions.append(action)
+    if actions:
+        elements.append({"tag": "action", "actions": actions})
+
+    return {
+        "config": {"wide_screen_mode": True},
+        "header": {"title": {"tag": "plain_text", "content": card.get("title", "")}},
+        "elements": elements,
+    }
+
+
+class ReplySender:
+    """
+    Sends the replies of a message to its chat, first reply first.
+
+    The first reply is sent straight from the calling thread as soon as it
+    is built; the remaining ones are handed to a small pool, so the caller
+    is free for the next message and the sends of different chats overlap
+    on the pooled Lark connections. Each chat has at most one sender at a
+    time, draining a FIFO of that chat's replies, so a chat always sees its
+    replies in the order they were produced, including across messages.
+    """
+
+    def __init__(self, deliver, workers=8, samples=1000):
+        """
+        :param deliver: Callable (chat_id, msg_type, content) -> bool, True once sent
+        :param workers: Threads sending follow-up replies
+        :param samples: Number of recent time-to-first-reply samples kept
+        """
+        self.deliver = deliver
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="reply")
+        self._chats = {}
+        self._lock = threading.Lock()
+        self._ttfr = deque(maxlen=samples)
+
+        # Counters
+        self.sent = 0
+        self.failed = 0
+
+    def submit(self, chat_id, replies, started=None):
+        """
+        Send replies to a chat in order.
+
+        :param chat_id: Lark chat_id
+        :param replies: Iterable of (msg_type, content)
+        :param started: time.monotonic() at which handling of the message
+                        began, for the time-to-first-reply metric
+        """
+        replies = iter(replies)
+        first = next(replies, None)
+        if first is None:
+            return
+
+        with self._lock:
+            pending = self._chats.get(chat_id)
+            if pending is not None:
+                # The chat's sender is still busy; it will pick these up in order
+                pending.append(first)
+                pending.extend(replies)
+                return
+            pending = self._chats[chat_id] = deque()
+
+        # The chat is now ours: nobody else sends to it until we drain it
+        self._send(chat_id, first)
+        if started is not None:
+            with self._lock:
+                self._ttfr.append(time.monotonic() - started)
+
+        rest = list(replies)
+        with self._lock:
+            # Ahead of anything queued by later messages in the meantime
+            pending.extendleft(reversed(rest))
+            if not pending:
+                del self._chats[chat_id]
+                return
+        self._executor.submit(self._drain, chat_id, pending)
+
+    def stats(self):
+        """
+        :return: dict of sender counters and time-to-first-reply percentiles (ms)
+        """
+        with self._lock:
+            samples = sorted(self._ttfr)
+            stats = {
+                "sent": self.sent,
+                "failed": self.failed,
+                "chats_sending": len(self._chats),
+            }
+        for pct in (50, 90, 99):
+            index = min(len(samples) - 1, int(len(samples) * pct / 100))
+            stats[f"ttfr_p{pct}_ms"] = round(samples[index] * 1000, 1) if samples else 0.0
+        return stats
+
+    def shutdown(self, wait=True):
+        """Stop the follow-up senders, by default after they sent everything queued."""
+        self._executor.shutdown(wait=wait)
+
+    def _drain(self, chat_id, pending):
+        while True:
+            with self._lock:
+                if not pending:
+                    del self._chats[chat_id]
+                    return
+                reply = pending.popleft()
+            self._send(chat_id, reply)
+
+    def _send(self, chat_id, reply):
+        msg_type, content = reply
+        try:
+            ok = self.deliver(chat_id, msg_type, content)
+        except Exception as e:
+            logger.warning("reply send failed: %r", e, extra={"chat_id": chat_id})
+            ok = False
+        with self._lock:
+            if ok:
+                self.sent += 1
+            else:
+                self.failed += 1
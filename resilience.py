@@ -0,0 +1,202 @@
+#!/usr/bin/env python
+# --coding:utf-8--
+
+import threading
+import time
+from collections import deque
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+
+class CircuitOpenError(Exception):
+    """Raised instead of calling a service whose circuit breaker is open."""
+
+
+class CircuitBreaker:
+    """
+    Stops calling a failing service for a while.
+
+    Closed (normal), it counts consecutive failures; after
+    `failure_threshold` of them it opens, and calls are refused (allow()
+    returns False) for `reset_timeout` seconds. Then it is half open: one
+    trial call goes through, and closes it again if it succeeds or reopens
+    it if it fails. The caller decides what a failure is (e.g. deadlines
+    and UNAVAILABLE, not a bad request).
+    """
+
+    def __init__(self, failure_threshold=5, reset_timeout=30.0):
+        """
+        :param failure_threshold: Consecutive failures opening the circuit
+        :param reset_timeout: Seconds the circuit stays open before a trial call
+        """
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+
+        self._state = CLOSED
+        self._failures = 0
+        self._opened_at = 0.0
+        self._trial = False
+        self._lock = threading.Lock()
+
+        # Counters
+        self.opened = 0
+        self.rejected = 0
+        self.successes = 0
+        self.failures = 0
+
+    @property
+    def state(self):
+        with self._lock:
+            return self._current_locked(time.monotonic())
+
+    def allow(self):
+        """
+        :return: True if a call may go ahead; then record its outcome with
+                 record_success() / record_failure()
+        """
+        with self._lock:
+            state = self._current_locked(time.monotonic())
+            if state == CLOSED:
+                return True
+            if state == HALF_OPEN and not self._trial:
+                self._trial = True
+                return True
+            self.rejected += 1
+            return False
+
+    def record_success(self):
+        with self._lock:
+            self.successes += 1
+            self._failures = 0
+            self._trial = False
+            self._state = CLOSED
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            self._failures += 1
+            if self._trial or self._failures >= self.failure_threshold:
+                if self._state != OPEN:
+                    self.opened += 1
+                self._state = OPEN
+                self._opened_at = time.monotonic()
+                self._trial = False
+
+    def release(self):
+        """Forget a call allow() let through that ended without an outcome (e.g. cancelled)."""
+        with self._lock:
+            self._trial = False
+
+    def stats(self):
+        """
+        :return: dict of breaker state and counters
+        """
+        with self._lock:
+            return {
+                "state": self._current_locked(time.monotonic()),
+                "consecutive_failures": self._failures,
+                "opened": self.opened,
+                "rejected": self.rejected,
+                "successes": self.successes,
+                "failures": self.failures,
+            }
+
+    def _current_locked(self, now):
+        if self._state == OPEN and now - self._opened_at >= self.reset_timeout:
+            self._state = HALF_OPEN
+        return self._state
+
+
+class HedgePolicy:
+    """
+    When to send a hedged (second) request: once the first one has taken
+    longer than the `percentile` of recent latencies, within
+    [`min_delay`, `max_delay`] seconds. A budget caps the extra load: every
+    request earns `budget` of a hedge (up to `burst` saved), so a service
+    that is slow across the board isn't sent twice the traffic.
+    """
+
+    def __init__(self, percentile=95.0, min_delay=0.05, max_delay=2.0, budget=0.1, burst=10,
+                 samples=500):
+        """
+        :param percentile: Latency percentile after which a request is hedged
+        :param min_delay: Shortest hedge delay in seconds
+        :param max_delay: Longest hedge delay in seconds (used until there are enough samples)
+        :param budget: Hedges per request at most, in the long run
+        :param burst: Hedges that can be sent in a row once saved up
+        :param samples: Number of recent latencies the percentile is taken over
+        """
+        self.percentile = percentile
+        self.min_delay = min_delay
+        self.max_delay = max_delay
+        self.budget = budget
+        self.burst = burst
+
+        self._latencies = deque(maxlen=samples)
+        self._credit = 1.0
+        self._delay = max_delay
+        self._lock = threading.Lock()
+
+        # Counters
+        self.requests = 0
+        self.hedges = 0
+        self.wins = 0
+        self.over_budget = 0
+
+    def delay(self):
+        """:return: Seconds to wait for the first request before hedging"""
+        with self._lock:
+            return self._delay
+
+    def should_hedge(self):
+        """
+        Take a hedge from the budget.
+
+        :return: True if the request may be hedged now
+        """
+        with self._lock:
+            if self._credit < 1:
+                self.over_budget += 1
+                return False
+            self._credit -= 1
+            self.hedges += 1
+            return True
+
+    def record(self, latency, hedge_won=False):
+        """
+        Record a finished request.
+
+        :param latency: Seconds until it answered
+        :param hedge_won: It was hedged and the hedge answered first
+        """
+        with self._lock:
+            self.requests += 1
+            if hedge_won:
+                self.wins += 1
+            self._credit = min(self.burst, self._credit + self.budget)
+            self._latencies.append(latency)
+            if len(self._latencies) >= 20:
+                ordered = sorted(self._latencies)
+                index = min(len(ordered) - 1, int(len(ordered) * self.percentile / 100))
+                self._delay = min(self.max_delay, max(self.min_delay, ordered[index]))
+
+    def win_rate(self):
+        """:return: Share of hedges that answered before the request they hedged"""
+        with self._lock:
+            return self.wins / self.hedges if self.hedges else 0.0
+
+    def stats(self):
+        """
+        :return: dict of hedging counters, win rate and the current delay (ms)
+        """
+        with self._lock:
+            return {
+                "requests": self.requests,
+                "hedges": self.hedges,
+                "wins": self.wins,
+                "win_rate": round(self.wins / self.hedges, 3) if self.hedges else 0.0,
+                "over_budget": self.over_budget,
+                "delay_ms": round(self._delay * 1000, 1),
+            }
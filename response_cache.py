@@ -0,0 +1,261 @@
+#!/usr/bin/env python
+# --coding:utf-8--
+
+import base64
+import logging
+import re
+import threading
+import time
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+_WHITESPACE = re.compile(r"\s+")
+_TRAILING_PUNCTUATION = re.compile(r"[\s.!?,;:~。！？，；：]+$")
+
+# Dialogflow ES forgets a session's contexts after 20 minutes without traffic
+CONTEXT_TTL = 1200
+
+
+class ContextTracker:
+    """
+    Sessions that have active Dialogflow contexts, as far as this process
+    saw them being set. Entries expire after CONTEXT_TTL, like the contexts.
+    """
+
+    def __init__(self, max_sessions=10000):
+        """
+        :param max_sessions: Maximum number of sessions tracked (oldest dropped first)
+        """
+        self.max_sessions = max_sessions
+        self._sessions = OrderedDict()
+        self._lock = threading.Lock()
+
+    def track(self, session, active):
+        """
+        Mark a session as having (or no longer having) active contexts.
+        """
+        with self._lock:
+            if active:
+                self._sessions[session] = time.monotonic() + CONTEXT_TTL
+                self._sessions.move_to_end(session)
+                # The oldest sessions are the likeliest expired
+                while len(self._sessions) > self.max_sessions:
+                    self._sessions.popitem(last=False)
+            else:
+                self._sessions.pop(session, None)
+
+    def active(self, session):
+        """
+        :return: True if the session may have active contexts
+        """
+        with self._lock:
+            expires_at = self._sessions.get(session)
+            if expires_at is None:
+                return False
+            if expires_at <= time.monotonic():
+                del self._sessions[session]
+                return False
+            return True
+
+
+class RedisContextTracker:
+    """
+    ContextTracker kept in Redis next to a shared response cache, so a
+    process doesn't serve a cached answer to a session another process
+    saw setting contexts. Keys expire after CONTEXT_TTL.
+    """
+
+    def __init__(self, redis_client, prefix="dialogflow:contexts:"):
+        """
+        :param redis_client: redis.Redis instance
+        :param prefix: Redis key prefix
+        """
+        self.redis_client = redis_client
+        self.prefix = prefix
+
+    def track(self, session, active):
+        """
+        Mark a session as having (or no longer having) active contexts.
+        """
+        try:
+            if active:
+                self.redis_client.set(self.prefix + session, "1", ex=CONTEXT_TTL)
+            else:
+                self.redis_client.delete(self.prefix + session)
+        except Exception as e:
+            logger.warning("context tracker redis update failed: %r", e)
+
+    def active(self, session):
+        """
+        :return: True if the session may have active contexts
+        """
+        try:
+            return bool(self.redis_client.exists(self.prefix + session))
+        except Exception as e:
+            logger.warning("context tracker redis lookup failed: %r", e)
+            # Unknown: bypass the cache rather than risk a context-free answer
+            return True
+
+
+class IntentResponseCache:
+    """
+    Opt-in cache of DetectIntentResponses for context-free intents
+    ("hi", "help", FAQs), keyed on the normalized query text and language.
+
+    A response is only reused when it cannot depend on, or change, the
+    conversation state: the session must have no active contexts, and the
+    response must not set output contexts or extract parameters. Entries
+    are evicted by size (LRU) and age. With a Redis client the cache is
+    shared by every process, and entries expire through Redis TTLs; the
+    sessions with active contexts are then tracked in Redis too.
+    """
+
+    def __init__(self, max_size=1000, ttl=300, redis_client=None, prefix="dialogflow:cache:"):
+        """
+        :param max_size: Maximum number of in-memory entries
+        :param ttl: Seconds a response is reused
+        :param redis_client: Optional redis.Redis to share the cache between processes
+        :param prefix: Redis key prefix
+        """
+        self.max_size = max_size
+        self.ttl = ttl
+        self.redis_client = redis_client
+        self.prefix = prefix
+
+        self._entries = OrderedDict()
+        if redis_client is not None:
+            # Shared like the entries
+            self._contexts = RedisContextTracker(redis_client, prefix + "contexts:")
+        else:
+            # Bounded like the entries
+            self._contexts = ContextTracker(max_sessions=max_size * 10)
+        self._lock = threading.Lock()
+
+        # Counters
+        self.hits = 0
+        self.misses = 0
+        self.stores = 0
+        self.bypasses = 0
+        self.uncacheable = 0
+
+    @staticmethod
+    def normalize(text):
+        """
+        Cache key text: case-folded, whitespace collapsed, trailing punctuation removed.
+        """
+        text = _WHITESPACE.sub(" ", text.strip().casefold())
+        return _TRAILING_PUNCTUATION.sub("", text)
+
+    @staticmethod
+    def is_cacheable(response):
+        """
+        Whether a response is independent of the conversation state.
+        """
+        query_result = response.query_result
+        return (bool(query_result.intent.display_name)
+                and not query_result.output_contexts
+                and not query_result.parameters)
+
+    def lookup(self, session_path, text, language_code):
+        """
+        Cached response for a query, or None on a miss or when the session
+        has active contexts (the answer may then depend on them).
+
+        :return: DetectIntentResponse or None
+        """
+        if self.has_contexts(session_path):
+            with self._lock:
+                self.bypasses += 1
+            return None
+
+        key = language_code + ":" + self.normalize(text)
+        raw = self._get(key)
+        with self._lock:
+            if raw is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+        # Imported here so that building the cache doesn't load the Dialogflow SDK
+        from google.cloud import dialogflow_v2 as dialogflow
+        return dialogflow.DetectIntentResponse.deserialize(raw)
+
+    def store(self, session_path, text, language_code, response):
+        """
+        Record a fresh response: remember whether it left contexts active in
+        the session, and cache it if it is context-free.
+        """
+        # An answer given while contexts were active may depend on them
+        had_contexts = self.has_contexts(session_path)
+        self.track_contexts(session_path, bool(response.query_result.output_contexts))
+        if had_contexts or not self.is_cacheable(response):
+            with self._lock:
+                self.uncacheable += 1
+            return
+
+        key = language_code + ":" + self.normalize(text)
+        self._set(key, type(response).serialize(response))
+        with self._lock:
+            self.stores += 1
+
+    def track_contexts(self, session_path, active):
+        """
+        Mark a session as having (or no longer having) active contexts.
+        """
+        self._contexts.track(session_path, active)
+
+    def has_contexts(self, session_path):
+        return self._contexts.active(session_path)
+
+    def stats(self):
+        """
+        :return: dict of cache counters
+        """
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "size": len(self._entries),
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0,
+                "stores": self.stores,
+                "bypasses": self.bypasses,
+                "uncacheable": self.uncacheable,
+            }
+
+    def _get(self, key):
+        if self.redis_client is not None:
+            try:
+                raw = self.redis_client.get(self.prefix + key)
+                # Values are base64 so they survive decode_responses=True clients
+                return base64.b64decode(raw) if raw else None
+            except Exception as e:
+                logger.warning("response cache redis get failed: %r", e)
+                return None
+
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            expires_at, raw = entry
+            if expires_at <= now:
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return raw
+
+    def _set(self, key, raw):
+        if self.redis_client is not None:
+            try:
+                self.redis_client.set(self.prefix + key, base64.b64encode(raw).decode("ascii"),
+                                      ex=self.ttl)
+            except Exception as e:
+                logger.warning("response cache redis set failed: %r", e)
+            return
+
+        with self._lock:
+            self._entries[key] = (time.monotonic() + self.ttl, raw)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
@@ -0,0 +1,109 @@
+#!/usr/bin/env python
+# --coding:utf-8--
+
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+
+
+class Session:
+    """
+    State kept for one Dialogflow session.
+    """
+
+    __slots__ = ("key", "session_id", "session_path", "last_used")
+
+    def __init__(self, key, session_id, session_path):
+        self.key = key
+        self.session_id = session_id
+        self.session_path = session_path
+        self.last_used = time.monotonic()
+
+
+class SessionRegistry:
+    """
+    Maps a conversation key (a Lark chat, or a user inside a group chat) to
+    its Dialogflow session.
+
+    Session IDs are derived from the key, so every worker and process agrees
+    on the session of a chat without sharing state. The registry only keeps
+    recently used sessions: entries idle for longer than `ttl` seconds are
+    evicted, and at most `max_sessions` are kept (least recently used first),
+    so memory stays bounded however many chats the bot sees. Dialogflow ES
+    itself expires a session's contexts after 20 minutes of inactivity,
+    which is the default ttl.
+    """
+
+    def __init__(self, path_factory, ttl=1200, max_sessions=10000):
+        """
+        :param path_factory: Callable turning a session ID into a session path
+        :param ttl: Seconds of inactivity after which a session is evicted
+        :param max_sessions: Maximum number of sessions kept in memory
+        """
+        self.path_factory = path_factory
+        self.ttl = ttl
+        self.max_sessions = max_sessions
+        self._sessions = OrderedDict()
+        self._lock = threading.Lock()
+
+        # Counters
+        self.created = 0
+        self.evicted = 0
+
+    @staticmethod
+    def session_key(chat_id, sender_id=None, chat_type="p2p"):
+        """
+        Conversation key of a message. One-on-one chats share a session per
+        chat; in group chats every sender gets their own session so users
+        don't step on each other's contexts.
+
+        :param chat_id: Lark chat_id
+        :param sender_id: Sender open_id
+        :param chat_type: "p2p" or "group"
+        :return: str
+        """
+        if chat_type == "group" and sender_id:
+            return f"{chat_id}:{sender_id}"
+        return chat_id
+
+    @staticmethod
+    def session_id_for(key):
+        """
+        Stable Dialogflow session ID for a key (Dialogflow allows at most 36 characters).
+        """
+        return hashlib.sha1(key.encode("utf-8")).hexdigest()[:32]
+
+    def get(self, key):
+        """
+        Look up (or register) the session for a key and mark it as used.
+
+        :param key: Conversation key, see session_key()
+        :return: Session
+        """
+        now = time.monotonic()
+        with self._lock:
+            session = self._sessions.get(key)
+            if session is None:
+                session_id = self.session_id_for(key)
+                session = Session(key, session_id, self.path_factory(session_id))
+                self._sessions[key] = session
+                self.created += 1
+            else:
+                self._sessions.move_to_end(key)
+            session.last_used = now
+            self._evict(now)
+        return session
+
+    def __len__(self):
+        with self._lock:
+            return len(self._sessions)
+
+    def _evict(self, now):
+        # The OrderedDict is kept in least-recently-used order
+        while self._sessions:
+            oldest = next(iter(self._sessions.values()))
+            if len(self._sessions) <= self.max_sessions and now - oldest.last_used < self.ttl:
+                break
+            del self._sessions[oldest.key]
+            self.evicted += 1
@@ -0,0 +1,130 @@
+#!/usr/bin/env python
+# --coding:utf-8--
+
+"""
+Non-blocking structured logging.
+
+setup_logging() routes every logger through a bounded in-memory queue; one
+background thread formats the records and writes them out, so a slow or
+blocked stdout never stalls a request thread or the event loop. When the
+queue is full, records are dropped (and counted) instead of waiting.
+
+Modules log with the standard library, e.g.
+logging.getLogger(__name__).info("message sent", extra={"chat_id": chat_id}),
+and the JSON formatter puts the `extra` fields next to the message.
+"""
+
+import atexit
+import json
+import logging
+import logging.handlers
+import queue
+import sys
+
+# Attributes every LogRecord has; anything else came from `extra`
+_RECORD_ATTRS = set(vars(logging.LogRecord("", 0, "", 0, "", (), None))) | {"message", "asctime", "taskName"}
+
+
+class JsonFormatter(logging.Formatter):
+    """One JSON object per line: ts, level, logger, msg and the extra fields."""
+
+    def format(self, record):
+        entry = {
+            "ts": round(record.created, 3),
+            "level": record.levelname.lower(),
+            "logger": record.name,
+            "msg": record.getMessage(),
+        }
+        for key, value in vars(record).items():
+            if key not in _RECORD_ATTRS and not key.startswith("_"):
+                entry[key] = value
+        if record.exc_info:
+            entry["exc"] = self.formatException(record.exc_info)
+        elif record.exc_text:
+            entry["exc"] = record.exc_text
+        return json.dumps(entry, default=str, ensure_ascii=False)
+
+
+class TextFormatter(logging.Formatter):
+    """Human-readable lines for local runs, with the extra fields as key=value."""
+
+    def __init__(self):
+        super().__init__("%(asctime)s %(levelname)s %(name)s: %(message)s")
+
+    def format(self, record):
+        line = super().format(record)
+        fields = " ".join(f"{key}={value}" for key, value in vars(record).items()
+                          if key not in _RECORD_ATTRS and not key.startswith("_"))
+        return f"{line} {fields}" if fields else line
+
+
+class DroppingQueueHandler(logging.handlers.QueueHandler):
+    """A QueueHandler that never blocks: records that don't fit are dropped."""
+
+    def __init__(self, log_queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+    def prepare(self, record):
+        # The listener thread formats; only make the record safe to hand over
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+
+_listener = None
+_handler = None
+
+
+def setup_logging(level="INFO", fmt="json", stream=None, max_queue=10000):
+    """
+    Send all logging through a bounded queue and a background writer thread.
+
+    :param level: Root log level name, e.g. "INFO" or "DEBUG"
+    :param fmt: "json" (one object per line) or "text"
+    :param stream: Where to write, stdout by default
+    :param max_queue: Records waiting to be written before new ones are dropped
+    :return: The DroppingQueueHandler (see dropped())
+    """
+    global _listener, _handler
+    stop_logging()
+
+    writer = logging.StreamHandler(stream or sys.stdout)
+    writer.setFormatter(JsonFormatter() if fmt == "json" else TextFormatter())
+    _handler = DroppingQueueHandler(queue.Queue(maxsize=max_queue))
+    _listener = logging.handlers.QueueListener(_handler.queue, writer, respect_handler_level=False)
+    _listener.start()
+
+    root = logging.getLogger()
+    for handler in list(root.handlers):
+        root.removeHandler(handler)
+    root.addHandler(_handler)
+    root.setLevel(level.upper() if isinstance(level, str) else level)
+    return _handler
+
+
+def stop_logging():
+    """Write out the records still queued and stop the writer thread."""
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
+
+
+def dropped():
+    """
+    :return: Number of records dropped because the queue was full
+    """
+    return _handler.dropped if _handler is not None else 0
+
+
+atexit.register(stop_logging)
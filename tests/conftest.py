@@ -0,0 +1,114 @@
+import os
+import sys
+
+import pytest
+
+# The bot's modules live at the top of the repository
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if ROOT not in sys.path:
+    sys.path.insert(0, ROOT)
+
+
+@pytest.fixture
+def fake_sessions():
+    """
+    Start local fake Dialogflow Sessions services; call the fixture with
+    FakeSessions arguments. Stopped after the test.
+    """
+    from benchmarks.fake_dialogflow import FakeSessions
+
+    started = []
+
+    def start(fake_class=FakeSessions, **kwargs):
+        fake = fake_class(**kwargs).start()
+        started.append(fake)
+        return fake
+
+    yield start
+    for fake in started:
+        fake.stop()
+
+
+@pytest.fixture
+def serve_async():
+    """
+    Run AsyncWebhookServers on background event loops; call the fixture
+    with AsyncWebhookServer arguments. serve_async.stop(server) stops one
+    (draining its queue); the others are stopped after the test.
+    """
+    import asyncio
+    import threading
+
+    from async_server import AsyncWebhookServer
+
+    threads = {}
+
+    def start(*args, **kwargs):
+        kwargs.setdefault("host", "127.0.0.1")
+        kwargs.setdefault("port", 0)
+        server = AsyncWebhookServer(*args, **kwargs)
+        ready = threading.Event()
+
+        def run():
+            loop = asyncio.new_event_loop()
+            asyncio.set_event_loop(loop)
+            loop.run_until_complete(server.start())
+            ready.set()
+            loop.run_until_complete(server.serve_forever())
+            loop.close()
+
+        threads[server] = threading.Thread(target=run, daemon=True)
+        threads[server].start()
+        ready.wait()
+        return server
+
+    def stop(server):
+        thread = threads.pop(server, None)
+        if thread is not None:
+            server.request_stop()
+            thread.join(10)
+
+    start.stop = stop
+    yield start
+    for server in list(threads):
+        stop(server)
+
+
+def raw_request(port, head, body=b""):
+    """:return: (HTTP status, response body) of a hand-written request"""
+    import socket
+
+    with socket.create_connection(("127.0.0.1", port), timeout=10) as sock:
+        sock.sendall(head.encode("latin-1") + b"\r\n\r\n" + body)
+        rsp = sock.makefile("rb")
+        status = int(rsp.readline().split()[1])
+        length = 0
+        while True:
+            line = rsp.readline().strip()
+            if not line:
+                break
+            name, _, value = line.decode("latin-1").partition(":")
+            if name.lower() == "content-length":
+                length = int(value)
+        return status, rsp.read(length)
+
+
+@pytest.fixture
+def post_callback():
+    """POST a callback body (dict or bytes) to a port; returns (status, body)."""
+    import json
+
+    def post(port, body):
+        if isinstance(body, dict):
+            body = json.dumps(body).encode()
+        head = (f"POST / HTTP/1.1\r\nHost: bot\r\nContent-Type: application/json\r\n"
+                f"Content-Length: {len(body)}\r\nConnection: close")
+        return raw_request(port, head, body)
+
+    return post
+
+
+@pytest.fixture
+def send_raw():
+    """Send a hand-written request head (and body) to a port; returns (status, body)."""
+    return raw_request
@@ -0,0 +1,85 @@
+import json
+import threading
+
+import pytest
+
+from benchmarks._offline import VERIFICATION_TOKEN, message_event
+from dedup import create_deduplicator
+
+POST = "POST / HTTP/1.1\r\nHost: bot\r\nContent-Type: application/json\r\nConnection: close"
+
+
+@pytest.fixture
+def server(serve_async):
+    return serve_async(VERIFICATION_TOKEN, lambda message: None)
+
+
+def test_url_verification(server, post_callback):
+    status, body = post_callback(server.port, {"type": "url_verification", "token": VERIFICATION_TOKEN,
+                                               "challenge": "c"})
+    assert status == 200
+    assert json.loads(body) == {"challenge": "c"}
+
+
+@pytest.mark.parametrize("head, expected", [
+    ("GET /" + "x" * 70000 + " HTTP/1.1\r\nHost: bot", 414),
+    (f"{POST}\r\nX-Pad: {'x' * 70000}", 431),
+    (POST + "".join(f"\r\nX-Pad-{i}: x" for i in range(120)), 431),
+    (POST, 411),
+    (f"{POST}\r\nContent-Length: many", 400),
+    (f"{POST}\r\nContent-Length: {64 * 1024 * 1024}", 413),
+], ids=["long request line", "long header", "too many headers", "no content-length",
+        "bad content-length", "body too large"])
+def test_bad_request_heads_are_answered(server, send_raw, head, expected):
+    status, _ = send_raw(server.port, head)
+    assert status == expected
+
+
+def test_failing_duplicate_check_answers_500(serve_async, post_callback):
+    handled = []
+
+    def is_duplicate(event):
+        raise ConnectionError("dedup store down")
+
+    server = serve_async(VERIFICATION_TOKEN, handled.append, is_duplicate=is_duplicate)
+    status, _ = post_callback(server.port, message_event("om_500"))
+    serve_async.stop(server)
+
+    # Lark retries a 500, so the message is not handled now
+    assert status == 500
+    assert handled == []
+
+
+def test_unqueued_message_is_refused_and_its_retry_accepted(serve_async, post_callback):
+    deduplicator = create_deduplicator("memory")
+    handled = []
+    queue_down = [True]
+
+    def enqueue(message):
+        if queue_down[0]:
+            raise ConnectionError("event queue down")
+        handled.append(message["message_id"])
+
+    server = serve_async(VERIFICATION_TOKEN, handled.append, enqueue=enqueue,
+                         is_duplicate=lambda event: not deduplicator.claim("event:" + event.event_id),
+                         forget=lambda event: deduplicator.release("event:" + event.event_id))
+    event = message_event("om_retry")
+    assert post_callback(server.port, event)[0] == 500
+    queue_down[0] = False
+    assert post_callback(server.port, event)[0] == 200
+    assert post_callback(server.port, event)[0] == 200
+    assert handled == ["om_retry"]
+
+
+def test_full_pipeline_answers_503(serve_async, post_callback):
+    forgotten = []
+    gate = threading.Event()
+    server = serve_async(VERIFICATION_TOKEN, lambda message: gate.wait(), workers=1, max_queue=1,
+                         forget=lambda event: forgotten.append(event.event_id))
+    try:
+        statuses = [post_callback(server.port, message_event(f"om_full_{i}"))[0] for i in range(4)]
+    finally:
+        gate.set()
+    # One message is being handled, one waits, the others are refused
+    assert statuses == [200, 200, 503, 503]
+    assert forgotten == ["ev_om_full_2", "ev_om_full_3"]
@@ -0,0 +1,31 @@
+from benchmarks._offline import import_bot
+
+
+class ExpiringLarkClient:
+    """Rejects the first token with 401, accepts the next one."""
+
+    def __init__(self):
+        self.sent = []
+
+    def send_message(self, token, chat_id, text):
+        self.sent.append(token)
+        if token == "t-expired":
+            return 401, {"code": 99991663, "msg": "invalid access token"}
+        return 200, {"code": 0}
+
+
+class RefreshingTokenManager:
+    def invalidate(self, token):
+        return "t-fresh"
+
+
+def test_send_retries_once_with_a_fresh_token(monkeypatch, capsys):
+    bot = import_bot("bot_v1")
+    client = ExpiringLarkClient()
+    monkeypatch.setattr(bot, "lark_client", client)
+    monkeypatch.setattr(bot, "token_manager", RefreshingTokenManager())
+
+    bot.RequestHandler.send_message(None, "t-expired", "oc_1", "hello")
+
+    assert client.sent == ["t-expired", "t-fresh"]
+    assert "failed" not in capsys.readouterr().out
@@ -0,0 +1,55 @@
+import json
+import time
+
+from event_queue import EventConsumer, SqliteEventQueue
+from message_debouncer import MessageDebouncer
+
+
+def text_message(i, chat_id="oc_1"):
+    return {"message_id": f"om_{i}", "chat_id": chat_id, "message_type": "text",
+            "content": json.dumps({"text": f"part {i}"}),
+            "sender": {"sender_id": {"open_id": "ou_1"}}}
+
+
+def wait_for(predicate, timeout=10.0):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if predicate():
+            return True
+        time.sleep(0.02)
+    return False
+
+
+def test_burst_refused_after_the_debounce_is_redelivered(tmp_path):
+    event_queue = SqliteEventQueue(str(tmp_path / "events.sqlite3"), visibility=0.3)
+    handled = []
+    refusals = [1]
+
+    def downstream(message):
+        # The pool is full the first time the burst is flushed
+        if refusals[0]:
+            refusals[0] -= 1
+            return False
+        handled.append(message)
+        for original in message.get("merged", ()):
+            consumer.done(original)
+        consumer.done(message)
+        return True
+
+    debouncer = MessageDebouncer(downstream, window=0.05, max_delay=0.2,
+                                 on_reject=lambda message: consumer.release(message))
+    consumer = EventConsumer(event_queue, debouncer.submit)
+    try:
+        for i in range(3):
+            event_queue.put(text_message(i))
+
+        assert wait_for(lambda: event_queue.pending() == 0)
+        stats = consumer.stats()
+        assert stats["released"] == 3
+        assert stats["redelivered"] == 3
+        assert stats["acked"] == 3
+        assert stats["inflight"] == 0
+        assert json.loads(handled[-1]["content"])["text"] == "part 0 part 1 part 2"
+    finally:
+        consumer.stop(drain=False)
+        debouncer.shutdown()
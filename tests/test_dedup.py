@@ -0,0 +1,90 @@
+import threading
+from collections import Counter
+
+import pytest
+
+from benchmarks._offline import VERIFICATION_TOKEN, message_event
+from dedup import create_deduplicator
+
+THREADS = 8
+KEYS = 200
+
+
+def claim_concurrently(deduplicators):
+    """
+    Every thread claims every key, all starting together.
+
+    :return: Counter of successful claims per key
+    """
+    claims = Counter()
+    lock = threading.Lock()
+    barrier = threading.Barrier(THREADS)
+
+    def run(deduplicator):
+        barrier.wait()
+        for i in range(KEYS):
+            if deduplicator.claim(f"om_{i}"):
+                with lock:
+                    claims[f"om_{i}"] += 1
+
+    threads = [threading.Thread(target=run, args=(deduplicators[i % len(deduplicators)],))
+               for i in range(THREADS)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return claims
+
+
+def test_memory_claims_each_key_once():
+    claims = claim_concurrently([create_deduplicator("memory")])
+    assert claims == Counter({f"om_{i}": 1 for i in range(KEYS)})
+
+
+def test_sqlite_claims_each_key_once_across_processes(tmp_path):
+    # One deduplicator per process sharing the file, each with its own front cache
+    path = str(tmp_path / "dedup.sqlite3")
+    deduplicators = [create_deduplicator("sqlite", sqlite_path=path) for _ in range(2)]
+    claims = claim_concurrently(deduplicators)
+    assert claims == Counter({f"om_{i}": 1 for i in range(KEYS)})
+    assert sum(d.stats()["duplicates"] for d in deduplicators) == (THREADS - 1) * KEYS
+
+
+def test_concurrent_retries_of_a_callback_are_handled_once(serve_async, post_callback):
+    deduplicator = create_deduplicator("memory")
+    handled = Counter()
+    lock = threading.Lock()
+
+    def handle(message):
+        with lock:
+            handled[message["message_id"]] += 1
+
+    server = serve_async(VERIFICATION_TOKEN, handle, workers=4,
+                         is_duplicate=lambda event: not deduplicator.claim("event:" + event.event_id))
+    events = [message_event(f"om_retry_{i}", chat_id=f"oc_{i % 3}") for i in range(20)]
+    statuses = Counter()
+
+    def deliver(event):
+        status, _ = post_callback(server.port, event)
+        with lock:
+            statuses[status] += 1
+
+    # Lark's retries of every event arrive together, over separate connections
+    threads = [threading.Thread(target=deliver, args=(event,)) for event in events for _ in range(5)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    serve_async.stop(server)
+
+    assert statuses == Counter({200: len(threads)})
+    assert handled == Counter({f"om_retry_{i}": 1 for i in range(20)})
+
+
+@pytest.mark.parametrize("backend", ["memory", "sqlite"])
+def test_released_key_can_be_claimed_again(backend, tmp_path):
+    deduplicator = create_deduplicator(backend, sqlite_path=str(tmp_path / "dedup.sqlite3"))
+    assert deduplicator.claim("event:ev_1")
+    assert not deduplicator.claim("event:ev_1")
+    deduplicator.release("event:ev_1")
+    assert deduplicator.claim("event:ev_1")
@@ -0,0 +1,67 @@
+import asyncio
+
+import pytest
+from google.protobuf import struct_pb2
+
+from async_dialogflow_helper import AsyncDialogflowHelper
+from benchmarks._offline import import_google_auth_offline
+from benchmarks.fake_dialogflow import FakeSessions
+from dialogflow_helper import DialogflowHelper
+
+import_google_auth_offline()
+
+
+class RecordingSessions(FakeSessions):
+    """Keeps every DetectIntentRequest."""
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.requests = []
+
+    def detect_intent(self, request, context):
+        self.requests.append(request)
+        return super().detect_intent(request, context)
+
+
+# The same parameters as plain values, as Values (the form callers used before) and as a Struct
+PLAIN = {"order": "A-17", "count": 2.0}
+VALUES = {"order": struct_pb2.Value(string_value="A-17"), "count": struct_pb2.Value(number_value=2.0)}
+FORMS = [None, PLAIN, VALUES, struct_pb2.Struct(fields=VALUES)]
+
+
+def sent_parameters(fake):
+    request = fake.requests[-1]
+    if request.query_params.contexts:
+        return dict(request.query_params.contexts[0].parameters)
+    return dict(request.query_input.event.parameters)
+
+
+@pytest.mark.parametrize("parameters", FORMS, ids=["none", "plain", "values", "struct"])
+def test_sync_parameters(fake_sessions, parameters):
+    fake = fake_sessions(RecordingSessions, latency=0.0)
+    helper = DialogflowHelper("test-project", "test-session", sessions_client=fake.sessions_client())
+    expected = PLAIN if parameters is not None else {}
+
+    helper.detect_intent_with_event("ORDER_STATUS", parameters=parameters)
+    assert sent_parameters(fake) == expected
+    helper.detect_intent_with_contexts("where is it", "order", parameters=parameters)
+    assert sent_parameters(fake) == expected
+
+
+@pytest.mark.parametrize("parameters", FORMS, ids=["none", "plain", "values", "struct"])
+def test_async_parameters(fake_sessions, parameters):
+    fake = fake_sessions(RecordingSessions, latency=0.0)
+    expected = PLAIN if parameters is not None else {}
+
+    async def run():
+        helper = AsyncDialogflowHelper("test-project", "test-session",
+                                       client_factory=fake.async_sessions_client)
+        try:
+            await helper.detect_intent_with_event("ORDER_STATUS", parameters=parameters)
+            assert sent_parameters(fake) == expected
+            await helper.detect_intent_with_contexts("where is it", "order", parameters=parameters)
+            assert sent_parameters(fake) == expected
+        finally:
+            await helper.close()
+
+    asyncio.run(run())
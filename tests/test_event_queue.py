@@ -0,0 +1,124 @@
+import json
+import threading
+import time
+
+from benchmarks._offline import import_bot
+from event_queue import EventConsumer, SqliteEventQueue, consumer_name
+from worker_pool import OVERFLOW_SPILL, WorkerPool
+
+
+def text_message(i, chat_id="oc_1"):
+    return {"message_id": f"om_{i}", "chat_id": chat_id, "message_type": "text",
+            "content": json.dumps({"text": f"part {i}"}),
+            "sender": {"sender_id": {"open_id": "ou_1"}}}
+
+
+def wait_for(predicate, timeout=10.0):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if predicate():
+            return True
+        time.sleep(0.02)
+    return False
+
+
+def test_full_pool_leaves_entries_in_the_queue(tmp_path):
+    event_queue = SqliteEventQueue(str(tmp_path / "events.sqlite3"), visibility=0.3)
+    spill_path = tmp_path / "spill.jsonl"
+    gate = threading.Event()
+    handled = []
+
+    def handle(message):
+        gate.wait()
+        handled.append(message["message_id"])
+        consumer.done(message)
+
+    pool = WorkerPool(handle, workers=1, max_queue=2, overflow=OVERFLOW_SPILL,
+                      spill_path=str(spill_path), key=lambda m: m["chat_id"])
+    consumer = EventConsumer(event_queue, pool.offer)
+    try:
+        for i in range(20):
+            event_queue.put(text_message(i))
+        assert wait_for(lambda: consumer.stats()["refused"] > 0)
+        assert event_queue.pending() == 20
+        assert not spill_path.exists()
+
+        gate.set()
+        assert wait_for(lambda: event_queue.pending() == 0)
+        assert handled == [f"om_{i}" for i in range(20)]
+        assert pool.stats()["spilled"] == 0
+    finally:
+        gate.set()
+        consumer.stop(drain=False)
+        pool.shutdown(wait=True)
+
+
+class RecordingConsumer:
+    def __init__(self):
+        self.acked = []
+
+    def done(self, message):
+        self.acked.append(message["queue_id"])
+
+
+def test_redelivered_message_is_acked_without_a_second_reply(monkeypatch):
+    bot = import_bot("bot_v2")
+    handled = []
+    consumer = RecordingConsumer()
+    monkeypatch.setattr(bot, "handle_message", lambda message: handled.append(message["message_id"]))
+    monkeypatch.setattr(bot, "event_consumer", consumer)
+
+    first = dict(text_message("redelivered"), queue_id=1)
+    bot.handle_queued(first)
+    # The same entry after a crash, and a burst holding it and a new message
+    bot.handle_queued(dict(first, queue_id=1))
+    burst = dict(text_message("new"), queue_id=3, merged=[dict(first, queue_id=1)])
+    bot.handle_queued(burst)
+
+    assert handled == ["om_redelivered", "om_new"]
+    assert consumer.acked == [1, 1, 1, 3]
+
+
+def test_held_entries_are_not_taken_back_after_the_visibility_timeout(tmp_path):
+    event_queue = SqliteEventQueue(str(tmp_path / "events.sqlite3"), visibility=0.3)
+    gate = threading.Event()
+    handled = []
+
+    def handle(message):
+        gate.wait()
+        handled.append(message["message_id"])
+        consumer.done(message)
+
+    pool = WorkerPool(handle, workers=1, max_queue=5, key=lambda m: m["chat_id"])
+    consumer = EventConsumer(event_queue, pool.offer)
+    try:
+        for i in range(10):
+            event_queue.put(text_message(i))
+        # Held by the pipeline for several visibility timeouts
+        time.sleep(1.2)
+        assert consumer.stats()["redelivered"] == 0
+
+        gate.set()
+        assert wait_for(lambda: event_queue.pending() == 0)
+        assert handled == [f"om_{i}" for i in range(10)]
+        assert consumer.stats()["consumed"] == 10
+    finally:
+        gate.set()
+        consumer.stop(drain=False)
+        pool.shutdown(wait=True)
+
+
+def test_claims_of_a_reused_pid_are_released(tmp_path):
+    path = str(tmp_path / "events.sqlite3")
+    event_queue = SqliteEventQueue(path)
+    for i in range(2):
+        event_queue.put(text_message(i))
+    host, pid, start = consumer_name().split(":")
+    # Entry 1: this process; entry 2: a dead process that had the same pid
+    event_queue._conn.execute("UPDATE events SET owner = ?, claimed_at = ? WHERE id = 1",
+                              (consumer_name(), time.time()))
+    event_queue._conn.execute("UPDATE events SET owner = ?, claimed_at = ? WHERE id = 2",
+                              (f"{host}:{pid}:{int(start) - 1}", time.time()))
+
+    reopened = SqliteEventQueue(path, consumer="restarted")
+    assert [entry_id for entry_id, _, _ in reopened.get(timeout=0)] == [2]
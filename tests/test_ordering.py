@@ -0,0 +1,93 @@
+import asyncio
+import random
+import threading
+import time
+from collections import defaultdict
+
+from async_server import AsyncWebhookServer
+from worker_pool import OVERFLOW_SPILL, WorkerPool
+
+CHATS = 20
+PER_CHAT = 25
+
+
+def interleaved_messages():
+    """Messages of every chat, numbered per chat and interleaved."""
+    return [{"chat_id": f"oc_{chat}", "seq": seq} for seq in range(PER_CHAT) for chat in range(CHATS)]
+
+
+def assert_fifo(handled):
+    assert len(handled) == CHATS
+    for chat_id, seqs in handled.items():
+        assert seqs == list(range(PER_CHAT)), chat_id
+
+
+def test_worker_pool_handles_a_chat_in_order():
+    handled = defaultdict(list)
+    lock = threading.Lock()
+
+    def handle(message):
+        time.sleep(random.uniform(0, 0.002))
+        with lock:
+            handled[message["chat_id"]].append(message["seq"])
+
+    pool = WorkerPool(handle, workers=8, max_queue=CHATS * PER_CHAT, key=lambda m: m["chat_id"])
+    for message in interleaved_messages():
+        assert pool.submit(message)
+    pool.shutdown(wait=True)
+
+    assert_fifo(handled)
+    assert pool.stats()["keys"] == 0
+
+
+def test_async_server_handles_a_chat_in_order():
+    handled = defaultdict(list)
+    running = set()
+    overlaps = []
+
+    async def handle(message):
+        chat_id = message["chat_id"]
+        if chat_id in running:
+            overlaps.append(chat_id)
+        running.add(chat_id)
+        await asyncio.sleep(random.uniform(0, 0.002))
+        handled[chat_id].append(message["seq"])
+        running.discard(chat_id)
+
+    async def run():
+        server = AsyncWebhookServer("test-token", handle, host="127.0.0.1", port=0, workers=8,
+                                    key=lambda m: m["chat_id"])
+        await server.start()
+        for message in interleaved_messages():
+            server._enqueue(message)
+        await server.stop()
+
+    asyncio.run(run())
+    assert_fifo(handled)
+    assert overlaps == []
+
+
+def test_spilled_messages_keep_their_chat_order(tmp_path):
+    handled = []
+    gate = threading.Event()
+
+    def handle(message):
+        gate.wait()
+        time.sleep(0.01)
+        handled.append(message["seq"])
+
+    pool = WorkerPool(handle, workers=1, max_queue=2, overflow=OVERFLOW_SPILL,
+                      spill_path=str(tmp_path / "spill.jsonl"), key=lambda m: m["chat_id"])
+    for seq in range(6):
+        pool.submit({"chat_id": "oc_1", "seq": seq})
+    gate.set()
+    # Room frees up before the spilled messages are replayed
+    time.sleep(0.015)
+    for seq in range(6, 10):
+        pool.submit({"chat_id": "oc_1", "seq": seq})
+
+    deadline = time.monotonic() + 10
+    while len(handled) < 10 and time.monotonic() < deadline:
+        time.sleep(0.02)
+    pool.shutdown(wait=True)
+    assert handled == list(range(10))
@@ -0,0 +1,127 @@
+import asyncio
+import time
+
+import grpc
+import pytest
+from google.api_core import exceptions
+
+from async_dialogflow_helper import AsyncDialogflowHelper
+from benchmarks._offline import import_google_auth_offline
+from benchmarks.fake_dialogflow import FakeSessions
+from dialogflow_helper import DialogflowHelper
+from resilience import CLOSED, OPEN, CircuitBreaker, CircuitOpenError, HedgePolicy
+
+import_google_auth_offline()
+
+
+class FirstCallUnavailable(FakeSessions):
+    """Fails the first call fast with UNAVAILABLE, answers the others."""
+
+    def detect_intent(self, request, context):
+        with self._lock:
+            first = self.calls == 0
+        if first:
+            with self._lock:
+                self.calls += 1
+            context.abort(grpc.StatusCode.UNAVAILABLE, "injected failure")
+        return super().detect_intent(request, context)
+
+
+def test_sync_deadline(fake_sessions):
+    fake = fake_sessions(latency=1.0)
+    helper = DialogflowHelper("test-project", "test-session", timeout=0.2,
+                              sessions_client=fake.sessions_client())
+    start = time.perf_counter()
+    with pytest.raises(exceptions.DeadlineExceeded):
+        helper._detect_intent_text("slow")
+    assert time.perf_counter() - start < 0.6
+
+
+def test_async_deadline(fake_sessions):
+    fake = fake_sessions(latency=1.0)
+
+    async def run():
+        helper = AsyncDialogflowHelper("test-project", "test-session", timeout=0.2,
+                                       client_factory=fake.async_sessions_client)
+        try:
+            await helper.detect_intent("slow")
+        finally:
+            await helper.close()
+
+    start = time.perf_counter()
+    with pytest.raises(exceptions.DeadlineExceeded):
+        asyncio.run(run())
+    assert time.perf_counter() - start < 0.6
+
+
+def test_breaker_opens_spares_dialogflow_and_closes(fake_sessions):
+    fake = fake_sessions(latency=0.0, error_rate=1.0, error_code=grpc.StatusCode.INTERNAL)
+    breaker = CircuitBreaker(failure_threshold=3, reset_timeout=0.3)
+    helper = DialogflowHelper("test-project", "test-session", timeout=1.0,
+                              sessions_client=fake.sessions_client(), breaker=breaker)
+
+    for _ in range(3):
+        with pytest.raises(exceptions.InternalServerError):
+            helper._detect_intent_text("ping")
+    assert breaker.state == OPEN
+
+    calls = fake.calls
+    for _ in range(10):
+        with pytest.raises(CircuitOpenError):
+            helper._detect_intent_text("ping")
+    assert fake.calls == calls
+
+    # Dialogflow recovers; the trial call after the reset timeout closes the breaker
+    fake.error_rate = 0.0
+    time.sleep(0.4)
+    assert helper._detect_intent_text("ping").query_result.query_text == "ping"
+    assert breaker.state == CLOSED
+
+
+def test_events_go_through_the_breaker(fake_sessions):
+    fake = fake_sessions(latency=0.0, error_rate=1.0, error_code=grpc.StatusCode.INTERNAL)
+    breaker = CircuitBreaker(failure_threshold=2, reset_timeout=30.0)
+    helper = DialogflowHelper("test-project", "test-session", timeout=1.0,
+                              sessions_client=fake.sessions_client(), breaker=breaker)
+
+    for _ in range(2):
+        with pytest.raises(exceptions.InternalServerError):
+            helper.detect_intent_with_event("WELCOME")
+    calls = fake.calls
+    with pytest.raises(CircuitOpenError):
+        helper.detect_intent_with_event("WELCOME")
+    assert fake.calls == calls
+
+
+def hedge():
+    # A hedge delay far above the fake's latency: only a failed first call can trigger it early
+    return HedgePolicy(min_delay=1.0, max_delay=1.0, budget=1.0, burst=10)
+
+
+def test_sync_hedge_fires_on_a_fast_failure(fake_sessions):
+    fake = fake_sessions(FirstCallUnavailable, latency=0.01)
+    helper = DialogflowHelper("test-project", "test-session", timeout=5.0, retry=None,
+                              sessions_client=fake.sessions_client(), hedge=hedge())
+    start = time.perf_counter()
+    response = helper._detect_intent_text("ping")
+    assert time.perf_counter() - start < 0.5
+    assert response.query_result.query_text == "ping"
+    assert fake.calls == 2
+
+
+def test_async_hedge_fires_on_a_fast_failure(fake_sessions):
+    fake = fake_sessions(FirstCallUnavailable, latency=0.01)
+
+    async def run():
+        helper = AsyncDialogflowHelper("test-project", "test-session", timeout=5.0, retry=None,
+                                       client_factory=fake.async_sessions_client, hedge=hedge())
+        try:
+            return await helper.detect_intent("ping")
+        finally:
+            await helper.close()
+
+    start = time.perf_counter()
+    response = asyncio.run(run())
+    assert time.perf_counter() - start < 0.5
+    assert response.query_result.query_text == "ping"
+    assert fake.calls == 2
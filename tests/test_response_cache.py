@@ -0,0 +1,52 @@
+from google.cloud import dialogflow_v2 as dialogflow
+
+from response_cache import IntentResponseCache
+
+SESSION = "projects/p/agent/sessions/oc_1"
+
+
+class DictRedis:
+    """The few Redis commands the cache uses, on a dict shared by the "processes"."""
+
+    def __init__(self):
+        self.data = {}
+
+    def get(self, key):
+        return self.data.get(key)
+
+    def set(self, key, value, ex=None):
+        self.data[key] = value
+        return True
+
+    def delete(self, key):
+        self.data.pop(key, None)
+
+    def exists(self, key):
+        return int(key in self.data)
+
+
+def response(text, contexts=()):
+    return dialogflow.DetectIntentResponse(query_result=dialogflow.QueryResult(
+        query_text=text,
+        fulfillment_text=f"answer to {text}",
+        intent=dialogflow.Intent(display_name="Greeting"),
+        output_contexts=[dialogflow.Context(name=f"{SESSION}/contexts/{c}", lifespan_count=2)
+                         for c in contexts],
+    ))
+
+
+def test_shared_cache_sees_contexts_set_in_another_process():
+    redis_client = DictRedis()
+    worker_1 = IntentResponseCache(redis_client=redis_client)
+    worker_2 = IntentResponseCache(redis_client=redis_client)
+
+    worker_1.store("projects/p/agent/sessions/oc_2", "hi", "en", response("hi"))
+    assert worker_2.lookup(SESSION, "hi", "en") is not None
+
+    # Worker 1 sees the session enter a conversation; worker 2 must not answer it from the cache
+    worker_1.store(SESSION, "order pizza", "en", response("order pizza", contexts=["ordering"]))
+    assert worker_2.lookup(SESSION, "hi", "en") is None
+    assert worker_2.stats()["bypasses"] == 1
+
+    worker_1.track_contexts(SESSION, False)
+    assert worker_2.lookup(SESSION, "hi", "en") is not None
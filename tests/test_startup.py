@@ -0,0 +1,34 @@
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+from benchmarks._offline import offline_env
+from benchmarks.bench_startup import measure_import
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Same budget as benchmarks.bench_startup
+IMPORT_BUDGET_SECONDS = 0.25
+
+
+def test_import_within_budget():
+    samples, heavy = measure_import(3)
+    assert heavy == []
+    assert statistics.median(samples) < IMPORT_BUDGET_SECONDS
+
+
+def test_import_leaves_queue_and_redis_to_the_warm_up(tmp_path):
+    # The default EVENT_QUEUE=auto; nothing may touch Redis or the disk before the bind
+    env = offline_env(dict(os.environ, EVENT_QUEUE="auto", PYTHONPATH=ROOT))
+    snippet = ("import json, sys, threading, bot_v2\n"
+               "print(json.dumps({'redis': 'redis' in sys.modules,"
+               " 'threads': [t.name for t in threading.enumerate()]}))")
+    out = subprocess.run([sys.executable, "-c", snippet], cwd=tmp_path, env=env,
+                         capture_output=True, text=True, check=True)
+    result = json.loads(out.stdout.strip().splitlines()[-1])
+
+    assert not result["redis"]
+    assert "consumer" not in result["threads"]
+    assert os.listdir(tmp_path) == []
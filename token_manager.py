@@ -0,0 +1,220 @@
+#!/usr/bin/env python
+# --coding:utf-8--
+
+import json
+import logging
+import threading
+import time
+
+from lark_client import LarkClient
+
+logger = logging.getLogger(__name__)
+
+# Open API error codes meaning the tenant_access_token is invalid or expired
+INVALID_TOKEN_CODES = {99991661, 99991663, 99991668}
+
+
+def is_invalid_token(status, rsp_dict):
+    """
+    Whether an Open API response means the access token was rejected.
+
+    :param status: HTTP status code
+    :param rsp_dict: Decoded response body
+    :return: bool
+    """
+    return status == 401 or rsp_dict.get("code") in INVALID_TOKEN_CODES
+
+
+class TenantTokenManager:
+    """
+    Process-wide cache for the Lark tenant_access_token.
+
+    The token is fetched once and reused until `refresh_margin` seconds
+    before its `expire` time, when a background timer refreshes it. Callers
+    that arrive while a refresh is in flight wait for that single request
+    instead of issuing their own. With a Redis client the token is shared by
+    every process of the deployment, and a short Redis lock collapses
+    refreshes across processes as well.
+    """
+
+    def __init__(self, app_id, app_secret, client=None,
+                 refresh_margin=300, redis_client=None, background_refresh=True):
+        """
+        :param app_id: APP_ID of the Lark app
+        :param app_secret: APP_SECRET of the Lark app
+        :param client: LarkClient used to call the auth endpoint
+        :param refresh_margin: Seconds before expiry at which the token is refreshed
+        :param redis_client: Optional redis.Redis used to share the token between processes
+        :param background_refresh: Refresh ahead of expiry on a timer thread
+        """
+        self.app_id = app_id
+        self.app_secret = app_secret
+        self.client = client or LarkClient()
+        self.refresh_margin = refresh_margin
+        self.redis_client = redis_client
+        self.background_refresh = background_refresh
+
+        self.redis_key = f"lark:tenant_access_token:{app_id}"
+        self.redis_lock_key = self.redis_key + ":lock"
+
+        self._token = ""
+        self._expires_at = 0.0
+        self._cond = threading.Condition()
+        self._refreshing = False
+        self._timer = None
+
+        # Counters
+        self.hits = 0
+        self.fetches = 0
+        self.failures = 0
+
+    def get(self):
+        """
+        Return a valid tenant_access_token, fetching one if needed.
+
+        :return: token (str), "" if it could not be obtained
+        """
+        with self._cond:
+            if self._valid():
+                self.hits += 1
+                return self._token
+            if self._refreshing:
+                # A background refresh is running; the old token is still usable
+                if self._token and time.time() < self._expires_at:
+                    self.hits += 1
+                    return self._token
+                # Another caller is already fetching, wait for its result
+                self._cond.wait_for(lambda: not self._refreshing)
+                return self._token if time.time() < self._expires_at else ""
+            self._refreshing = True
+
+        return self._refresh_and_notify()
+
+    def invalidate(self, token=None):
+        """
+        Drop the cached token and fetch a new one immediately, e.g. after the
+        Open API answered 401. Passing the rejected token avoids throwing
+        away a newer one that another caller already fetched.
+
+        :param token: The token that was rejected
+        :return: The new token (str), "" if it could not be obtained
+        """
+        with self._cond:
+            if token is None or token == self._token:
+                self._token = ""
+                self._expires_at = 0.0
+                if self.redis_client is not None:
+                    try:
+                        cached = self._load_shared()
+                        # Don't discard a token another process already replaced
+                        if cached is not None and (token is None or cached[0] == token):
+                            self.redis_client.delete(self.redis_key)
+                    except Exception as e:
+                        logger.warning("redis token delete failed: %r", e)
+        return self.get()
+
+    def stop(self):
+        """Cancel the background refresh timer."""
+        with self._cond:
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+
+    def _valid(self):
+        return bool(self._token) and time.time() < self._expires_at - self.refresh_margin
+
+    def _refresh_and_notify(self):
+        token, expires_at = "", 0.0
+        try:
+            token, expires_at = self._load_or_fetch()
+        finally:
+            with self._cond:
+                if token:
+                    self._token = token
+                    self._expires_at = expires_at
+                    self._schedule_refresh()
+                self._refreshing = False
+                self._cond.notify_all()
+        return token
+
+    def _background_refresh(self):
+        with self._cond:
+            if self._refreshing:
+                return
+            self._refreshing = True
+        self._refresh_and_notify()
+
+    def _schedule_refresh(self):
+        if not self.background_refresh:
+            return
+        if self._timer is not None:
+            self._timer.cancel()
+        delay = max(1.0, self._expires_at - self.refresh_margin - time.time())
+        self._timer = threading.Timer(delay, self._background_refresh)
+        self._timer.daemon = True
+        self._timer.start()
+
+    def _load_or_fetch(self):
+        """
+        Get the token from Redis if another process already refreshed it,
+        otherwise fetch it from the Open API.
+
+        :return: (token, absolute expiry timestamp)
+        """
+        if self.redis_client is None:
+            return self._fetch()
+
+        try:
+            cached = self._load_shared()
+            if cached is not None:
+                return cached
+
+            # Only one process fetches; the others poll Redis for its result
+            if self.redis_client.set(self.redis_lock_key, "1", nx=True, ex=10):
+                try:
+                    token, expires_at = self._fetch()
+                    if token:
+                        ttl = max(1, int(expires_at - time.time()))
+                        self.redis_client.set(self.redis_key,
+                                              json.dumps({"token": token, "expires_at": expires_at}),
+                                              ex=ttl)
+                    return token, expires_at
+                finally:
+                    self.redis_client.delete(self.redis_lock_key)
+
+            deadline = time.time() + 10
+            while time.time() < deadline:
+                time.sleep(0.05)
+                cached = self._load_shared()
+                if cached is not None:
+                    return cached
+        except Exception as e:
+            logger.warning("redis token cache unavailable: %r", e)
+
+        return self._fetch()
+
+    def _load_shared(self):
+        raw = self.redis_client.get(self.redis_key)
+        if not raw:
+            return None
+        cached = json.loads(raw)
+        if time.time() >= cached["expires_at"] - self.refresh_margin:
+            return None
+        return cached["token"], cached["expires_at"]
+
+    def _fetch(self):
+        """
+        POST to the tenant_access_token endpoint.
+
+        :return: (token, absolute expiry timestamp), ("", 0.0) on failure
+        """
+        self.fetches += 1
+        status, rsp_dict = self.client.tenant_access_token(self.app_id, self.app_secret)
+
+        code = rsp_dict.get("code", -1)
+        if code != 0:
+            self.failures += 1
+            logger.error("get tenant_access_token failed", extra={"code": code})
+            return "", 0.0
+        expires_at = time.time() + rsp_dict.get("expire", 7200)
+        return rsp_dict.get("tenant_access_token", ""), expires_at
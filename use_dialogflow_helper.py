@@ -47,6 +47,11 @@ def main():
     #     print(f"User: {texts[i]}")
     #     print("Response:", df_helper.get_fulfillment_text(res))
 
+    # Example: Concurrent batch, e.g. for regression-testing an agent
+    # results = df_helper.detect_intent_batch(texts, max_concurrency=16)
+    # for r in results:
+    #     print(r.text, "->", r.error or df_helper.get_fulfillment_text(r.response))
+
     # Example: Event-based trigger
     # event_response = df_helper.detect_intent_with_event("WELCOME_EVENT")
     # print("Event response text:", df_helper.get_fulfillment_text(event_response))
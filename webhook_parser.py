@@ -0,0 +1,160 @@
+#!/usr/bin/env python
+# --coding:utf-8--
+
+import json
+import re
+
+# Lark callbacks are a few KB; a larger body is refused before it is read
+MAX_BODY = 1024 * 1024
+
+MESSAGE_EVENT = "im.message.receive_v1"
+
+# Tokens that appear verbatim in any JSON encoding of the callback
+_PLAIN_TOKEN = re.compile(r"[A-Za-z0-9_\-]+")
+
+_decoder = json.JSONDecoder()
+
+
+class InvalidCallback(ValueError):
+    """A request rejected before it reached the bot, with the HTTP status to answer."""
+
+    def __init__(self, status, reason):
+        super().__init__(reason)
+        self.status = status
+        self.reason = reason
+
+
+class CallbackEvent:
+    """The fields of a Lark callback the bot acts on."""
+
+    __slots__ = ("verified", "token", "event_type", "event_id", "message", "challenge")
+
+    def __init__(self, verified, token="", event_type="", event_id="", message=None, challenge=""):
+        self.verified = verified
+        self.token = token
+        self.event_type = event_type
+        self.event_id = event_id
+        # im.message.receive_v1 only: the message, with its sender under "sender"
+        self.message = message
+        self.challenge = challenge
+
+
+def json_loads(backend="auto"):
+    """
+    :param backend: "json", "orjson", or "auto" for orjson when it is installed
+    :return: Callable decoding JSON from bytes
+    """
+    if backend in ("auto", "orjson"):
+        try:
+            import orjson
+            return orjson.loads
+        except ImportError:
+            if backend == "orjson":
+                raise
+    return _json_loads
+
+
+def _json_loads(data):
+    """json.loads for UTF-8 bytes, without sniffing their encoding first."""
+    if isinstance(data, (bytes, bytearray)):
+        data = data.decode("utf-8")
+    return _decoder.decode(data)
+
+
+class WebhookParser:
+    """
+    Ingress parser for Lark event callbacks, shared by both server modes.
+
+    Checks the body size before reading it, rejects bodies that can't be a
+    callback (not a JSON object, or without the verification token) before
+    decoding them, and decodes the bytes in one pass with `loads` (orjson
+    when available). Only the token, event type, event_id, URL verification
+    challenge and message are picked out; the rest of the callback is left
+    alone.
+    """
+
+    def __init__(self, verification_token, max_body=MAX_BODY, loads=None):
+        """
+        :param verification_token: APP_VERIFICATION_TOKEN from the Lark developer console
+        :param max_body: Largest accepted body in bytes
+        :param loads: Callable decoding JSON bytes, see json_loads(); defaults to "auto"
+        """
+        self.verification_token = verification_token
+        self.max_body = max_body
+        self.loads = loads or json_loads()
+        # The token's bytes must be in the body: a cheap test before decoding
+        plain = bool(verification_token) and _PLAIN_TOKEN.fullmatch(verification_token) is not None
+        self._token_bytes = verification_token.encode() if plain else None
+
+    def body_length(self, content_length, transfer_encoding=None):
+        """
+        Validate the request's Content-Length before the body is read.
+
+        :param content_length: Content-Length header value, None if missing
+        :param transfer_encoding: Transfer-Encoding header value, None if missing
+        :return: Number of body bytes to read
+        """
+        if transfer_encoding is not None and transfer_encoding.lower() != "identity":
+            raise InvalidCallback(411, "chunked body")
+        if content_length is None:
+            raise InvalidCallback(411, "missing content-length")
+        try:
+            length = int(content_length)
+        except ValueError:
+            raise InvalidCallback(400, "invalid content-length") from None
+        if length < 0:
+            raise InvalidCallback(400, "invalid content-length")
+        if length > self.max_body:
+            raise InvalidCallback(413, "body too large")
+        return length
+
+    def parse(self, body):
+        """
+        :param body: Request body (bytes)
+        :return: CallbackEvent; verified is False if the token doesn't match
+        """
+        if len(body) > self.max_body:
+            raise InvalidCallback(413, "body too large")
+        if body[:1] != b"{" and body.lstrip()[:1] != b"{":
+            raise InvalidCallback(400, "not a JSON object")
+        if self._token_bytes is not None and self._token_bytes not in body:
+            return CallbackEvent(False)
+        try:
+            obj = self.loads(body)
+        except ValueError:
+            raise InvalidCallback(400, "malformed JSON") from None
+        if not isinstance(obj, dict):
+            raise InvalidCallback(400, "not a JSON object")
+
+        # v2 callbacks carry token, event type and event_id in the header, v1 at the top level
+        header = obj.get("header")
+        if not isinstance(header, dict):
+            header = {}
+        token = obj.get("token") or header.get("token") or ""
+        if token != self.verification_token:
+            return CallbackEvent(False, token)
+
+        event_type = obj.get("type") or header.get("event_type") or ""
+        event = CallbackEvent(True, token, event_type, header.get("event_id") or "")
+        if event_type == "url_verification":
+            event.challenge = obj.get("challenge", "")
+        elif event_type == MESSAGE_EVENT:
+            payload = obj.get("event")
+            message = payload.get("message") if isinstance(payload, dict) else None
+            if not isinstance(message, dict):
+                raise InvalidCallback(400, "message event without a message")
+            # Keep the sender with the message, it selects the Dialogflow session
+            message["sender"] = payload.get("sender") or {}
+            event.message = message
+        return event
+
+    def content(self, message):
+        """
+        :param message: Lark message dict
+        :return: Its decoded "content" dict, empty if it is missing or malformed
+        """
+        try:
+            content = self.loads(message.get("content") or "{}")
+        except ValueError:
+            return {}
+        return content if isinstance(content, dict) else {}
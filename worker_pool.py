@@ -0,0 +1,371 @@
+#!/usr/bin/env python
+# --coding:utf-8--
+
+import json
+import logging
+import os
+import queue
+import threading
+import time
+from collections import Counter, deque
+
+logger = logging.getLogger(__name__)
+
+OVERFLOW_DROP = "drop"
+OVERFLOW_BUSY = "busy"
+OVERFLOW_SPILL = "spill"
+
+
+class WorkerPool:
+    """
+    A fixed number of worker threads draining a bounded queue of messages.
+
+    Replaces "one thread per message": the number of threads (and therefore
+    of concurrent Dialogflow calls) is capped, and the memory held by waiting
+    messages is bounded by max_queue. When the queue is full the overflow
+    policy decides what happens to the new message:
+
+      - "drop":  log and discard it
+      - "busy":  call on_busy(message), e.g. to reply "busy, try again"
+      - "spill": append it to a JSON lines file and replay it once the
+                 workers are idle again (survives a restart)
+
+    Only the message dict is queued, never the request handler, so the
+    handler and its socket can be released as soon as the ack is written.
+
+    With a `key` function the pool dispatches in order per key: messages
+    with the same key (e.g. the same chat_id) are handled one at a time, in
+    the order they were submitted, while different keys run in parallel.
+    The shared queue then holds keys that have work, each at most once,
+    and every key has its own FIFO of messages; a worker takes a key,
+    handles its oldest message, and puts the key back at the end of the
+    queue if more are waiting, so a busy chat can't starve the others.
+    The FIFO of a key is dropped as soon as it is empty. While a key has
+    spilled messages, its new messages are spilled after them (or refused
+    by offer()), so the replay keeps its order.
+    """
+
+    def __init__(self, handler, workers=8, max_queue=1000, overflow=OVERFLOW_DROP,
+                 on_busy=None, spill_path="spill.jsonl", name="worker", key=None):
+        """
+        :param handler: Callable taking one message dict
+        :param workers: Number of worker threads
+        :param max_queue: Maximum number of messages waiting for a worker
+        :param overflow: Overflow policy, one of "drop", "busy", "spill"
+        :param on_busy: Callable taking the rejected message (policy "busy")
+        :param spill_path: JSON lines file used by policy "spill"
+        :param name: Thread name prefix
+        :param key: Optional callable returning a message's ordering key;
+                    messages with equal keys are handled one at a time, in order
+        """
+        if overflow not in (OVERFLOW_DROP, OVERFLOW_BUSY, OVERFLOW_SPILL):
+            raise ValueError(f"unknown overflow policy: {overflow}")
+
+        self.handler = handler
+        self.workers = workers
+        self.max_queue = max_queue
+        self.overflow = overflow
+        self.on_busy = on_busy
+        self.spill_path = spill_path
+        self.key = key
+
+        self._queue = queue.Queue(maxsize=max_queue)
+        # Ordered mode: per-key FIFOs of waiting messages
+        self._keyed = {}
+        self._keyed_depth = 0
+        self._lock = threading.Lock()
+        self._spill_lock = threading.Lock()
+        # Ordered mode: number of spilled messages per key, guarded by _spill_lock
+        self._spilled_keys = Counter()
+        self._stopping = False
+
+        # Counters
+        self.submitted = 0
+        self.completed = 0
+        self.failed = 0
+        self.dropped = 0
+        self.busy_replies = 0
+        self.spilled = 0
+        self.replayed = 0
+        self.max_depth = 0
+        self.max_keys = 0
+        self._active = 0
+        self._busy_seconds = 0.0
+        self._stats_at = time.monotonic()
+        self._stats_busy = 0.0
+
+        self._threads = [
+            threading.Thread(target=self._run, name=f"{name}-{i}", daemon=True)
+            for i in range(workers)
+        ]
+        for t in self._threads:
+            t.start()
+
+        if self.overflow == OVERFLOW_SPILL:
+            self._replay_spill()
+
+    def submit(self, message):
+        """
+        Queue a message for the workers without blocking.
+
+        :param message: Lark message dict
+        :return: True if queued, False if the overflow policy handled it
+        """
+        if self.overflow == OVERFLOW_SPILL and self.key is not None:
+            with self._spill_lock:
+                if self._offer_after_spill(message):
+                    return True
+                self._spill_locked(message)
+            return False
+        if self.offer(message):
+            return True
+        self._overflow(message)
+        return False
+
+    def offer(self, message):
+        """
+        Queue a message if there is room, without the overflow policy: for
+        messages whose source keeps them until they are handled and delivers
+        them again (the durable event queue), so they are neither dropped,
+        answered "busy" nor spilled.
+
+        :param message: Lark message dict
+        :return: True if queued, False if the pool is full (or, in ordered
+                 mode, older messages of its key are spilled)
+        """
+        if self.overflow == OVERFLOW_SPILL and self.key is not None:
+            with self._spill_lock:
+                return self._offer_after_spill(message)
+        return self._offer(message)
+
+    def _offer_after_spill(self, message):
+        """offer() behind the spilled messages of the key, with the spill lock held."""
+        if self._spilled_keys[self.key(message)]:
+            return False
+        return self._offer(message)
+
+    def _offer(self, message):
+        try:
+            self._enqueue(message)
+        except queue.Full:
+            return False
+
+        with self._lock:
+            self.submitted += 1
+            depth = self._depth()
+            if depth > self.max_depth:
+                self.max_depth = depth
+        return True
+
+    def load(self):
+        """
+        Current load, without starting a new utilization window like stats().
+
+        :return: (messages being handled, messages waiting)
+        """
+        with self._lock:
+            return self._active, self._depth()
+
+    def stats(self):
+        """
+        Snapshot of the pool's sizing metrics.
+
+        utilization is the fraction of worker time spent handling messages
+        since the previous call to stats().
+
+        :return: dict
+        """
+        now = time.monotonic()
+        with self._lock:
+            busy = self._busy_seconds
+            elapsed = now - self._stats_at
+            utilization = (busy - self._stats_busy) / (elapsed * self.workers) if elapsed > 0 else 0.0
+            self._stats_at = now
+            self._stats_busy = busy
+            return {
+                "workers": self.workers,
+                "active": self._active,
+                "queue_depth": self._depth(),
+                "max_queue": self.max_queue,
+                "max_depth": self.max_depth,
+                "keys": len(self._keyed),
+                "max_keys": self.max_keys,
+                "utilization": round(min(utilization, 1.0), 4),
+                "submitted": self.submitted,
+                "completed": self.completed,
+                "failed": self.failed,
+                "dropped": self.dropped,
+                "busy_replies": self.busy_replies,
+                "spilled": self.spilled,
+                "replayed": self.replayed,
+            }
+
+    def shutdown(self, wait=True):
+        """
+        Stop the workers after the queued messages have been handled.
+
+        :param wait: Block until the queue is drained and the workers exited
+        """
+        if wait:
+            self._queue.join()
+        self._stopping = True
+        for _ in self._threads:
+            try:
+                self._queue.put_nowait(None)
+            except queue.Full:
+                break
+        if wait:
+            for t in self._threads:
+                t.join()
+
+    def _run(self):
+        while not self._stopping:
+            try:
+                item = self._queue.get(timeout=1.0)
+            except queue.Empty:
+                if self.overflow == OVERFLOW_SPILL:
+                    self._replay_spill()
+                continue
+
+            if item is None:
+                self._queue.task_done()
+                break
+
+            if self.key is None:
+                message = item
+            else:
+                # The key is off the queue, so no other worker touches it until we put it back
+                with self._lock:
+                    message = self._keyed[item].popleft()
+                    self._keyed_depth -= 1
+
+            with self._lock:
+                self._active += 1
+            start = time.monotonic()
+            try:
+                self.handler(message)
+                ok = True
+            except Exception:
+                logger.exception("worker failed to handle message")
+                ok = False
+            finally:
+                duration = time.monotonic() - start
+                with self._lock:
+                    self._active -= 1
+                    self._busy_seconds += duration
+                    if ok:
+                        self.completed += 1
+                    else:
+                        self.failed += 1
+                    if self.key is not None:
+                        if self._keyed[item]:
+                            # Back of the line: other chats get a turn first
+                            self._queue.put_nowait(item)
+                        else:
+                            del self._keyed[item]
+                self._queue.task_done()
+
+            if self.overflow == OVERFLOW_SPILL and self._depth() == 0:
+                self._replay_spill()
+
+    def _enqueue(self, message):
+        """
+        Queue a message, raising queue.Full when the pool is at capacity.
+        """
+        if self.key is None:
+            self._queue.put_nowait(message)
+            return
+
+        key = self.key(message)
+        with self._lock:
+            if self._keyed_depth >= self.max_queue:
+                raise queue.Full
+            pending = self._keyed.get(key)
+            if pending is None:
+                pending = self._keyed[key] = deque()
+                # At most one entry per key and no more keys than messages,
+                # so this never exceeds max_queue
+                self._queue.put_nowait(key)
+                if len(self._keyed) > self.max_keys:
+                    self.max_keys = len(self._keyed)
+            pending.append(message)
+            self._keyed_depth += 1
+
+    def _depth(self):
+        """Number of messages waiting for a worker."""
+        if self.key is None:
+            return self._queue.qsize()
+        return self._keyed_depth
+
+    def _overflow(self, message):
+        message_id = message.get("message_id", "")
+        if self.overflow == OVERFLOW_BUSY and self.on_busy is not None:
+            with self._lock:
+                self.busy_replies += 1
+            logger.warning("queue full, busy reply", extra={"message_id": message_id})
+            try:
+                self.on_busy(message)
+            except Exception as e:
+                logger.warning("busy reply failed: %r", e)
+        elif self.overflow == OVERFLOW_SPILL:
+            with self._spill_lock:
+                self._spill_locked(message)
+        else:
+            with self._lock:
+                self.dropped += 1
+            logger.warning("queue full, message dropped", extra={"message_id": message_id})
+
+    def _spill_locked(self, message):
+        """Append a message to the spill file, with the spill lock held."""
+        with open(self.spill_path, "a", encoding="utf-8") as f:
+            f.write(json.dumps(message) + "\n")
+        if self.key is not None:
+            self._spilled_keys[self.key(message)] += 1
+        with self._lock:
+            self.spilled += 1
+        logger.warning("queue full, message spilled", extra={"message_id": message.get("message_id", "")})
+
+    def _replay_spill(self):
+        """Move spilled messages back into the queue while there is room."""
+        with self._spill_lock:
+            if not os.path.exists(self.spill_path):
+                return
+            with open(self.spill_path, "r", encoding="utf-8") as f:
+                lines = [line for line in f if line.strip()]
+
+            consumed = replayed = 0
+            for line in lines:
+                try:
+                    message = json.loads(line)
+                except ValueError:
+                    logger.warning("skipping corrupt spill line", extra={"line": line[:80]})
+                    consumed += 1
+                    continue
+                try:
+                    self._enqueue(message)
+                except queue.Full:
+                    break
+                consumed += 1
+                replayed += 1
+
+            rest = lines[consumed:]
+            if self.key is not None:
+                # Also counts the spill file left by a previous run
+                self._spilled_keys.clear()
+                for line in rest:
+                    try:
+                        self._spilled_keys[self.key(json.loads(line))] += 1
+                    except ValueError:
+                        pass
+            if rest:
+                tmp_path = self.spill_path + ".tmp"
+                with open(tmp_path, "w", encoding="utf-8") as f:
+                    f.writelines(rest)
+                os.replace(tmp_path, self.spill_path)
+            else:
+                os.remove(self.spill_path)
+
+        if replayed:
+            with self._lock:
+                self.replayed += replayed
+                self.submitted += replayed